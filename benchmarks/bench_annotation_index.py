@@ -0,0 +1,81 @@
+"""
+Benchmark for merging annotation saves into a page.
+
+Compares the nested id scan formerly used by ``_save_annotation_type``
+with the id-indexed upsert of ``AnnotationIndex`` when a page already
+holds many annotations.
+
+Usage:
+    python benchmarks/bench_annotation_index.py [annotations_per_page] [updates]
+"""
+
+import sys
+import time
+
+from pdfx.models import AnnotationIndex
+
+
+def make_page(count):
+    """Build one page of scribble strokes."""
+    return [{'id': f'stroke_{i}', 'data': {'points': [[i, i]]}} for i in range(count)]
+
+
+def linear_merge(existing_page_annotations, page_annotations):
+    """The previous merge: a set of ids, then a scan per updated annotation."""
+    existing_ids = {ann.get('id') for ann in existing_page_annotations if isinstance(ann, dict)}
+    for new_annotation in page_annotations:
+        if new_annotation.get('id') not in existing_ids:
+            existing_page_annotations.append(new_annotation)
+        else:
+            for i, existing_ann in enumerate(existing_page_annotations):
+                if existing_ann.get('id') == new_annotation.get('id'):
+                    existing_page_annotations[i] = new_annotation
+                    break
+
+
+def indexed_merge(index, page_annotations):
+    """The indexed merge used by the XBlock."""
+    for new_annotation in page_annotations:
+        index.upsert('marker_strokes', '1', new_annotation)
+
+
+def measure(label, func):
+    """Run a function once and print its wall time."""
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed * 1000:10.2f} ms")
+    return elapsed
+
+
+def main(argv):
+    per_page = int(argv[1]) if len(argv) > 1 else 10000
+    updates = int(argv[2]) if len(argv) > 2 else 1000
+
+    # Update the most recent strokes, the common case for autosave
+    batch = [{'id': f'stroke_{i}', 'data': {'points': [[0, 0]]}}
+             for i in range(per_page - updates, per_page)]
+
+    print(f"{per_page} annotations on the page, {updates} updated per save")
+
+    page = make_page(per_page)
+    linear = measure('linear scan merge', lambda: linear_merge(page, batch))
+
+    fields = {'marker_strokes': {'1': make_page(per_page)}}
+    index = AnnotationIndex({}, fields.__getitem__)
+    measure('index build (once)', lambda: index.rebuild(fields.keys()))
+    indexed = measure('indexed upsert merge', lambda: indexed_merge(index, batch))
+
+    delete_ids = [f'stroke_{i}' for i in range(0, per_page, per_page // 100 or 1)]
+    page = make_page(per_page)
+    measure('linear delete (100 ids)', lambda: [
+        page.__setitem__(slice(None), [ann for ann in page if ann['id'] != annotation_id])
+        for annotation_id in delete_ids
+    ])
+    measure('indexed delete (100 ids)', lambda: [index.remove(annotation_id) for annotation_id in delete_ids])
+
+    print(f"speedup on merge: {linear / indexed:.1f}x")
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,70 @@
+"""
+Benchmark for storing a large compressed annotation field.
+
+A save usually changes one page of a field. Compares serializing the
+field as plain JSON (the cost the user state store pays anyway), with
+compressing the whole field on every save, as the first format of
+``CompressedDict`` did, and with the per-page format, which only
+compresses the pages that changed.
+
+Usage:
+    python benchmarks/bench_compressed_save.py [pages] [annotations_per_page] [saves]
+"""
+
+import base64
+import json
+import sys
+import time
+import zlib
+
+from pdfx.models import CompressedDict
+
+
+def make_field(pages, per_page):
+    """Build a field of text annotations."""
+    return {
+        str(page): [{'id': f'note_{page}_{i}', 'type': 'text', 'data': {'text': f'note {i} of page {page} ' * 4}}
+                    for i in range(per_page)]
+        for page in range(1, pages + 1)
+    }
+
+
+def plain_save(value):
+    """Serialize the field, without compression."""
+    return json.dumps(value, separators=(',', ':'))
+
+
+def whole_field_save(value):
+    """The previous format: compress the JSON of the whole field."""
+    return base64.b64encode(zlib.compress(plain_save(value).encode('utf-8'))).decode('ascii')
+
+
+def measure(label, func, value, saves):
+    """Change one page and save the field, repeatedly, and print the time per save."""
+    start = time.perf_counter()
+    for save in range(saves):
+        value['1'][0]['data']['text'] = f'edit {save}'
+        func(value)
+    elapsed = (time.perf_counter() - start) / saves
+    print(f"{label:<28} {elapsed * 1000:10.3f} ms/save")
+    return elapsed
+
+
+def main(argv):
+    pages = int(argv[1]) if len(argv) > 1 else 200
+    per_page = int(argv[2]) if len(argv) > 2 else 20
+    saves = int(argv[3]) if len(argv) > 3 else 50
+    value = make_field(pages, per_page)
+    field = CompressedDict()
+
+    print(f"{pages} pages of {per_page} annotations, {len(plain_save(value)) // 1024} KB of JSON, one page changed per save")
+    measure('plain JSON', plain_save, value, saves)
+    whole = measure('whole field compressed', whole_field_save, value, saves)
+    field.to_json(value)
+    per_page_time = measure('per page, cached', field.to_json, value, saves)
+
+    print(f"speedup per save: {whole / per_page_time:.1f}x")
+
+
+if __name__ == '__main__':
+    main(sys.argv)
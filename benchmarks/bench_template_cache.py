@@ -0,0 +1,64 @@
+"""
+Benchmark for rendering the student_view template.
+
+Compares reading and compiling ``pdfx.html`` on every render, as
+``student_view`` formerly did, with rendering the compiled template kept
+by ``TemplateCache``, with and without the dev-mode mtime check.
+
+Usage:
+    python benchmarks/bench_template_cache.py [renders]
+"""
+
+import re
+import sys
+import time
+from importlib.resources import files
+
+from mako.template import Template
+
+from pdfx.services import TemplateCache
+
+TEMPLATE_PATH = 'static/html/pdfx.html'
+
+
+def make_context(text):
+    """Give every variable of the template a short placeholder value."""
+    return {name: '1' for name in re.findall(r'\$\{\s*(\w+)', text)}
+
+
+def uncached_render(context):
+    """The previous render: read the file and compile it every time."""
+    html = files('pdfx').joinpath(TEMPLATE_PATH).read_text(encoding='utf-8')
+    return Template(html).render(**context)
+
+
+def cached_render(context, check_mtime=False):
+    """The cached render used by the XBlock."""
+    return TemplateCache.get(TEMPLATE_PATH, check_mtime=check_mtime).render(**context)
+
+
+def measure(label, func, renders):
+    """Run a function repeatedly and print its time per call."""
+    start = time.perf_counter()
+    for _ in range(renders):
+        func()
+    elapsed = (time.perf_counter() - start) / renders
+    print(f"{label:<28} {elapsed * 1000:10.3f} ms/render")
+    return elapsed
+
+
+def main(argv):
+    renders = int(argv[1]) if len(argv) > 1 else 200
+    context = make_context(files('pdfx').joinpath(TEMPLATE_PATH).read_text(encoding='utf-8'))
+
+    print(f"{renders} renders of {TEMPLATE_PATH}")
+    uncached = measure('compile every render', lambda: uncached_render(context), renders)
+    TemplateCache.clear()
+    cached = measure('template cache', lambda: cached_render(context), renders)
+    measure('template cache + mtime', lambda: cached_render(context, check_mtime=True), renders)
+
+    print(f"speedup per render: {uncached / cached:.1f}x")
+
+
+if __name__ == '__main__':
+    main(sys.argv)
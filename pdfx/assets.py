@@ -0,0 +1,122 @@
+"""
+Content-hashed static assets for the PDF XBlock.
+
+``python -m pdfx.assets`` copies the student view's JavaScript and CSS to
+``public/build/`` under names carrying a hash of their content, and writes
+``public/build/manifest.json`` mapping each source path to its built
+file. When the manifest exists, student_view references the built files
+through the runtime's local resource URLs, which browsers cache across
+unit views because a changed file gets a new name. Without a manifest
+the sources are inlined into the fragment as before.
+
+Installing the package (``pip install``) runs the build through the
+``build_py`` command in setup.py, so installed packages ship with the
+manifest. Run ``python -m pdfx.assets`` by hand only in a source checkout
+served without installing, and again after changing an asset there.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+from importlib.resources import files
+
+from .config import STUDENT_VIEW_CSS, STUDENT_VIEW_JS
+
+log = logging.getLogger(__name__)
+
+BUILD_DIR = 'public/build'
+MANIFEST_PATH = f'{BUILD_DIR}/manifest.json'
+
+
+class StaticAssets:
+    """Adds the student view's JavaScript and CSS to a fragment, by URL when built."""
+
+    _manifest = None
+
+    @classmethod
+    def manifest(cls):
+        """
+        Get the build manifest, read once per process.
+
+        Returns:
+            dict: Source path -> built path, empty if nothing was built.
+        """
+        if cls._manifest is None:
+            try:
+                cls._manifest = json.loads(files(__package__).joinpath(MANIFEST_PATH).read_text(encoding='utf-8'))
+            except (OSError, ValueError):
+                cls._manifest = {}
+        return cls._manifest
+
+    @classmethod
+    def add_to_fragment(cls, block, frag, use_urls=True):
+        """
+        Add the student view's CSS and JavaScript to a fragment, in order.
+
+        Args:
+            block: The XBlock rendering the fragment.
+            frag (Fragment): The fragment.
+            use_urls (bool): Reference built files by URL when they exist.
+        """
+        manifest = cls.manifest() if use_urls else {}
+        inlined = []
+        for path in STUDENT_VIEW_CSS:
+            if path in manifest:
+                frag.add_css_url(block.runtime.local_resource_url(block, manifest[path]))
+            else:
+                frag.add_css(block.resource_string(path))
+                inlined.append(path)
+        for path in STUDENT_VIEW_JS:
+            if path in manifest:
+                frag.add_javascript_url(block.runtime.local_resource_url(block, manifest[path]))
+            else:
+                frag.add_javascript(block.resource_string(path))
+                inlined.append(path)
+        if use_urls and manifest and inlined:
+            log.warning(f"[StaticAssets] Not in the build manifest, inlined: {inlined}")
+
+
+def build(package_dir=None):
+    """
+    Build the content-hashed copies of the student view's assets.
+
+    Args:
+        package_dir (str): The pdfx package directory (default: this package).
+
+    Returns:
+        dict: The written manifest.
+    """
+    package_dir = package_dir or os.path.dirname(os.path.abspath(__file__))
+    build_dir = os.path.join(package_dir, BUILD_DIR)
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(build_dir)
+
+    manifest = {}
+    for path in STUDENT_VIEW_CSS + STUDENT_VIEW_JS:
+        with open(os.path.join(package_dir, path), 'rb') as source:
+            content = source.read()
+        name, extension = os.path.splitext(os.path.basename(path))
+        built_path = f'{BUILD_DIR}/{name}.{hashlib.sha256(content).hexdigest()[:12]}{extension}'
+        with open(os.path.join(package_dir, built_path), 'wb') as built:
+            built.write(content)
+        manifest[path] = built_path
+
+    with open(os.path.join(package_dir, MANIFEST_PATH), 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    return manifest
+
+
+def main(argv=None):
+    """Build the assets and print the manifest."""
+    argv = sys.argv[1:] if argv is None else argv
+    manifest = build(argv[0] if argv else None)
+    for path, built_path in manifest.items():
+        print(f"{path} -> {built_path}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
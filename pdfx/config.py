@@ -58,11 +58,20 @@ DEFAULT_SETTINGS = {
     'preload_pages': 2,  # Number of pages to preload
     'render_text_layer': True,
     'disable_animations_on_mobile': True,
+    'compact_strokes': True,  # Store stroke points with StrokeCodec
+    'stroke_precision': 20,  # Fixed-point steps per PDF unit for compact strokes
+    'stroke_simplify_tolerance': 0.5,  # In PDF units; 0 keeps every stroke point
+    'serve_static_urls': True,  # Reference hashed assets by URL (built on install, see pdfx/assets.py); inline otherwise
+    'serve_pdf_ranges': True,  # Serve uploaded PDFs through the range-capable serve_pdf handler
+    'index_pdf_text': True,  # Extract the text of uploaded PDFs into a search index for search_pdf
 
     # Advanced settings
     'pdf_worker_url': '',  # Default uses CDN
     'annotation_storage_limit': 10 * 1024 * 1024,  # 10MB
-    'debug_mode': False
+    'annotation_backend': 'fields',  # 'fields' (user_state) or 'sqlite' (one row per annotation, needed to browse; see pdfx/migrate.py)
+    'annotation_db_path': 'pdfx_annotations.sqlite3',  # Database file of the sqlite backend, relative to DATA_DIR unless absolute
+    'debug_mode': False,  # Log structured debug events (pdfx.instrumentation.DebugEvents)
+    'debug_sample_rate': 1.0  # Fraction of requests whose debug events are logged
 }
 
 # Tool definitions
@@ -150,7 +159,69 @@ KEYBOARD_SHORTCUTS = {
 # Other constants
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
 MAX_ANNOTATION_COUNT = 1000
+MAX_PAGES_PER_LOAD = 100  # Pages one 'load_pages' request may ask for
+COMPRESSION_THRESHOLD = 4 * 1024  # Serialized bytes above which annotation fields are stored compressed
+COMPRESSION_PAGE_THRESHOLD = 512  # Serialized bytes from which a page of a compressed field is compressed
+COMPRESSION_CACHE_SIZE = 1024  # Compressed pages kept per process, so unchanged pages are not compressed again
+IDEMPOTENCY_KEY_TIMEOUT = 10 * 60  # Seconds a save response is kept for replay
+IDEMPOTENCY_MAX_KEYS = 1000  # Responses kept by the in-memory idempotency store
+HEATMAP_RESOLUTION = 1000  # Steps down the page height in the class highlight heatmap
+EXPORT_CHUNK_SIZE = 64 * 1024  # Bytes of export output gathered per streamed chunk
+BROWSE_DEFAULT_LIMIT = 50  # Annotations per page of the staff browse handler
+BROWSE_MAX_LIMIT = 500  # Largest page a browse request may ask for
+PDF_STREAM_CHUNK_SIZE = 256 * 1024  # Bytes per chunk when serve_pdf streams an in-memory asset
+PDF_UPLOAD_CHUNK_SIZE = 1024 * 1024  # Bytes read per chunk from an uploaded PDF
+PDF_UPLOAD_SPOOL_SIZE = 8 * 1024 * 1024  # Uploads above this many bytes are spooled to a temporary file
+PDF_ASSET_HASH_LENGTH = 32  # Hex digits of the SHA-256 naming an uploaded PDF asset
+PDF_OUTLINE_MAX_ITEMS = 500  # Outline entries kept by the upload-time PDF analysis
+SEARCH_DEFAULT_LIMIT = 20  # Matching pages per search_pdf response
+SEARCH_MAX_LIMIT = 200  # Largest number of matching pages a search may ask for
+SEARCH_SNIPPET_CHARS = 80  # Characters of context on each side of a search match
+PDF_DERIVED_CACHE_SIZE = 8  # Search indexes and text layers kept in memory per process
+PDF_CACHE_MAX_AGE = 365 * 24 * 60 * 60  # Seconds browsers keep a served PDF; safe as asset names are derived from the content
 SUPPORTED_PDF_VERSIONS = [1.0, 1.1, 1.2, 1.3, 1.4, 1.5, 1.6, 1.7]
 DEFAULT_TOOLBAR_GROUPS = [
     'navigation', 'zoom', 'drawing', 'shape', 'text', 'utility', 'display'
-]
\ No newline at end of file
+]
+
+# Annotation types sent by the frontend tools, mapped to the XBlock
+# user_state fields that store them
+ANNOTATION_FIELD_MAPPING = {
+    'highlights': 'highlights',
+    'highlight': 'highlights',
+    'drawing_strokes': 'drawing_strokes',
+    'draw': 'drawing_strokes',
+    'scribble': 'marker_strokes',
+    'marker_strokes': 'marker_strokes',
+    'text_annotations': 'text_annotations',
+    'text': 'text_annotations',
+    'shape_annotations': 'shape_annotations',
+    'shape': 'shape_annotations',
+    'stamp': 'shape_annotations',  # stamps are stored as shape annotations
+}
+
+# Fields holding per-page annotation lists, in the order they are cleared
+ANNOTATION_FIELDS = (
+    'highlights', 'drawing_strokes', 'marker_strokes', 'text_annotations', 'shape_annotations'
+)
+
+# Fields holding scribble and drawing strokes, whose points can be stored compactly
+STROKE_FIELDS = ('drawing_strokes', 'marker_strokes')
+
+# Operations accepted by the 'apply_ops' save action
+ANNOTATION_OPERATIONS = ('add', 'update', 'delete', 'clear')
+
+# Student view assets, in load order; `python -m pdfx.assets` builds hashed copies
+STUDENT_VIEW_CSS = (
+    'static/css/pdfx.css',
+)
+STUDENT_VIEW_JS = (
+    'static/js/pdf-loader-es6.js',
+    'static/js/src/tools/highlight/HighlightTool.js',
+    'static/js/src/tools/scribble/ScribbleTool.js',
+    'static/js/src/tools/text/TextTool.js',
+    'static/js/src/tools/stamp/StampTool.js',
+    'static/js/src/tools/ManualSaveTool.js',
+    'static/js/pdfx-init.js',
+    'static/js/src/tools/base/ClearTool.js',
+)
@@ -0,0 +1,145 @@
+"""
+Instrumentation for the PDF XBlock.
+
+``Metrics`` keeps process-wide named counters and timers. They cost one
+clock read and one dict update, so they are always on. ``DebugEvents``
+logs structured events for a sample of requests when ``debug_mode`` is
+set. Its fields are passed as values or callables and only evaluated and
+formatted for sampled requests, so disabled debugging costs nothing beyond
+the call.
+"""
+
+import json
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+log = logging.getLogger(__name__)
+
+
+class Metrics:
+    """Process-wide counters and timers, keyed by dotted name (e.g. 'save.merge')."""
+
+    _lock = threading.Lock()
+    _counters = {}
+    _timers = {}  # name -> [count, total seconds, max seconds]
+
+    @classmethod
+    def incr(cls, name, amount=1):
+        """
+        Add to a counter.
+
+        Args:
+            name (str): The counter name.
+            amount (int): The amount to add.
+        """
+        with cls._lock:
+            cls._counters[name] = cls._counters.get(name, 0) + amount
+
+    @classmethod
+    def record(cls, name, seconds):
+        """
+        Record one timing.
+
+        Args:
+            name (str): The timer name.
+            seconds (float): The elapsed time.
+        """
+        with cls._lock:
+            stats = cls._timers.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    @classmethod
+    @contextmanager
+    def timer(cls, name):
+        """
+        Time the enclosed block, including when it raises.
+
+        Args:
+            name (str): The timer name.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls.record(name, time.perf_counter() - start)
+
+    @classmethod
+    def timed(cls, name):
+        """
+        Decorate a function so that every call is timed.
+
+        Args:
+            name (str): The timer name.
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with cls.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @classmethod
+    def snapshot(cls):
+        """
+        Get the current counters and timers.
+
+        Returns:
+            dict: {'counters': {name: count}, 'timers': {name: {count, totalMs, meanMs, maxMs}}}
+        """
+        with cls._lock:
+            counters = dict(cls._counters)
+            timers = {name: list(stats) for name, stats in cls._timers.items()}
+        return {
+            'counters': counters,
+            'timers': {
+                name: {
+                    'count': count,
+                    'totalMs': round(total * 1000, 3),
+                    'meanMs': round(total * 1000 / count, 3),
+                    'maxMs': round(longest * 1000, 3)
+                }
+                for name, (count, total, longest) in timers.items()
+            }
+        }
+
+    @classmethod
+    def reset(cls):
+        """Forget all counters and timers."""
+        with cls._lock:
+            cls._counters.clear()
+            cls._timers.clear()
+
+
+class DebugEvents:
+    """Structured debug events of one request, logged only if the request is sampled."""
+
+    def __init__(self, enabled=False, sample_rate=1.0):
+        """
+        Initialize the events of a request.
+
+        Args:
+            enabled (bool): Whether debug events are on (the debug_mode setting).
+            sample_rate (float): Fraction of requests whose events are logged.
+        """
+        self.sampled = bool(enabled) and random.random() < sample_rate
+
+    def emit(self, name, **fields):
+        """
+        Log an event if the request is sampled.
+
+        Args:
+            name (str): The event name, e.g. 'save.received'.
+            **fields: Event fields. Callables are called to get the value,
+                so costly fields are only computed for sampled requests.
+        """
+        if not self.sampled:
+            return
+        values = {key: value() if callable(value) else value for key, value in fields.items()}
+        log.info("pdfx.%s %s", name, json.dumps(values, default=str, sort_keys=True))
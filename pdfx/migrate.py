@@ -0,0 +1,129 @@
+"""
+Command line migration of a PDF XBlock's annotations to the sqlite backend.
+
+Setting annotation_backend to 'sqlite' takes effect for a block only once
+this command has moved every student's annotations out of the user state
+into the database. Until then the block keeps reading and writing its
+fields, so staff exports, browsing and heatmap rebuilds never leave out
+students who have not come back since the switch, and no request moves
+data as a side effect.
+
+The students are moved one at a time. The block is then marked migrated,
+which sends new saves to the database, and a second pass moves what was
+saved to the fields during the first one. An annotation that already has
+a row is never overwritten by its field copy.
+
+Run it inside an LMS environment (DJANGO_SETTINGS_MODULE set), with --db
+naming the database file the block uses (the annotation_db_path setting).
+
+Example:
+    pdfx-migrate-annotations block-v1:Org+Course+Run+type@pdfx+block@intro \\
+        --db /edx/var/edxapp/data/pdfx_annotations.sqlite3
+"""
+
+import argparse
+import logging
+import sys
+
+from .services import SqliteAnnotationBackend
+
+log = logging.getLogger(__name__)
+
+
+def build_parser():
+    """
+    Build the command line parser.
+
+    Returns:
+        argparse.ArgumentParser: The parser.
+    """
+    parser = argparse.ArgumentParser(
+        prog='pdfx-migrate-annotations',
+        description="Move every student's annotations of a PDF XBlock from user state to the sqlite backend."
+    )
+    parser.add_argument('usage_key', help="Usage key of the block")
+    parser.add_argument('--db', required=True, help="Database file of the sqlite annotation backend")
+    return parser
+
+
+def migrate_pass(path, usage_key, client, user_ids):
+    """
+    Move the field annotations of every student of a block into the database once.
+
+    Args:
+        path (str): The SQLite database file.
+        usage_key: The block usage key.
+        client: The LMS user state client (iter_all_for_block and set).
+        user_ids (callable): Maps a username to the user id the block stores rows under.
+
+    Returns:
+        tuple: (students changed, annotations moved)
+    """
+    students = moved = 0
+    for user_state in client.iter_all_for_block(usage_key):
+        backend = SqliteAnnotationBackend(path, usage_key.course_key, usage_key, user_ids(user_state.username))
+        try:
+            count, changed = backend.migrate_state(user_state.state)
+            backend.commit()
+        except (TypeError, ValueError) as e:
+            backend.rollback()
+            log.error(f"Not migrating {user_state.username}, whose state could not be read: {e}")
+            continue
+        if changed:
+            # Only after the rows are committed: the fields are the copy of record until then
+            client.set(user_state.username, usage_key, changed)
+            students += 1
+            moved += count
+    return students, moved
+
+
+def migrate_block(path, usage_key, client, user_ids):
+    """
+    Move a block to the database: a pass, the switch, and a pass for saves made meanwhile.
+
+    Args:
+        path (str): The SQLite database file.
+        usage_key: The block usage key.
+        client: The LMS user state client.
+        user_ids (callable): Maps a username to the user id the block stores rows under.
+
+    Returns:
+        tuple: (students changed, annotations moved)
+    """
+    students, moved = migrate_pass(path, usage_key, client, user_ids)
+    SqliteAnnotationBackend.mark_migrated(path, usage_key.course_key, usage_key)
+    late_students, late_moved = migrate_pass(path, usage_key, client, user_ids)
+    return students + late_students, moved + late_moved
+
+
+def lms_user_id(username):
+    """Get the LMS user id of a username."""
+    from django.contrib.auth import get_user_model
+    return get_user_model().objects.get(username=username).pk
+
+
+def main(argv=None):
+    """
+    Run the migration.
+
+    Args:
+        argv (list): The arguments, or None for sys.argv.
+
+    Returns:
+        int: The exit status.
+    """
+    args = build_parser().parse_args(argv)
+
+    import django
+    django.setup()
+    from lms.djangoapps.courseware.user_state_client import DjangoXBlockUserStateClient
+    from opaque_keys.edx.keys import UsageKey
+
+    usage_key = UsageKey.from_string(args.usage_key)
+    students, moved = migrate_block(args.db, usage_key, DjangoXBlockUserStateClient(), lms_user_id)
+    print(f"Moved {moved} annotations of {students} students; {usage_key} now uses {args.db}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,10 +5,22 @@ This module contains data models and structures for
 PDF annotations and user interactions.
 """
 
+import base64
+import hashlib
 import json
 import logging
+import math
+import threading
+import zlib
+from collections import OrderedDict
 from datetime import datetime
 
+from xblock.fields import Dict
+
+from .config import (
+    COMPRESSION_CACHE_SIZE, COMPRESSION_PAGE_THRESHOLD, COMPRESSION_THRESHOLD, HEATMAP_RESOLUTION
+)
+
 logger = logging.getLogger(__name__)
 
 class PDFDocument:
@@ -415,4 +427,825 @@ class ShapeAnnotation(Annotation):
         )
         annotation.id = data.get('id', annotation.id)
         annotation.timestamp = data.get('timestamp', annotation.timestamp)
-        return annotation
\ No newline at end of file
+        return annotation
+
+
+class AnnotationIndex:
+    """
+    Id index over the per-page annotation fields of one user.
+
+    The index maps every annotation id to ``[field_name, page_key, slot]``,
+    the position of the annotation inside ``field[page_key]``. It lets
+    upserts and deletes find an annotation without scanning page lists.
+    Deletes keep the order of the page, which is its drawing order: the
+    annotations after the deleted one move up a slot, so a delete costs
+    the length of the rest of that page, never of the whole field.
+    """
+
+    def __init__(self, entries, get_field):
+        """
+        Initialize the index.
+
+        Args:
+            entries (dict): The persisted index, mutated in place.
+            get_field (callable): Returns the page dict stored in a field name.
+                Fields are only fetched when an operation needs them.
+        """
+        self.entries = entries
+        self.get_field = get_field
+
+    def rebuild(self, field_names):
+        """
+        Rebuild the index from the stored fields.
+
+        Args:
+            field_names (iterable): The annotation fields to index.
+        """
+        self.entries.clear()
+        for field_name in field_names:
+            for page_key, page_annotations in self.get_field(field_name).items():
+                if not isinstance(page_annotations, list):
+                    continue
+                for slot, annotation in enumerate(page_annotations):
+                    if isinstance(annotation, dict) and annotation.get('id'):
+                        self.entries[annotation['id']] = [field_name, page_key, slot]
+
+    def locate(self, annotation_id):
+        """
+        Find where an annotation is stored.
+
+        Args:
+            annotation_id (str): The annotation ID.
+
+        Returns:
+            tuple: (field_name, page_key, slot), or None if the id is unknown
+            or the entry no longer matches the stored data.
+        """
+        entry = self.entries.get(annotation_id)
+        if not entry:
+            return None
+
+        field_name, page_key, slot = entry
+        page_annotations = self.get_field(field_name).get(page_key)
+        if (isinstance(page_annotations, list) and slot < len(page_annotations)
+                and isinstance(page_annotations[slot], dict)
+                and page_annotations[slot].get('id') == annotation_id):
+            return field_name, page_key, slot
+
+        # Stale entry (the field was rewritten outside the index)
+        del self.entries[annotation_id]
+        return None
+
+    def upsert(self, field_name, page_key, annotation):
+        """
+        Insert an annotation, or replace the stored one with the same id.
+
+        An annotation that moved to another page or field is removed from
+        its previous location first.
+
+        Args:
+            field_name (str): The field to store the annotation in.
+            page_key (str): The page the annotation belongs to.
+            annotation (dict): The annotation, with an 'id' key.
+
+        Returns:
+            bool: True if an existing annotation was replaced.
+        """
+        annotation_id = annotation['id']
+        location = self.locate(annotation_id)
+        if location and location[:2] == (field_name, page_key):
+            self.get_field(field_name)[page_key][location[2]] = annotation
+            return True
+
+        if location:
+            self.remove(annotation_id)
+
+        page_annotations = self.get_field(field_name).setdefault(page_key, [])
+        page_annotations.append(annotation)
+        self.entries[annotation_id] = [field_name, page_key, len(page_annotations) - 1]
+        return location is not None
+
+    def remove(self, annotation_id):
+        """
+        Remove an annotation.
+
+        Args:
+            annotation_id (str): The annotation ID.
+
+        Returns:
+            dict: The removed annotation, or None if it was not found.
+        """
+        location = self.locate(annotation_id)
+        if not location:
+            return None
+
+        field_name, page_key, slot = location
+        field_data = self.get_field(field_name)
+        page_annotations = field_data[page_key]
+        removed = page_annotations.pop(slot)
+
+        for moved in page_annotations[slot:]:
+            moved_entry = self.entries.get(moved.get('id')) if isinstance(moved, dict) else None
+            if moved_entry:
+                moved_entry[2] -= 1
+        if not page_annotations:
+            del field_data[page_key]
+
+        del self.entries[annotation_id]
+        return removed
+
+    def drop_page(self, page_key, field_names):
+        """
+        Forget every entry of a page, after the page has been cleared.
+
+        Args:
+            page_key (str): The cleared page.
+            field_names (iterable): The fields the page was cleared from.
+        """
+        field_names = set(field_names)
+        stale = [
+            annotation_id for annotation_id, (field_name, entry_page, _) in self.entries.items()
+            if entry_page == page_key and field_name in field_names
+        ]
+        for annotation_id in stale:
+            del self.entries[annotation_id]
+
+    def drop_field(self, field_name):
+        """
+        Forget every entry of a field, after the field has been cleared.
+
+        Args:
+            field_name (str): The cleared field.
+        """
+        stale = [
+            annotation_id for annotation_id, entry in self.entries.items()
+            if entry[0] == field_name
+        ]
+        for annotation_id in stale:
+            del self.entries[annotation_id]
+
+
+class AnnotationLimitError(Exception):
+    """Raised when a save would take a user past an annotation limit."""
+
+    def __init__(self, limit, maximum, usage):
+        """
+        Initialize the error.
+
+        Args:
+            limit (str): The exceeded limit, 'count' or 'bytes'.
+            maximum (int): The value of the limit.
+            usage (dict): The usage before the refused change.
+        """
+        super().__init__(f"Annotation {limit} limit of {maximum} exceeded")
+        self.limit = limit
+        self.maximum = maximum
+        self.usage = usage
+
+    def to_dict(self):
+        """
+        Convert the error to a dictionary for JSON responses.
+
+        Returns:
+            dict: The structured error.
+        """
+        return {
+            'code': 'annotation_limit_exceeded',
+            'limit': self.limit,
+            'maximum': self.maximum,
+            'usage': self.usage,
+            'message': str(self),
+        }
+
+
+class AnnotationUsage:
+    """
+    Running totals of the annotations stored for one user.
+
+    The totals are kept in ``{'count': ..., 'bytes': ...}``, where bytes is
+    the size of the compact JSON of each stored annotation. Callers update
+    them with the delta of every change instead of re-measuring the state.
+    """
+
+    def __init__(self, totals, max_count, max_bytes):
+        """
+        Initialize the usage.
+
+        Args:
+            totals (dict): The persisted totals, mutated in place.
+            max_count (int): The maximum number of annotations.
+            max_bytes (int): The maximum size of the annotations, in bytes.
+        """
+        self.totals = totals
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def measure(annotation):
+        """
+        Measure the stored size of an annotation.
+
+        Args:
+            annotation (dict): The stored annotation.
+
+        Returns:
+            int: The size of its compact JSON, in bytes.
+        """
+        return len(json.dumps(annotation, separators=(',', ':')).encode('utf-8'))
+
+    @classmethod
+    def measure_page(cls, page_annotations):
+        """
+        Measure the annotations of one page.
+
+        Args:
+            page_annotations (list): The stored annotations of the page.
+
+        Returns:
+            tuple: (count, bytes)
+        """
+        if not isinstance(page_annotations, list):
+            return 0, 0
+        return len(page_annotations), sum(cls.measure(annotation) for annotation in page_annotations)
+
+    def rebuild(self, fields):
+        """
+        Measure the whole state, for data saved before usage was tracked.
+
+        Args:
+            fields (iterable): The per-page annotation dicts of every field.
+        """
+        count = size = 0
+        for pages in fields:
+            for page_annotations in pages.values():
+                page_count, page_size = self.measure_page(page_annotations)
+                count += page_count
+                size += page_size
+        self.totals['count'] = count
+        self.totals['bytes'] = size
+
+    def check(self, count_delta, bytes_delta):
+        """
+        Check that a change keeps the usage within the limits.
+
+        Changes that do not grow a total are always allowed.
+
+        Args:
+            count_delta (int): The change in the number of annotations.
+            bytes_delta (int): The change in size, in bytes.
+
+        Raises:
+            AnnotationLimitError: If the change would exceed a limit.
+        """
+        if count_delta > 0 and self.totals.get('count', 0) + count_delta > self.max_count:
+            raise AnnotationLimitError('count', self.max_count, self.to_dict())
+        if bytes_delta > 0 and self.totals.get('bytes', 0) + bytes_delta > self.max_bytes:
+            raise AnnotationLimitError('bytes', self.max_bytes, self.to_dict())
+
+    def apply(self, count_delta, bytes_delta):
+        """
+        Add a change to the totals.
+
+        Args:
+            count_delta (int): The change in the number of annotations.
+            bytes_delta (int): The change in size, in bytes.
+        """
+        self.totals['count'] = max(0, self.totals.get('count', 0) + count_delta)
+        self.totals['bytes'] = max(0, self.totals.get('bytes', 0) + bytes_delta)
+
+    def to_dict(self):
+        """
+        Convert the usage to a dictionary for JSON responses.
+
+        Returns:
+            dict: The totals and limits.
+        """
+        return {
+            'count': self.totals.get('count', 0),
+            'bytes': self.totals.get('bytes', 0),
+            'maxCount': self.max_count,
+            'maxBytes': self.max_bytes,
+        }
+
+
+class HighlightHeatmap:
+    """
+    Class-wide highlight counts by page region.
+
+    Each page maps to disjoint ``[start, end, count]`` segments sorted by
+    start, measured down the page height in HEATMAP_RESOLUTION steps. A
+    highlight adds one to every step covered by its merged rectangles, so
+    the segments of a page stay few however many students highlight it,
+    and rendering the heatmap costs O(pages).
+
+    The block keeps the segments in a user_state_summary field, which each
+    save reads, changes and writes back. That is not atomic: when students
+    save at the same moment the last write wins and the others' counts are
+    lost, and highlights saved before the heatmap existed are not counted.
+    The heatmap is an approximation between rebuilds from the stored
+    highlights (see ``rebuild``).
+    """
+
+    def __init__(self, pages):
+        """
+        Initialize the heatmap.
+
+        Args:
+            pages (dict): The persisted segments by page key, mutated in place.
+        """
+        self.pages = pages
+
+    @staticmethod
+    def merge_intervals(intervals):
+        """
+        Merge overlapping or touching intervals.
+
+        Args:
+            intervals (iterable): (start, end) pairs.
+
+        Returns:
+            list: Disjoint [start, end] pairs sorted by start.
+        """
+        merged = []
+        for start, end in sorted(intervals):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return merged
+
+    @classmethod
+    def highlight_intervals(cls, annotation):
+        """
+        Get the vertical page regions covered by a highlight.
+
+        Only the page-relative percentageRects can be placed; highlights
+        saved with pixel rects alone cover no region.
+
+        Args:
+            annotation (dict): The stored highlight.
+
+        Returns:
+            list: Disjoint [start, end] pairs in HEATMAP_RESOLUTION steps.
+        """
+        data = annotation.get('data') if isinstance(annotation, dict) else None
+        rects = data.get('percentageRects') if isinstance(data, dict) else None
+
+        intervals = []
+        for rect in rects if isinstance(rects, list) else []:
+            try:
+                top = float(rect['topPercent'])
+                bottom = top + float(rect['heightPercent'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            start = min(HEATMAP_RESOLUTION, max(0, int(top * HEATMAP_RESOLUTION / 100)))
+            end = min(HEATMAP_RESOLUTION, max(0, math.ceil(bottom * HEATMAP_RESOLUTION / 100)))
+            if end > start:
+                intervals.append((start, end))
+        return cls.merge_intervals(intervals)
+
+    @staticmethod
+    def add_interval(segments, start, end, delta):
+        """
+        Add a count to an interval of a page.
+
+        Args:
+            segments (list): The page's [start, end, count] segments.
+            start (int): The first step of the interval.
+            end (int): The step after the interval.
+            delta (int): The count to add, negative to remove.
+
+        Returns:
+            list: The new segments, with empty steps dropped and equal
+            neighbours coalesced.
+        """
+        bounds = sorted({bound for segment in segments for bound in segment[:2]} | {start, end})
+        result = []
+        position = 0
+        for low, high in zip(bounds, bounds[1:]):
+            while position < len(segments) and segments[position][1] <= low:
+                position += 1
+            covered = position < len(segments) and segments[position][0] <= low
+            count = segments[position][2] if covered else 0
+            if start <= low and high <= end:
+                count += delta
+            if count <= 0:
+                continue
+            if result and result[-1][1] == low and result[-1][2] == count:
+                result[-1][1] = high
+            else:
+                result.append([low, high, count])
+        return result
+
+    def add(self, page_key, annotation, delta=1):
+        """
+        Count a highlight in, or out of, its page.
+
+        Args:
+            page_key (str): The page of the highlight.
+            annotation (dict): The stored highlight.
+            delta (int): 1 to count the highlight, -1 to remove it.
+        """
+        intervals = self.highlight_intervals(annotation)
+        if not intervals:
+            return
+
+        page_key = str(page_key)
+        segments = self.pages.get(page_key, [])
+        for start, end in intervals:
+            segments = self.add_interval(segments, start, end, delta)
+        if segments:
+            self.pages[page_key] = segments
+        else:
+            self.pages.pop(page_key, None)
+
+    def rebuild(self, rows):
+        """
+        Recount the heatmap from every stored highlight.
+
+        Args:
+            rows (iterable): (user, field_name, page_key, annotation) tuples,
+                as yielded by ``AnnotationBackend.iter_block``.
+
+        Returns:
+            int: The number of highlights counted.
+        """
+        self.pages.clear()
+        counted = 0
+        for _user, field_name, page_key, annotation in rows:
+            if field_name == 'highlights' and isinstance(annotation, dict):
+                self.add(page_key, annotation)
+                counted += 1
+        return counted
+
+
+class StrokeCodec:
+    """
+    Compact encoding for the points of scribble and drawing strokes.
+
+    Stroke points are stored by the frontend as ``{x, y, color, thickness,
+    opacity}`` dicts in container pixels at ``strokeData.originalScale``.
+    The codec divides coordinates by that scale, quantizes them to
+    ``precision`` steps per PDF unit, delta-encodes consecutive points and
+    packs the zigzagged deltas as varints, stored base64'd in
+    ``strokeData.encodedPoints`` together with the stroke style.
+
+    Only strokes whose points share a single style are encoded; others are
+    kept as they are. ``pathData`` is dropped from encoded strokes because
+    the viewer rebuilds it from the points.
+    """
+
+    VERSION = 1
+    STYLE_KEYS = ('color', 'thickness', 'opacity')
+
+    @staticmethod
+    def pack_varints(values):
+        """
+        Pack signed integers as zigzag varints.
+
+        Args:
+            values (iterable): The integers to pack
+
+        Returns:
+            bytes: The packed integers
+        """
+        packed = bytearray()
+        for value in values:
+            value = value * 2 if value >= 0 else -value * 2 - 1
+            while value > 0x7F:
+                packed.append((value & 0x7F) | 0x80)
+                value >>= 7
+            packed.append(value)
+        return bytes(packed)
+
+    @staticmethod
+    def unpack_varints(packed):
+        """
+        Unpack zigzag varints packed by ``pack_varints``.
+
+        Args:
+            packed (bytes): The packed integers
+
+        Returns:
+            list: The integers
+        """
+        values = []
+        value = shift = 0
+        for byte in packed:
+            value |= (byte & 0x7F) << shift
+            if byte & 0x80:
+                shift += 7
+                continue
+            values.append((value >> 1) ^ -(value & 1))
+            value = shift = 0
+        return values
+
+    @classmethod
+    def encode_points(cls, points, scale=1, precision=20):
+        """
+        Encode a stroke's points.
+
+        Args:
+            points (list): Point dicts with 'x', 'y' and the stroke style
+            scale (float): The viewer scale the points were captured at
+            precision (int): Fixed-point steps per PDF unit
+
+        Returns:
+            dict: The encoded points, or None if the points cannot be encoded
+        """
+        if not points or not all(isinstance(point, dict) for point in points):
+            return None
+
+        style = {key: points[0][key] for key in cls.STYLE_KEYS if key in points[0]}
+        allowed_keys = {'x', 'y'} | set(style)
+        deltas = []
+        last_x = last_y = 0
+        factor = precision / scale
+        for point in points:
+            if point.keys() != allowed_keys or any(point[key] != value for key, value in style.items()):
+                return None
+            try:
+                x = round(float(point['x']) * factor)
+                y = round(float(point['y']) * factor)
+            except (TypeError, ValueError, OverflowError):
+                return None
+            deltas.extend((x - last_x, y - last_y))
+            last_x, last_y = x, y
+
+        return {
+            'version': cls.VERSION,
+            'precision': precision,
+            'scale': scale,
+            'count': len(points),
+            'style': style,
+            'data': base64.b64encode(cls.pack_varints(deltas)).decode('ascii'),
+        }
+
+    @classmethod
+    def decode_points(cls, encoded):
+        """
+        Decode points encoded by ``encode_points``.
+
+        Args:
+            encoded (dict): The encoded points
+
+        Returns:
+            list: Point dicts with 'x', 'y' and the stroke style
+        """
+        deltas = cls.unpack_varints(base64.b64decode(encoded['data']))
+        factor = encoded['scale'] / encoded['precision']
+        style = encoded.get('style', {})
+
+        points = []
+        x = y = 0
+        for i in range(0, len(deltas) - 1, 2):
+            x += deltas[i]
+            y += deltas[i + 1]
+            point = {'x': round(x * factor, 3), 'y': round(y * factor, 3)}
+            point.update(style)
+            points.append(point)
+        return points
+
+    @classmethod
+    def encode_annotation(cls, annotation, precision=20):
+        """
+        Encode the stroke points of a stroke annotation.
+
+        Args:
+            annotation (dict): The stored annotation
+            precision (int): Fixed-point steps per PDF unit
+
+        Returns:
+            dict: A copy of the annotation with encoded points, or the
+            annotation itself if it has nothing to encode
+        """
+        data = annotation.get('data')
+        stroke_data = data.get('strokeData') if isinstance(data, dict) else None
+        if not isinstance(stroke_data, dict) or not isinstance(stroke_data.get('points'), list):
+            return annotation
+
+        scale = stroke_data.get('originalScale') or 1
+        if not isinstance(scale, (int, float)) or scale <= 0:
+            scale = 1
+        encoded = cls.encode_points(stroke_data['points'], scale, precision)
+        if encoded is None:
+            return annotation
+
+        stroke_data = {key: value for key, value in stroke_data.items() if key not in ('points', 'pathData')}
+        stroke_data['encodedPoints'] = encoded
+        return dict(annotation, data=dict(data, strokeData=stroke_data))
+
+    @classmethod
+    def decode_annotation(cls, annotation):
+        """
+        Decode the stroke points of a stroke annotation.
+
+        Args:
+            annotation (dict): The stored annotation
+
+        Returns:
+            dict: A copy of the annotation with plain points, or the
+            annotation itself if it is not encoded
+        """
+        data = annotation.get('data') if isinstance(annotation, dict) else None
+        stroke_data = data.get('strokeData') if isinstance(data, dict) else None
+        if not isinstance(stroke_data, dict) or 'encodedPoints' not in stroke_data:
+            return annotation
+
+        stroke_data = dict(stroke_data)
+        try:
+            stroke_data['points'] = cls.decode_points(stroke_data.pop('encodedPoints'))
+        except (KeyError, TypeError, ValueError, ZeroDivisionError) as e:
+            logger.warning(f"Could not decode stroke points of annotation {annotation.get('id')}: {e}")
+            return annotation
+        return dict(annotation, data=dict(data, strokeData=stroke_data))
+
+    @classmethod
+    def decode_strokes(cls, strokes_by_page):
+        """
+        Decode every stroke of a per-page stroke field.
+
+        Args:
+            strokes_by_page (dict): Stroke annotations keyed by page number
+
+        Returns:
+            dict: A new dict of pages with plain points; the input is not modified
+        """
+        return {
+            page: [cls.decode_annotation(stroke) for stroke in page_strokes]
+            if isinstance(page_strokes, list) else page_strokes
+            for page, page_strokes in strokes_by_page.items()
+        }
+
+
+class PreservedDict(dict):
+    """
+    Value of a CompressedDict field whose stored form could not be read.
+
+    It starts empty and takes new annotations like any field value, while
+    ``raw`` keeps the stored form as it was. CompressedDict writes both
+    back, so a corrupt or unknown envelope is never overwritten.
+    """
+
+    def __init__(self, pages=(), raw=None):
+        """
+        Initialize the value.
+
+        Args:
+            pages (dict): The readable pages.
+            raw: The stored form that could not be read.
+        """
+        super().__init__(pages)
+        self.raw = raw
+
+
+class CompressedDict(Dict):
+    """
+    Dict field stored compressed page by page once its JSON gets large.
+
+    Values whose compact JSON is at least ``threshold`` bytes are written
+    as ``{FORMAT_KEY: FORMAT, 'pages': {page_key: page}}``, where each page
+    of at least ``page_threshold`` bytes is the base64 of its zlib-compressed
+    JSON and smaller pages are kept as they are. A save usually changes one
+    page, and the compressed form of the others is taken from a process-wide
+    cache keyed by a digest of their JSON, so a save compresses what changed
+    rather than the whole field. Smaller values, and values stored before
+    compression existed, are kept as plain dicts; whole-field envelopes of
+    the first format are still read. The envelope is only decompressed when
+    the field is first read, after which XBlock serves it from the field cache.
+
+    A stored value that cannot be read (a corrupt envelope, or one of an
+    unknown format) is read as a PreservedDict and written back as
+    ``{PRESERVED_KEY: stored value, 'value': new pages}``, never replaced.
+    """
+
+    FORMAT_KEY = '__pdfx_format__'
+    FORMAT = 'zlib+base64/2'
+    FIELD_FORMAT = 'zlib+base64/1'  # One envelope for the whole field, read only
+    PRESERVED_KEY = '__pdfx_unreadable__'
+
+    _lock = threading.Lock()
+    _page_cache = OrderedDict()  # digest of page JSON -> compressed page
+
+    def __init__(self, threshold=COMPRESSION_THRESHOLD, page_threshold=COMPRESSION_PAGE_THRESHOLD, **kwargs):
+        """
+        Initialize the field.
+
+        Args:
+            threshold (int): Serialized size in bytes from which values are compressed
+            page_threshold (int): Serialized size in bytes from which a page is compressed
+            **kwargs: Passed to the Dict field
+        """
+        super().__init__(**kwargs)
+        self.threshold = threshold
+        self.page_threshold = page_threshold
+
+    @classmethod
+    def is_compressed(cls, value):
+        """
+        Check whether a stored value is a compressed envelope.
+
+        Args:
+            value: The stored value
+
+        Returns:
+            bool: True if the value is an envelope written by this field
+        """
+        return isinstance(value, dict) and value.get(cls.FORMAT_KEY) in (cls.FORMAT, cls.FIELD_FORMAT)
+
+    @staticmethod
+    def decompress(data):
+        """
+        Decode one compressed JSON value.
+
+        Args:
+            data (str): Base64 of the zlib-compressed JSON
+
+        Returns:
+            The decoded value
+        """
+        return json.loads(zlib.decompress(base64.b64decode(data)).decode('utf-8'))
+
+    @classmethod
+    def compress_page(cls, serialized):
+        """
+        Compress the JSON of one page, reusing an earlier compression of the same JSON.
+
+        Args:
+            serialized (bytes): The compact JSON of the page
+
+        Returns:
+            str: Base64 of the zlib-compressed JSON
+        """
+        digest = hashlib.blake2b(serialized, digest_size=16).digest()
+        with cls._lock:
+            compressed = cls._page_cache.get(digest)
+            if compressed is not None:
+                cls._page_cache.move_to_end(digest)
+                return compressed
+
+        compressed = base64.b64encode(zlib.compress(serialized)).decode('ascii')
+        with cls._lock:
+            cls._page_cache[digest] = compressed
+            while len(cls._page_cache) > COMPRESSION_CACHE_SIZE:
+                cls._page_cache.popitem(last=False)
+        return compressed
+
+    def from_json(self, value):
+        """
+        Decompress an envelope, or return a plain stored dict unchanged.
+
+        Args:
+            value: The stored value
+
+        Returns:
+            dict: The field value, a PreservedDict if the stored value cannot be read
+        """
+        if isinstance(value, dict) and self.PRESERVED_KEY in value:
+            return PreservedDict(self.from_json(value.get('value')) or {}, value[self.PRESERVED_KEY])
+        if isinstance(value, dict) and self.FORMAT_KEY in value:
+            if not self.is_compressed(value):
+                logger.error(f"Unknown format of field {self.name}, kept as stored: {value[self.FORMAT_KEY]!r}")
+                return PreservedDict(raw=value)
+            try:
+                if value[self.FORMAT_KEY] == self.FIELD_FORMAT:
+                    value = self.decompress(value['data'])
+                else:
+                    value = {
+                        page_key: self.decompress(page) if isinstance(page, str) else page
+                        for page_key, page in value['pages'].items()
+                    }
+            except (AttributeError, KeyError, TypeError, ValueError, zlib.error) as e:
+                logger.error(f"Could not decompress field {self.name}, kept as stored: {e}")
+                return PreservedDict(raw=value)
+        return super().from_json(value)
+
+    def to_json(self, value):
+        """
+        Compress the large pages of the value if its JSON reaches the threshold.
+
+        Args:
+            value (dict): The field value
+
+        Returns:
+            dict: The value to store
+        """
+        if isinstance(value, PreservedDict):
+            return {self.PRESERVED_KEY: value.raw, 'value': self.to_json(dict(value))}
+        value = super().to_json(value)
+        if not isinstance(value, dict) or not value:
+            return value
+
+        serialized = {
+            page_key: json.dumps(page, separators=(',', ':')).encode('utf-8')
+            for page_key, page in value.items()
+        }
+        if sum(len(page) for page in serialized.values()) < self.threshold:
+            return value
+        return {
+            self.FORMAT_KEY: self.FORMAT,
+            'pages': {
+                page_key: self.compress_page(page) if len(page) >= self.page_threshold else value[page_key]
+                for page_key, page in serialized.items()
+            },
+        }
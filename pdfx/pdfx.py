@@ -1,19 +1,34 @@
 """PDF Viewer XBlock - ES6 Implementation"""
 
+import hashlib
 import json
 import logging
-import uuid
+import os
 import time
 from importlib.resources import files
 from web_fragments.fragment import Fragment
 from xblock.core import XBlock
 from xblock.fields import Scope, String, Dict, Boolean, Integer
 
+from .config import (
+    ANNOTATION_FIELD_MAPPING, ANNOTATION_FIELDS, ANNOTATION_OPERATIONS, BROWSE_DEFAULT_LIMIT, BROWSE_MAX_LIMIT,
+    DEFAULT_SETTINGS, HEATMAP_RESOLUTION, MAX_ANNOTATION_COUNT, MAX_PAGES_PER_LOAD, PDF_ASSET_HASH_LENGTH, PDF_CACHE_MAX_AGE,
+    SEARCH_DEFAULT_LIMIT, SEARCH_MAX_LIMIT, STROKE_FIELDS
+)
+from .instrumentation import Metrics
+from .models import AnnotationLimitError, AnnotationUsage, CompressedDict, HighlightHeatmap, StrokeCodec
+from .services import (
+    AnnotationCursor, AnnotationExporter, AssetStream, DerivedAsset, FieldAnnotationBackend, IdempotencyStore,
+    PdfAnalyzer, PdfTextIndex, PdfTextLayer, PdfUpload, PdfUploadError, RequestContext, SqliteAnnotationBackend,
+    StrokeSimplifier, TemplateCache
+)
+
 log = logging.getLogger(__name__)
 
 
 @XBlock.needs("user")
 @XBlock.needs("i18n")
+@XBlock.wants("settings")
 class PdfxXBlock(XBlock):
     """
     ES6 implementation of the PDF XBlock using the new ES6 modules architecture.
@@ -21,6 +36,8 @@ class PdfxXBlock(XBlock):
     drawing shapes, and clearing annotations.
     """
 
+    _unmigrated_warned = set()  # Blocks set to sqlite but not migrated yet, warned about once per process
+
     # XBlock fields
     display_name = String(
         display_name="Display Name",
@@ -65,47 +82,83 @@ class PdfxXBlock(XBlock):
     )
 
     # Store student's drawing strokes
-    drawing_strokes = Dict(
+    drawing_strokes = CompressedDict(
         help="Student's drawing strokes on the PDF",
         scope=Scope.user_state,
         default={}
     )
 
     # Store student's highlights
-    highlights = Dict(
+    highlights = CompressedDict(
         help="Student's highlights on the PDF",
         scope=Scope.user_state,
         default={}
     )
 
     # Store marker strokes
-    marker_strokes = Dict(
+    marker_strokes = CompressedDict(
         help="Marker strokes data",
         scope=Scope.user_state,
         default={}
     )
 
     # Store text annotations
-    text_annotations = Dict(
+    text_annotations = CompressedDict(
         help="Text annotations data",
         scope=Scope.user_state,
         default={}
     )
 
     # Store shape annotations
-    shape_annotations = Dict(
+    shape_annotations = CompressedDict(
         help="Shape annotations data",
         scope=Scope.user_state,
         default={}
     )
 
     # Store note annotations
-    note_annotations = Dict(
+    note_annotations = CompressedDict(
         help="Note annotations data",
         scope=Scope.user_state,
         default={}
     )
 
+    # Id index over the annotation fields: annotation id -> [field, page, slot]
+    annotation_index = CompressedDict(
+        help="Index locating each annotation by id",
+        scope=Scope.user_state,
+        default={}
+    )
+
+    # Per-user revision of the annotation state, advanced by every save
+    annotation_revision = Integer(
+        help="Revision of the user's annotations, exposed as the load ETag",
+        scope=Scope.user_state,
+        default=0
+    )
+
+    # Revision of the last change to each page, for detecting concurrent saves
+    page_revisions = Dict(
+        help="Annotation revision of the last change to each page",
+        scope=Scope.user_state,
+        default={}
+    )
+
+    # Running totals of the user's stored annotations: {'count': ..., 'bytes': ...}
+    annotation_usage = Dict(
+        help="Number and size of the user's stored annotations",
+        scope=Scope.user_state,
+        default={}
+    )
+
+    # Class-wide highlight counts by page region, updated by every save. Concurrent saves
+    # can overwrite each other's counts; staff rebuild it with the rebuild_heatmap handler
+    highlight_heatmap = Dict(
+        help="Highlight heatmap segments of all students, by page",
+        scope=Scope.user_state_summary,
+        default={}
+    )
+
     # Store staff highlights (visible to all students)
     staff_highlights = Dict(
         help="Staff highlights visible to all students",
@@ -155,98 +208,90 @@ class PdfxXBlock(XBlock):
         default=""
     )
 
+    # Page count, page sizes, metadata and outline of the uploaded PDF, read once at upload
+    pdf_analysis = Dict(
+        help="Upload-time analysis of the uploaded PDF file",
+        scope=Scope.settings,
+        default={}
+    )
+
+    # Asset key of the text search index of the uploaded PDF, built at upload
+    pdf_search_index = String(
+        help="Asset key of the search index of the uploaded PDF file",
+        scope=Scope.settings,
+        default=""
+    )
+
+    # Asset key of the positioned text runs of the uploaded PDF, used as the viewer's text layer
+    pdf_text_layer = String(
+        help="Asset key of the text layer of the uploaded PDF file",
+        scope=Scope.settings,
+        default=""
+    )
+
     # Non-editable metadata fields - fields that Studio should not show in editor
     non_editable_metadata_fields = (
         'annotations', 'drawing_strokes', 'highlights', 'marker_strokes',
         'text_annotations', 'shape_annotations', 'note_annotations',
+        'annotation_index', 'annotation_revision', 'page_revisions', 'annotation_usage',
+        'highlight_heatmap',
         'staff_highlights', 'current_page', 'brightness', 'is_grayscale',
-        'block_id'
+        'block_id', 'pdf_analysis', 'pdf_search_index', 'pdf_text_layer'
     )
 
     def resource_string(self, path):
         """Handy helper for getting resources from our kit."""
         return files(__package__).joinpath(path).read_text(encoding="utf-8")
 
-    def get_user_info(self):
-        """Get current user information using proper Open edX user service"""
+    def _get_setting(self, name):
+        """Get a setting from XBLOCK_SETTINGS['PdfxXBlock'], falling back to DEFAULT_SETTINGS"""
         try:
-            # Use the user service to get current user
-            user_service = self.runtime.service(self, 'user')
-            if user_service:
-                current_user = user_service.get_current_user()
-                if current_user and hasattr(current_user, 'opt_attrs'):
-                    # Extract user information from user service
-                    user_id = current_user.opt_attrs.get('edx-platform.user_id')
-                    username = current_user.opt_attrs.get('edx-platform.username', '')
-                    is_authenticated = current_user.opt_attrs.get('edx-platform.is_authenticated', False)
-
-                    if user_id and is_authenticated:
-                        log.info(f"[PdfxXBlock] get_user_info - Found authenticated user: {username} (ID: {user_id})")
-                        # Try to get email from user service or Django user
-                        email = ''
-                        try:
-                            # Try to get the real Django user object for email
-                            if hasattr(user_service, 'get_user_by_anonymous_id'):
-                                anonymous_id = current_user.opt_attrs.get('edx-platform.anonymous_user_id')
-                                if anonymous_id:
-                                    django_user = user_service.get_user_by_anonymous_id(anonymous_id)
-                                    if django_user and hasattr(django_user, 'email'):
-                                        email = django_user.email
-                        except Exception as e:
-                            log.warning(f"[PdfxXBlock] get_user_info - Could not get email: {e}")
-
-                        return {
-                            'id': str(user_id),
-                            'username': username,
-                            'email': email
-                        }
-                    else:
-                        log.info(f"[PdfxXBlock] get_user_info - User not authenticated or no user ID")
-
-            # Fallback: try to get user from runtime directly
-            if hasattr(self.runtime, 'user') and self.runtime.user:
-                user = self.runtime.user
-                if hasattr(user, 'id') and user.id and user.is_authenticated:
-                    log.info(f"[PdfxXBlock] get_user_info - Found user from runtime: {getattr(user, 'username', '')} (ID: {user.id})")
-                    return {
-                        'id': str(user.id),
-                        'username': getattr(user, 'username', ''),
-                        'email': getattr(user, 'email', '')
-                    }
-
+            settings_service = self.runtime.service(self, 'settings')
+            if settings_service:
+                platform_settings = settings_service.get_settings_bucket(self, default={})
+                if name in platform_settings:
+                    return platform_settings[name]
         except Exception as e:
-            log.error(f"[PdfxXBlock] get_user_info - Error getting user info: {e}")
+            log.warning(f"[PdfxXBlock] Error reading setting '{name}' from settings service: {e}")
+        return DEFAULT_SETTINGS.get(name)
 
-        log.warning(f"[PdfxXBlock] get_user_info - Falling back to anonymous user")
+    def _begin_request(self, request=None):
+        """Start the request context of a view or handler: user, staff role and course are resolved once"""
+        self._request_context = RequestContext(self, request)
+        return self._request_context
+
+    def _get_request_context(self):
+        """Get the context of the current request, starting one if none was begun"""
+        return getattr(self, '_request_context', None) or self._begin_request()
+
+    def _debug_event(self, name, **fields):
+        """Log a structured debug event if debug_mode is on and this request is sampled"""
+        self._get_request_context().events.emit(name, **fields)
+
+    def get_user_info(self):
+        """Get current user information using proper Open edX user service"""
+        context = self._get_request_context()
         return {
-            'id': 'anonymous',
-            'username': '',
-            'email': ''
+            'id': context.user_id,
+            'username': context.username,
+            'email': context.email
         }
 
     def get_course_info(self):
         """Get current course information"""
-        try:
-            course_id = getattr(self.runtime, 'course_id', None)
-            if course_id:
-                return {'id': str(course_id)}
-        except:
-            pass
-
-        return {'id': ''}
+        return {'id': self._get_request_context().course_id}
 
     def get_pdf_url(self):
         """Get the PDF URL, handling both direct URLs and file uploads"""
-        log.info(f"[PdfxXBlock] get_pdf_url - START")
-        log.info(f"[PdfxXBlock] get_pdf_url - pdf_file_asset_key: '{getattr(self, 'pdf_file_asset_key', 'N/A')}'")
-        log.info(f"[PdfxXBlock] get_pdf_url - pdf_url field: '{self.pdf_url}'")
-        log.info(f"[PdfxXBlock] get_pdf_url - pdf_file_path: '{getattr(self, 'pdf_file_path', 'N/A')}'")
-        log.info(f"[PdfxXBlock] get_pdf_url - pdf_file_name: '{self.pdf_file_name}'")
-
         # **PRIORITY 1: Check for Open edX asset key (uploaded files)**
         if hasattr(self, 'pdf_file_asset_key') and self.pdf_file_asset_key:
-            log.info(f"[PdfxXBlock] get_pdf_url - Using asset key: {self.pdf_file_asset_key}")
-
+            # Prefer our range-capable handler, named after the asset so that it can be cached
+            if self._get_setting('serve_pdf_ranges'):
+                try:
+                    asset_name = self._pdf_asset_path().rsplit('@', 1)[-1]
+                    return self.runtime.handler_url(self, 'serve_pdf', asset_name)
+                except NotImplementedError:
+                    pass  # Runtimes without handler URLs get the asset URL
             # The asset key should already be in the correct format from upload
             asset_url = self.pdf_file_asset_key
 
@@ -259,15 +304,11 @@ class PdfxXBlock(XBlock):
                     if lms_base:
                         protocol = 'https' if getattr(settings, 'HTTPS', 'on') == 'on' else 'http'
                         asset_url = f"{protocol}://{lms_base}{asset_url}"
-                        log.info(f"[PdfxXBlock] get_pdf_url - Made asset URL absolute: {asset_url}")
                 except Exception as e:
                     log.warning(f"[PdfxXBlock] get_pdf_url - Could not make asset URL absolute: {e}")
 
-            log.info(f"[PdfxXBlock] get_pdf_url - Returning asset URL: {asset_url}")
             return asset_url
 
-        log.info(f"[PdfxXBlock] get_pdf_url - No asset key, checking pdf_url field")
-
         # **PRIORITY 2: Check for direct URL or data URL**
         if not self.pdf_url:
             log.warning(f"[PdfxXBlock] get_pdf_url - pdf_url field is empty/None")
@@ -278,11 +319,8 @@ class PdfxXBlock(XBlock):
             log.warning(f"[PdfxXBlock] get_pdf_url - pdf_url field is empty after strip")
             return ""
 
-        log.info(f"[PdfxXBlock] get_pdf_url - Processing URL: {url}")
-
         # Handle data URLs (base64 encoded files from uploads)
         if url.startswith('data:application/pdf;base64,'):
-            log.info(f"[PdfxXBlock] get_pdf_url - Returning data URL (length: {len(url)})")
             return url
 
         # Handle Open edX asset URLs (asset-v1:...)
@@ -324,73 +362,26 @@ class PdfxXBlock(XBlock):
             return f"https://{url}"
 
         # Return as is if it's already a complete URL
-        log.info(f"[PdfxXBlock] get_pdf_url - Returning complete URL: {url}")
         return url
 
     def is_staff_user(self):
         """Check if current user is staff"""
-        try:
-            # First try to get from user service
-            user_service = self.runtime.service(self, 'user')
-            if user_service:
-                current_user = user_service.get_current_user()
-                if current_user and hasattr(current_user, 'opt_attrs'):
-                    is_staff = current_user.opt_attrs.get('edx-platform.user_is_staff', False)
-                    is_global_staff = current_user.opt_attrs.get('edx-platform.user_is_global_staff', False)
-                    user_role = current_user.opt_attrs.get('edx-platform.user_role', '')
-
-                    # User is staff if they have staff flag, global staff flag, or instructor/staff role
-                    staff_status = is_staff or is_global_staff or user_role in ('staff', 'instructor')
-                    log.info(f"[PdfxXBlock] is_staff_user - Staff status: {staff_status} (is_staff: {is_staff}, is_global_staff: {is_global_staff}, role: {user_role})")
-                    return staff_status
-
-            # Fallback to runtime attribute
-            if hasattr(self.runtime, 'user_is_staff'):
-                staff_status = getattr(self.runtime, 'user_is_staff', False)
-                log.info(f"[PdfxXBlock] is_staff_user - Staff status from runtime: {staff_status}")
-                return staff_status
-
-            log.warning(f"[PdfxXBlock] is_staff_user - Could not determine staff status, defaulting to False")
-            return False
-        except Exception as e:
-            log.error(f"[PdfxXBlock] is_staff_user - Error checking staff status: {e}")
-            return False
+        return self._get_request_context().is_staff
 
     def retrieve_user_highlights(self, user_id):
         """Retrieve highlights for a specific user"""
         return self.highlights.get(user_id, {}) if isinstance(self.highlights, dict) else {}
 
-    def get_all_user_highlights(self):
-        """Get highlights from all users (staff view)"""
-        if isinstance(self.highlights, dict):
-            all_highlights = {}
-            for user_id, user_highlight_data in self.highlights.items():
-                if isinstance(user_highlight_data, dict):
-                    for page_num, page_highlights in user_highlight_data.items():
-                        if page_num not in all_highlights:
-                            all_highlights[page_num] = []
-                        if isinstance(page_highlights, list):
-                            all_highlights[page_num].extend(page_highlights)
-            return all_highlights
-        return {}
+    def get_class_highlight_heatmap(self):
+        """Get the highlight heatmap of all students (staff view): {page: [[start, end, count], ...]}"""
+        return dict(self.highlight_heatmap)
 
+    @Metrics.timed('student_view')
     def student_view(self, context=None):
         """
         The primary view using ES6 modules implementation.
         """
-        import json  # Move json import to the top to avoid UnboundLocalError
-
-        log.info(f"[PdfxXBlock] STUDENT_VIEW START - Block: {getattr(self, 'location', 'unknown')}")
-        log.info(f"[PdfxXBlock] STUDENT_VIEW - Context: {context}")
-        log.info(f"[PdfxXBlock] STUDENT_VIEW - Current block_id field: '{self.block_id}'")
-
-        # Track initial field state
-        initial_fields = {
-            'block_id': self.block_id,
-            'pdf_url': self.pdf_url,
-            'display_name': self.display_name
-        }
-        log.info(f"[PdfxXBlock] STUDENT_VIEW - Initial field values: {initial_fields}")
+        request_context = self._begin_request()
 
         # Generate a working block ID for JavaScript - only save to field if it's truly empty
         working_block_id = self.block_id
@@ -399,7 +390,6 @@ class PdfxXBlock(XBlock):
             import hashlib
             location_str = str(getattr(self, 'location', 'unknown'))
             temp_id = hashlib.md5(location_str.encode()).hexdigest()[:8]
-            log.info(f"[PdfxXBlock] STUDENT_VIEW - Generated deterministic temp_id: {temp_id} from location: {location_str}")
 
             # Only save to field if we're in a normal context (not Studio preview)
             try:
@@ -408,104 +398,33 @@ class PdfxXBlock(XBlock):
                 is_studio_context = 'Studio' in runtime_type or 'Caching' in runtime_type
 
                 if not is_studio_context and hasattr(self, '_field_data') and hasattr(self._field_data, 'set'):
-                    log.info(f"[PdfxXBlock] STUDENT_VIEW - Attempting to save block_id to field")
                     self.block_id = temp_id
-                    working_block_id = temp_id
-                    log.info(f"[PdfxXBlock] STUDENT_VIEW - Successfully saved block_id: {temp_id}")
-                else:
-                    working_block_id = temp_id
-                    log.info(f"[PdfxXBlock] STUDENT_VIEW - Using temp block_id (Studio context): {temp_id}")
+                working_block_id = temp_id
             except Exception as e:
                 # If we can't save (e.g., in preview mode), use temp ID
                 working_block_id = temp_id
                 log.warning(f"[PdfxXBlock] STUDENT_VIEW - Failed to save block_id, using temp: {temp_id}, error: {e}")
 
-        # Use the same HTML template as the base class
-        html = self.resource_string("static/html/pdfx.html")
-
-        # Import Template from Mako
-        from mako.template import Template
-        template = Template(html)
+        # Compiled once per process; dev mode recompiles when the file changes
+        template = TemplateCache.get("static/html/pdfx.html", check_mtime=self._get_setting('debug_mode'))
 
         # Prepare context for template
-        user_info = self.get_user_info()
-        course_info = self.get_course_info()
+        user_info = {'id': request_context.user_id, 'username': request_context.username}
+        course_info = {'id': request_context.course_id}
         pdf_url = self.get_pdf_url()
         is_staff = self.is_staff_user()
 
-        # Debug logging
-        log.info(f"[PdfxXBlock] Block ID: {working_block_id}")
-        log.info(f"[PdfxXBlock] Raw PDF URL field: '{self.pdf_url}'")
-        log.info(f"[PdfxXBlock] Raw PDF URL length: {len(self.pdf_url) if self.pdf_url else 0}")
-        log.info(f"[PdfxXBlock] PDF file asset key: '{getattr(self, 'pdf_file_asset_key', 'N/A')}'")
-        log.info(f"[PdfxXBlock] PDF file path: '{getattr(self, 'pdf_file_path', 'N/A')}'")
-        log.info(f"[PdfxXBlock] PDF file name: '{self.pdf_file_name}'")
-        log.info(f"[PdfxXBlock] Allow download: {self.allow_download}")
-        log.info(f"[PdfxXBlock] Allow annotation: {self.allow_annotation}")
-        log.info(f"[PdfxXBlock] Processed PDF URL: '{pdf_url}'")
-        log.info(f"[PdfxXBlock] Processed PDF URL length: {len(pdf_url) if pdf_url else 0}")
-        log.info(f"[PdfxXBlock] User ID: {user_info.get('id', 'anonymous')}")
-        log.info(f"[PdfxXBlock] Username: {user_info.get('username', 'anonymous')}")
-        log.info(f"[PdfxXBlock] User Email: {user_info.get('email', 'none')}")
-        log.info(f"[PdfxXBlock] Is Staff: {is_staff}")
-        log.info(f"[PdfxXBlock] Course ID: {course_info.get('id', 'none')}")
-
-        # Detailed user service debug
-        try:
-            user_service = self.runtime.service(self, 'user')
-            if user_service:
-                current_user = user_service.get_current_user()
-                if current_user and hasattr(current_user, 'opt_attrs'):
-                    log.info(f"[PdfxXBlock] User service available - opt_attrs keys: {list(current_user.opt_attrs.keys())}")
-                    log.info(f"[PdfxXBlock] User authenticated: {current_user.opt_attrs.get('edx-platform.is_authenticated', False)}")
-                else:
-                    log.warning(f"[PdfxXBlock] User service available but no current_user or opt_attrs")
-            else:
-                log.warning(f"[PdfxXBlock] User service not available")
-        except Exception as user_debug_error:
-            log.error(f"[PdfxXBlock] Error in user service debug: {user_debug_error}")
-
-        # Validate PDF URL
         if not pdf_url:
-            log.warning(f"[PdfxXBlock] No PDF URL provided for block {working_block_id}")
-            log.warning(f"[PdfxXBlock] Raw pdf_url field: '{self.pdf_url}'")
-            log.warning(f"[PdfxXBlock] Raw pdf_url length: {len(self.pdf_url) if self.pdf_url else 0}")
-            log.warning(f"[PdfxXBlock] PDF file name: '{self.pdf_file_name}'")
-            log.warning(f"[PdfxXBlock] PDF file path: '{getattr(self, 'pdf_file_path', 'N/A')}'")
-            log.warning(f"[PdfxXBlock] PDF file asset key: '{getattr(self, 'pdf_file_asset_key', 'N/A')}'")
-
-            # Instead of returning a different fragment, let's continue with the normal template
-            # but use an empty PDF URL - this will allow the template to render properly
-            # and the JavaScript to handle the "no PDF" case gracefully
+            # Render the normal template with an empty URL; the JavaScript handles the "no PDF" case
+            log.warning(f"[PdfxXBlock] No PDF URL configured for block {working_block_id}")
             pdf_url = ""  # Ensure it's an empty string, not None
-            log.info(f"[PdfxXBlock] Continuing with empty PDF URL to render proper template")
-
-        # Log PDF configuration status
-        if pdf_url:
-            log.info(f"[PdfxXBlock] ✅ PDF successfully configured for block {working_block_id}")
-            if getattr(self, 'pdf_file_path', ''):
-                log.info(f"[PdfxXBlock] ✅ PDF source: Uploaded file (stored at: {self.pdf_file_path})")
-            elif pdf_url.startswith('data:application/pdf'):
-                log.info(f"[PdfxXBlock] ✅ PDF source: Uploaded file (data URL, length: {len(pdf_url)})")
-            else:
-                log.info(f"[PdfxXBlock] ✅ PDF source: External URL - {pdf_url}")
-            log.info(f"[PdfxXBlock] ✅ PDF file name: {self.pdf_file_name}")
-        else:
-            log.warning(f"[PdfxXBlock] ⚠️ PDF NOT configured for block {working_block_id} - will render with empty PDF URL")
-
-        log.info(f"[PdfxXBlock] ✅ Allow download: {self.allow_download}")
-        log.info(f"[PdfxXBlock] ✅ Allow annotation: {self.allow_annotation}")
 
-        # Check for field changes before proceeding
-        current_fields = {
-            'block_id': self.block_id,
-            'pdf_url': self.pdf_url,
-            'display_name': self.display_name
-        }
-        if current_fields != initial_fields:
-            log.warning(f"[PdfxXBlock] STUDENT_VIEW - Field values changed during rendering!")
-            log.warning(f"[PdfxXBlock] STUDENT_VIEW - Initial: {initial_fields}")
-            log.warning(f"[PdfxXBlock] STUDENT_VIEW - Current: {current_fields}")
+        self._debug_event(
+            'student_view.context', block=working_block_id, user=request_context.user_id,
+            course=request_context.course_id, staff=is_staff, pdf_file_name=self.pdf_file_name,
+            pdf_source=lambda: self._pdf_source(pdf_url), pdf_url_length=len(pdf_url),
+            allow_download=self.allow_download, allow_annotation=self.allow_annotation
+        )
 
         # Get PDF file name
         if self.pdf_file_name:
@@ -523,32 +442,49 @@ class PdfxXBlock(XBlock):
         else:
             pdf_file_name = "document.pdf"
 
-        # Document info
+        # Document info, with the page count and metadata read at upload when available
+        pdf_analysis = self.pdf_analysis or {}
         document_info = {
-            'title': self.pdf_file_name or 'PDF Document',
+            'title': pdf_analysis.get('title') or self.pdf_file_name or 'PDF Document',
             'url': pdf_url
         }
+        if pdf_analysis.get('numPages'):
+            document_info.update(
+                numPages=pdf_analysis['numPages'], author=pdf_analysis.get('author', ''),
+                pageSizes=pdf_analysis.get('pageSizes', [])
+            )
 
         # Get highlights based on user type
+        highlights_to_display = self.retrieve_user_highlights(user_info['id'])
+        class_heatmap = {}
         if is_staff:
-            highlights_to_display = self.get_all_user_highlights()
-        else:
-            highlights_to_display = self.retrieve_user_highlights(user_info['id'])
-            if self.staff_highlights:
-                for page, page_highlights in self.staff_highlights.items():
-                    if page not in highlights_to_display:
-                        highlights_to_display[page] = []
-                    highlights_to_display[page].extend(page_highlights)
+            # Staff see where the class highlights instead of every student's highlights
+            class_heatmap = self.get_class_highlight_heatmap()
+        elif self.staff_highlights:
+            for page, page_highlights in self.staff_highlights.items():
+                if page not in highlights_to_display:
+                    highlights_to_display[page] = []
+                highlights_to_display[page].extend(page_highlights)
+
+        # Only embed the pages around the current page; the viewer loads others on demand
+        page_window = self._get_page_window(self.current_page)
+        highlights_to_display = self._select_pages(highlights_to_display, [page_window])
+        window_data = self._load_annotation_pages([page_window])
 
         # Get annotation data
-        marker_strokes_data = self.marker_strokes or {}
-        text_annotations_data = self.text_annotations or {}
-        shape_annotations_data = self.shape_annotations or {}
-        note_annotations_data = self.note_annotations or {}
+        drawing_strokes_data = window_data['drawing_strokes']
+        marker_strokes_data = window_data['marker_strokes']
+        text_annotations_data = window_data['text_annotations']
+        shape_annotations_data = window_data['shape_annotations']
 
         # Get save URL
         save_url = self.runtime.handler_url(self, 'save_annotations')
 
+        # Precomputed text runs replace pdf.js text extraction when the text layer is on
+        text_layer_url = ''
+        if self.pdf_text_layer and self._get_setting('render_text_layer'):
+            text_layer_url = self.runtime.handler_url(self, 'text_layer', self.pdf_text_layer.rsplit('@', 1)[-1])
+
         # Get CSRF token for frontend use
         csrf_token = None
         try:
@@ -557,7 +493,6 @@ class PdfxXBlock(XBlock):
             request = getattr(self.runtime, 'request', None)
             if request:
                 csrf_token = get_token(request)
-                log.info(f"[PdfxXBlock] Successfully obtained CSRF token from Django middleware")
             else:
                 log.warning(f"[PdfxXBlock] No request object available for CSRF token")
         except ImportError:
@@ -565,28 +500,22 @@ class PdfxXBlock(XBlock):
         except Exception as e:
             log.warning(f"[PdfxXBlock] Error getting CSRF token: {e}")
 
-        # Pre-serialize JSON data to avoid scope issues in f-strings
-        # Use HTML escaping to prevent quotes from breaking HTML attributes
-        import html
-        allow_download_json = html.escape(json.dumps(self.allow_download))
-        allow_annotation_json = html.escape(json.dumps(self.allow_annotation))
-        annotations_json = html.escape(json.dumps(self.annotations))
-        drawing_strokes_json = html.escape(json.dumps(self.drawing_strokes))
-        highlights_json = html.escape(json.dumps(highlights_to_display))
-        marker_strokes_json = html.escape(json.dumps(marker_strokes_data))
-        text_annotations_json = html.escape(json.dumps(text_annotations_data))
-        shape_annotations_json = html.escape(json.dumps(shape_annotations_data))
-        note_annotations_json = html.escape(json.dumps(note_annotations_data))
-        document_info_json = html.escape(json.dumps(document_info))
-        csrf_token_json = html.escape(json.dumps(csrf_token)) if csrf_token else html.escape(json.dumps(''))
-
-        # Debug the JSON serialization
-        log.info(f"[PdfxXBlock] JSON SERIALIZATION DEBUG:")
-        log.info(f"  - Raw drawing_strokes: {self.drawing_strokes}")
-        log.info(f"  - JSON dumped: {json.dumps(self.drawing_strokes)}")
-        log.info(f"  - HTML escaped: {drawing_strokes_json}")
-        log.info(f"  - Length of escaped JSON: {len(drawing_strokes_json)}")
-        log.info(f"  - CSRF token available: {'Yes' if csrf_token else 'No'}")
+        # Serialize the initial state once, embedded once as a JSON script block. Only the page window
+        # of each annotation field is embedded; the legacy annotations and note fields are not read
+        # by the viewer and are left out rather than embedded whole
+        initial_state_json = self._script_json({
+            'drawingStrokes': drawing_strokes_data,
+            'highlights': highlights_to_display,
+            'markerStrokes': marker_strokes_data,
+            'textAnnotations': text_annotations_data,
+            'shapeAnnotations': shape_annotations_data,
+            'documentInfo': document_info,
+            'classHeatmap': class_heatmap,
+            'heatmapResolution': HEATMAP_RESOLUTION,
+            'debugMode': bool(self._get_setting('debug_mode')),
+        })
+        self._debug_event('student_view.state', bytes=len(initial_state_json), csrf_token=bool(csrf_token),
+                          pages=page_window, highlights=lambda: len(highlights_to_display))
 
         # Render template with context
         template_context = {
@@ -598,63 +527,37 @@ class PdfxXBlock(XBlock):
             'allow_annotation': self.allow_annotation,
             'user_id': user_info.get('id', 'anonymous'),
             'username': user_info.get('username', ''),
-            'email': user_info.get('email', ''),
             'current_page': self.current_page or 1,
+            'preload_pages': self._get_setting('preload_pages'),
+            'loaded_pages': f'{page_window[0]}-{page_window[1]}',
             'brightness': self.brightness or 100,
             'is_grayscale': self.is_grayscale or False,
             'is_staff': is_staff,
             'course_id': course_info.get('id', ''),
             'handler_url': save_url,
+            'text_layer_url': text_layer_url,
             'csrf_token': csrf_token,
-            # Add JSON data for JavaScript
-            'saved_annotations_json': annotations_json,
-            'drawing_strokes_json': drawing_strokes_json,
-            'highlights_json': highlights_json,
-            'marker_strokes_json': marker_strokes_json,
-            'text_annotations_json': text_annotations_json,
-            'shape_annotations_json': shape_annotations_json,
-            'note_annotations_json': note_annotations_json,
-            'csrf_token_json': csrf_token_json,
+            # Annotation data for JavaScript, read from the pdfx-state script block
+            'initial_state_json': initial_state_json,
+            # Sized page placeholders and the outline, shown before pdf.js opens the document
+            'num_pages': pdf_analysis.get('numPages', 0),
+            'page_placeholders': PdfAnalyzer.expand_page_sizes(pdf_analysis),
+            'outline': pdf_analysis.get('outline', []),
         }
 
-        # Debug the template context
-        log.info(f"[PdfxXBlock] TEMPLATE CONTEXT:")
-        log.info(f"  - block_id: '{template_context['block_id']}'")
-        log.info(f"  - pdf_url: '{template_context['pdf_url']}'")
-        log.info(f"  - allow_download: {template_context['allow_download']}")
-        log.info(f"  - allow_annotation: {template_context['allow_annotation']}")
-        log.info(f"  - user_id: '{template_context['user_id']}'")
-        log.info(f"  - course_id: '{template_context['course_id']}'")
-        log.info(f"  - current_page: {template_context['current_page']}")
-
-        # Debug annotation data being passed
-        log.info(f"[PdfxXBlock] ANNOTATION DATA:")
-        log.info(f"  - drawing_strokes: {len(self.drawing_strokes)} pages")
-        log.info(f"  - drawing_strokes content: {self.drawing_strokes}")
-        log.info(f"  - highlights: {len(highlights_to_display)} pages")
-        log.info(f"  - saved_annotations: {len(self.annotations)} items")
-
-        rendered_html = template.render(**template_context)
+        with Metrics.timer('student_view.render'):
+            rendered_html = template.render(**template_context)
         frag = Fragment(rendered_html)
 
+        # Add our CSS and JavaScript: cacheable built files when available, inline otherwise
+        from .assets import StaticAssets
+        StaticAssets.add_to_fragment(self, frag, use_urls=self._get_setting('serve_static_urls'))
+
         # Add CSS for PDF.js viewer
-        frag.add_css(self.resource_string("static/css/pdfx.css"))
         # frag.add_css(self.resource_string("static/css/pdf_viewer.css"))
         frag.add_css_url('https://cdn.jsdelivr.net/npm/pdfjs-dist@5.3.31/web/pdf_viewer.min.css')
         frag.add_css_url('https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.5.1/css/all.min.css')
 
-        # Load PDF.js libraries using dedicated ES6 loader
-        frag.add_javascript(self.resource_string("static/js/pdf-loader-es6.js"))
-
-        # Add the PDF.js XBlock initializer
-        frag.add_javascript(self.resource_string("static/js/src/tools/highlight/HighlightTool.js"))
-        frag.add_javascript(self.resource_string("static/js/src/tools/scribble/ScribbleTool.js"))
-        frag.add_javascript(self.resource_string("static/js/src/tools/text/TextTool.js"))
-        frag.add_javascript(self.resource_string("static/js/src/tools/stamp/StampTool.js"))
-        frag.add_javascript(self.resource_string("static/js/src/tools/ManualSaveTool.js"))
-        frag.add_javascript(self.resource_string("static/js/pdfx-init.js"))
-        frag.add_javascript(self.resource_string("static/js/src/tools/base/ClearTool.js"))
-
         # Initialize the XBlock with PDF.js
         frag.initialize_js('PdfxXBlockInit')
 
@@ -665,30 +568,22 @@ class PdfxXBlock(XBlock):
             data-user-id="{user_info['id']}"
             data-course-id="{course_info['id']}"
             data-handler-url="{save_url}"
-            data-marker-strokes='{marker_strokes_json}'
-            data-text-annotations='{text_annotations_json}'
-            data-shape-annotations='{shape_annotations_json}'
-            data-note-annotations='{note_annotations_json}'
-            data-document-info='{document_info_json}'
             style="display:none;">
         </div>
         """
         frag.add_resource(data_html, mimetype='text/html')
-
-        # Final field check
-        final_fields = {
-            'block_id': self.block_id,
-            'pdf_url': self.pdf_url,
-            'display_name': self.display_name
-        }
-        if final_fields != initial_fields:
-            log.warning(f"[PdfxXBlock] STUDENT_VIEW - Final field values changed!")
-            log.warning(f"[PdfxXBlock] STUDENT_VIEW - Initial: {initial_fields}")
-            log.warning(f"[PdfxXBlock] STUDENT_VIEW - Final: {final_fields}")
-
-        log.info(f"[PdfxXBlock] STUDENT_VIEW END - Successfully created fragment")
         return frag
 
+    def _pdf_source(self, pdf_url):
+        """Describe where the PDF comes from, for debug events"""
+        if getattr(self, 'pdf_file_asset_key', ''):
+            return 'contentstore'
+        if getattr(self, 'pdf_file_path', ''):
+            return 'file'
+        if pdf_url.startswith('data:application/pdf'):
+            return 'data_url'
+        return 'url' if pdf_url else 'none'
+
     def author_view(self, context=None):
         """
         The author view for Studio preview - shows configuration summary.
@@ -834,12 +729,8 @@ class PdfxXBlock(XBlock):
         log.info(f"[PdfxXBlock] STUDIO_VIEW START - Block: {getattr(self, 'location', 'unknown')}")
 
         try:
-            # Load the HTML template
-            html = self.resource_string("static/html/pdfx_edit.html")
-
-            # Import Template from Mako
-            from mako.template import Template
-            template = Template(html)
+            # Load the compiled HTML template
+            template = TemplateCache.get("static/html/pdfx_edit.html", check_mtime=self._get_setting('debug_mode'))
 
             # Render template with proper context
             template_context = {
@@ -907,82 +798,39 @@ class PdfxXBlock(XBlock):
             return error_frag
 
     @XBlock.handler
+    @Metrics.timed('studio_submit')
     def studio_submit(self, request, suffix=''):
         """
         Handle the Studio save and file uploads.
         """
-        log.info(f"[PdfxXBlock] =================== STUDIO_SUBMIT START ===================")
-        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Block: {getattr(self, 'location', 'unknown')}")
-        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Request method: {request.method}")
-        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Content type: {getattr(request, 'content_type', 'unknown')}")
-        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Request path: {getattr(request, 'path', 'unknown')}")
-
-        # Log detailed request information
-        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Request details:")
-        log.info(f"  - Request: {request.params}")
-        log.info(f"  - Request method: {request.method}")
-        log.info(f"  - Has POST: {hasattr(request, 'POST')}")
-        log.info(f"  - Has FILES: {hasattr(request, 'FILES')}")
-
-        if hasattr(request, 'POST'):
-            log.info(f"  - POST keys: {list(request.POST.keys())}")
-            for key, value in request.POST.items():
-                if hasattr(value, 'name') and hasattr(value, 'size'):  # It's a file object
-                    log.info(f"    - POST[{key}]: FILE - name='{value.name}', size={value.size}, type='{getattr(value, 'content_type', 'unknown')}'")
-                elif len(str(value)) > 100:
-                    log.info(f"    - POST[{key}]: {str(value)[:100]}... (truncated, length: {len(str(value))})")
-                else:
-                    log.info(f"    - POST[{key}]: {value}")
-
-        if hasattr(request, 'FILES'):
-            log.info(f"  - FILES keys: {list(request.FILES.keys())}")
-            for key, file_obj in request.FILES.items():
-                log.info(f"    - FILES[{key}]: name='{file_obj.name}', size={file_obj.size}, type='{file_obj.content_type}'")
+        # Get user info (but don't enforce staff status in Studio context)
+        request_context = self._begin_request(request)
+        self._debug_event(
+            'studio_submit.request', user=request_context.user_id, method=request.method,
+            content_type=getattr(request, 'content_type', None),
+            post_keys=lambda: list(request.POST.keys()) if hasattr(request, 'POST') else None,
+            file_keys=lambda: list(request.FILES.keys()) if hasattr(request, 'FILES') else None
+        )
 
         # Ensure backward compatibility fields exist
         if not hasattr(self, 'pdf_file_path'):
-            log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Adding pdf_file_path field for backward compatibility")
             self.pdf_file_path = ""
 
         if not hasattr(self, 'pdf_file_asset_key'):
-            log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Adding pdf_file_asset_key field for backward compatibility")
             self.pdf_file_asset_key = ""
 
-        # Get user info (but don't enforce staff status in Studio context)
-        user_info = self.get_user_info()
-        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - User: {user_info.get('username', 'anonymous')} (ID: {user_info.get('id', 'anonymous')})")
-
-        # Log current field values before update
-        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - BEFORE UPDATE - Current field values:")
-        log.info(f"  - display_name: '{self.display_name}'")
-        log.info(f"  - pdf_url: '{self.pdf_url}' (length: {len(self.pdf_url) if self.pdf_url else 0})")
-        log.info(f"  - pdf_file_name: '{self.pdf_file_name}'")
-        log.info(f"  - pdf_file_path: '{getattr(self, 'pdf_file_path', 'N/A')}'")
-        log.info(f"  - pdf_file_asset_key: '{getattr(self, 'pdf_file_asset_key', 'N/A')}'")
-        log.info(f"  - allow_download: {self.allow_download}")
-        log.info(f"  - allow_annotation: {self.allow_annotation}")
-
         try:
             # **STEP 1: DETECT FILE UPLOAD** - Check both FILES and POST for uploaded files
             uploaded_file = None
             form_data = {}
 
-            log.info(f"[PdfxXBlock] STUDIO_SUBMIT - STEP 1: Detecting file upload...")
-
             # First check request.FILES (standard Django file upload location)
             if hasattr(request, 'FILES') and 'pdf_file' in request.FILES:
                 uploaded_file = request.FILES['pdf_file']
-                log.info(f"[PdfxXBlock] STUDIO_SUBMIT - ✅ FILE UPLOAD DETECTED in FILES!")
-                log.info(f"[PdfxXBlock] STUDIO_SUBMIT - File details:")
-                log.info(f"    - File name: '{uploaded_file.name}'")
-                log.info(f"    - File size: {uploaded_file.size} bytes ({uploaded_file.size / (1024*1024):.2f} MB)")
-                log.info(f"    - Content type: '{uploaded_file.content_type}'")
-                log.info(f"    - File object type: {type(uploaded_file)}")
 
             # Also check request.POST for file objects (XBlock sometimes puts files here)
             elif hasattr(request, 'POST') and 'pdf_file' in request.POST:
                 file_obj = request.POST['pdf_file']
-                log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Found object in POST[pdf_file]: {type(file_obj)}")
 
                 # Check if it's a DjangoUploadedFile or similar file object
                 # DjangoUploadedFile has different attributes than regular files
@@ -994,53 +842,8 @@ class PdfxXBlock(XBlock):
                         hasattr(file_obj, 'content_type') or
                         hasattr(file_obj, 'file')):
                         uploaded_file = file_obj
-                        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - ✅ FILE UPLOAD DETECTED in POST!")
-                        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - File details:")
-
-                        # Get filename properly for DjangoUploadedFile
-                        actual_filename = getattr(uploaded_file, 'filename', getattr(uploaded_file, 'name', 'unknown.pdf'))
-                        log.info(f"    - File name: '{actual_filename}'")
-
-                        # DjangoUploadedFile has different size access patterns
-                        file_size = 0
-                        try:
-                            if hasattr(uploaded_file, 'file') and hasattr(uploaded_file.file, 'size'):
-                                file_size = uploaded_file.file.size
-                            elif hasattr(uploaded_file, 'size'):
-                                file_size = uploaded_file.size
-                            elif hasattr(uploaded_file, '_size'):
-                                file_size = uploaded_file._size
-                            elif hasattr(uploaded_file, 'file'):
-                                # Try to get size by seeking to end
-                                current_pos = uploaded_file.file.tell()
-                                uploaded_file.file.seek(0, 2)  # Seek to end
-                                file_size = uploaded_file.file.tell()
-                                uploaded_file.file.seek(current_pos)  # Restore position
-                        except Exception as size_error:
-                            log.warning(f"[PdfxXBlock] STUDIO_SUBMIT - Could not determine file size: {size_error}")
-
-                        log.info(f"    - File size: {file_size} bytes ({file_size / (1024*1024):.2f} MB)")
-                        log.info(f"    - Content type: '{getattr(uploaded_file, 'content_type', 'application/pdf')}'")
-                        log.info(f"    - File object type: {type(uploaded_file)}")
-                        log.info(f"    - Available attributes: {[attr for attr in dir(uploaded_file) if not attr.startswith('_')]}")
-                        log.info(f"    - Has 'file' attribute: {hasattr(uploaded_file, 'file')}")
-                        log.info(f"    - Has 'filename' attribute: {hasattr(uploaded_file, 'filename')}")
-                        if hasattr(uploaded_file, 'file'):
-                            log.info(f"    - File object type: {type(uploaded_file.file)}")
-                            log.info(f"    - File object attributes: {[attr for attr in dir(uploaded_file.file) if not attr.startswith('_')][:10]}")
                     else:
-                        log.warning(f"[PdfxXBlock] STUDIO_SUBMIT - POST[pdf_file] exists but doesn't have file-like attributes")
-                        log.warning(f"    - Has 'read': {hasattr(file_obj, 'read')}")
-                        log.warning(f"    - Has 'chunks': {hasattr(file_obj, 'chunks')}")
-                        log.warning(f"    - Has 'content_type': {hasattr(file_obj, 'content_type')}")
-                        log.warning(f"    - Has 'file': {hasattr(file_obj, 'file')}")
-                        log.warning(f"    - Type: {type(file_obj)}")
-                        log.warning(f"    - String representation: {str(file_obj)[:100]}")
-                else:
-                    log.info(f"[PdfxXBlock] STUDIO_SUBMIT - POST[pdf_file] is not a file object")
-                    log.info(f"    - Has 'name': {hasattr(file_obj, 'name')}")
-                    log.info(f"    - Has 'filename': {hasattr(file_obj, 'filename')}")
-                    log.info(f"    - Type: {type(file_obj)}")
+                        log.warning(f"[PdfxXBlock] STUDIO_SUBMIT - POST[pdf_file] exists but doesn't have file-like attributes ({type(file_obj).__name__})")
 
             # Get form data from POST
             if hasattr(request, 'POST'):
@@ -1048,62 +851,27 @@ class PdfxXBlock(XBlock):
                     # Skip file objects when collecting form data - check for file-like attributes
                     if not (hasattr(value, 'name') and ('UploadedFile' in str(type(value)) or hasattr(value, 'read'))):
                         form_data[key] = value
-                        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Form field '{key}': '{value}'")
 
             # **CRITICAL CHECK: If no file uploaded, check for existing files or URL**
             if not uploaded_file:
-                log.info(f"[PdfxXBlock] STUDIO_SUBMIT - No new file uploaded, checking for existing files or URL...")
-                log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Available data in request:")
-                log.info(f"    - request.FILES keys: {list(request.FILES.keys()) if hasattr(request, 'FILES') else 'No FILES'}")
-                log.info(f"    - request.POST keys: {list(request.POST.keys()) if hasattr(request, 'POST') else 'No POST'}")
-
-                # Check if user is providing a PDF URL
-                pdf_url = form_data.get('pdf_url', '').strip()
-
-                # Check for existing uploaded files in XBlock fields
-                existing_asset_key = getattr(self, 'pdf_file_asset_key', '').strip()
-                existing_file_path = getattr(self, 'pdf_file_path', '').strip()
-                existing_file_name = getattr(self, 'pdf_file_name', '').strip()
-
-                log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Checking existing file data:")
-                log.info(f"    - pdf_url from form: '{pdf_url}'")
-                log.info(f"    - existing_asset_key: '{existing_asset_key}'")
-                log.info(f"    - existing_file_path: '{existing_file_path}'")
-                log.info(f"    - existing_file_name: '{existing_file_name}'")
-
                 # We have valid configuration if any of these are true:
                 # 1. User provided a PDF URL
                 # 2. There's an existing asset key (contentstore file)
                 # 3. There's an existing file path (Django storage file)
                 # 4. There's an existing file name (any uploaded file)
                 has_valid_pdf_source = (
-                    pdf_url or
-                    existing_asset_key or
-                    existing_file_path or
-                    existing_file_name
+                    form_data.get('pdf_url', '').strip() or
+                    getattr(self, 'pdf_file_asset_key', '').strip() or
+                    getattr(self, 'pdf_file_path', '').strip() or
+                    getattr(self, 'pdf_file_name', '').strip()
                 )
 
-                if pdf_url:
-                    log.info(f"[PdfxXBlock] STUDIO_SUBMIT - ✅ User provided PDF URL: '{pdf_url}'")
-                elif existing_asset_key:
-                    log.info(f"[PdfxXBlock] STUDIO_SUBMIT - ✅ Found existing contentstore asset: '{existing_asset_key}'")
-                elif existing_file_path:
-                    log.info(f"[PdfxXBlock] STUDIO_SUBMIT - ✅ Found existing file path: '{existing_file_path}'")
-                elif existing_file_name:
-                    log.info(f"[PdfxXBlock] STUDIO_SUBMIT - ✅ Found existing file name: '{existing_file_name}'")
-
                 if not has_valid_pdf_source:
-                    log.error(f"[PdfxXBlock] STUDIO_SUBMIT - ❌ CRITICAL ERROR: No PDF source found!")
-                    log.error(f"[PdfxXBlock] STUDIO_SUBMIT - This PDF viewer component requires either:")
-                    log.error(f"    - A new PDF file upload, OR")
-                    log.error(f"    - A PDF URL, OR")
-                    log.error(f"    - An existing uploaded file")
+                    log.error(f"[PdfxXBlock] STUDIO_SUBMIT - ❌ No PDF source found: no upload, PDF URL or existing file")
                     return self._json_response({
                         'result': 'error',
                         'message': 'No PDF file uploaded and no PDF URL provided. This component requires either a PDF file upload or a valid PDF URL to function.'
                     })
-                else:
-                    log.info(f"[PdfxXBlock] STUDIO_SUBMIT - ✅ Valid PDF source found, proceeding with configuration update...")
 
             if not uploaded_file and not form_data:
                 log.warning(f"[PdfxXBlock] STUDIO_SUBMIT - ❌ No POST or FILES data found")
@@ -1120,105 +888,21 @@ class PdfxXBlock(XBlock):
             if uploaded_file:
                 # Get the actual filename from DjangoUploadedFile
                 actual_filename = getattr(uploaded_file, 'filename', uploaded_file.name)
-                log.info(f"[PdfxXBlock] STUDIO_SUBMIT - STEP 2: Processing file upload for '{actual_filename}'")
 
                 try:
-                    # **STEP 2A: VALIDATE PDF**
-                    log.info(f"[PdfxXBlock] STUDIO_SUBMIT - STEP 2A: Validating PDF file...")
-
-                    # For DjangoUploadedFile, we need to read from the .file attribute
-                    if hasattr(uploaded_file, 'file'):
-                        file_content = uploaded_file.file.read()
-                        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Read {len(file_content)} bytes from uploaded_file.file")
-                    else:
-                        # Fallback for other file types
-                        file_content = uploaded_file.read()
-                        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Read {len(file_content)} bytes from uploaded_file")
-
-                    if not file_content.startswith(b'%PDF'):
-                        log.error(f"[PdfxXBlock] STUDIO_SUBMIT - ❌ File validation failed: Not a valid PDF")
-                        log.error(f"[PdfxXBlock] STUDIO_SUBMIT - File starts with: {file_content[:20]}")
-                        return self._json_response({'result': 'error', 'message': 'Uploaded file is not a valid PDF'})
-
-                    log.info(f"[PdfxXBlock] STUDIO_SUBMIT - ✅ PDF validation passed")
-
-                    # Reset file pointer for storage (for DjangoUploadedFile, reset the .file)
-                    if hasattr(uploaded_file, 'file'):
-                        uploaded_file.file.seek(0)
-                    else:
-                        uploaded_file.seek(0)
+                    # **STEP 2A: READ AND VALIDATE PDF** - one chunked read, refused as soon as it is too large
+                    try:
+                        with Metrics.timer('studio_submit.read'):
+                            pdf_upload = PdfUpload.read(uploaded_file)
+                    except PdfUploadError as upload_error:
+                        Metrics.incr(f'upload.{upload_error.code}')
+                        log.warning(f"[PdfxXBlock] STUDIO_SUBMIT - ❌ Upload refused: {upload_error}")
+                        return self._json_response(upload_error.to_dict())
 
                     # **STEP 2B: USE OPEN EDX CONTENTSTORE** (Only method we support)
-                    log.info(f"[PdfxXBlock] STUDIO_SUBMIT - STEP 2B: Using Open edX contentstore...")
                     try:
-                        # Import Open edX contentstore modules
-                        from xmodule.contentstore.django import contentstore
-                        from xmodule.contentstore.content import StaticContent
-                        from opaque_keys.edx.keys import AssetKey
-                        import uuid
-
-                        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Successfully imported contentstore modules")
-
-                        # Generate a unique filename
-                        import os
-                        safe_filename = actual_filename.replace(' ', '_')
-                        unique_id = str(uuid.uuid4())[:8]
-                        unique_filename = f"{unique_id}_{safe_filename}"
-
-                        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Generated unique filename: {unique_filename}")
-
-                        # Get the course key from the XBlock's location
-                        course_key = self.location.course_key
-                        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Course key: {course_key}")
-
-                        # Get content store
-                        content_store = contentstore()
-                        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Got contentstore: {type(content_store)}")
-
-                        # Create asset path - use a simpler name pattern (same as example-pdf.py)
-                        asset_path = f"pdfs_{unique_id}_{safe_filename}"
-                        asset_key = StaticContent.compute_location(course_key, asset_path)
-                        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Generated asset key: {asset_key}")
-
-                        # Reset file pointer and read content again for storage
-                        if hasattr(uploaded_file, 'file'):
-                            uploaded_file.file.seek(0)
-                            file_content = uploaded_file.file.read()
-                        else:
-                            uploaded_file.seek(0)
-                            file_content = uploaded_file.read()
-                        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Read file content for storage: {len(file_content)} bytes")
-
-                        # Create the static content (same pattern as example-pdf.py)
-                        content = StaticContent(
-                            asset_key,
-                            actual_filename,  # Use actual filename for display
-                            'application/pdf',
-                            file_content,
-                            length=len(file_content)
-                        )
-                        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Created StaticContent object")
-
-                        # Save the content to contentstore
-                        content_store.save(content)
-                        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - ✅ Successfully saved to contentstore!")
-
-                        # Generate the asset URL (same pattern as example-pdf.py)
-                        try:
-                            asset_url = StaticContent.serialize_asset_key_with_slash(asset_key)
-                            log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Generated asset URL: {asset_url}")
-
-                            # If this doesn't work, try constructing it manually
-                            if not asset_url:
-                                log.warning(f"[PdfxXBlock] STUDIO_SUBMIT - serialize_asset_key_with_slash returned empty, using manual construction")
-                                asset_url = f"/asset-v1:{str(course_key)}+type@asset+block@{asset_path}"
-                                log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Manual asset URL: {asset_url}")
-
-                        except Exception as url_error:
-                            log.error(f"[PdfxXBlock] STUDIO_SUBMIT - Error generating asset URL: {url_error}")
-                            # Fallback to basic URL format
-                            asset_url = f"/asset-v1:{str(course_key)}+type@asset+block@{asset_path}"
-                            log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Fallback asset URL: {asset_url}")
+                        # Store it under its content hash, reusing an identical asset of the course, and analyze it
+                        asset_url, deduplicated = self._ingest_pdf_upload(pdf_upload, actual_filename, 'studio_submit.store')
 
                         # Update fields with asset data
                         self.display_name = form_data.get('display_name', self.display_name)
@@ -1230,13 +914,6 @@ class PdfxXBlock(XBlock):
                         storage_method = 'open_edx_contentstore'
                         storage_path = asset_url
 
-                        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - ✅ Open edX contentstore SUCCESS!")
-                        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Updated fields after contentstore:")
-                        log.info(f"    - pdf_file_asset_key: '{self.pdf_file_asset_key}'")
-                        log.info(f"    - pdf_file_name: '{self.pdf_file_name}'")
-                        log.info(f"    - pdf_url cleared: '{self.pdf_url}'")
-                        log.info(f"    - pdf_file_path cleared: '{self.pdf_file_path}'")
-
                     except ImportError as import_error:
                         log.error(f"[PdfxXBlock] STUDIO_SUBMIT - ❌ Contentstore import failed: {import_error}")
                         return self._json_response({
@@ -1253,6 +930,8 @@ class PdfxXBlock(XBlock):
                             'result': 'error',
                             'message': f'File storage to Open edX contentstore failed: {str(contentstore_error)}'
                         })
+                    finally:
+                        pdf_upload.close()
 
                     if not file_stored_successfully:
                         log.error(f"[PdfxXBlock] STUDIO_SUBMIT - ❌ File storage failed - Open edX contentstore is required")
@@ -1262,16 +941,6 @@ class PdfxXBlock(XBlock):
                     self.allow_download = str(form_data.get('allow_download', 'true')).lower() == 'true'
                     self.allow_annotation = str(form_data.get('allow_annotation', 'true')).lower() == 'true'
 
-                    log.info(f"[PdfxXBlock] STUDIO_SUBMIT - STEP 2D: Final field verification after file storage:")
-                    log.info(f"    - display_name: '{self.display_name}'")
-                    log.info(f"    - pdf_file_asset_key: '{getattr(self, 'pdf_file_asset_key', 'N/A')}'")
-                    log.info(f"    - pdf_file_path: '{getattr(self, 'pdf_file_path', 'N/A')}'")
-                    log.info(f"    - pdf_file_name: '{self.pdf_file_name}'")
-                    log.info(f"    - pdf_url length: {len(self.pdf_url) if self.pdf_url else 0}")
-                    log.info(f"    - allow_download: {self.allow_download}")
-                    log.info(f"    - allow_annotation: {self.allow_annotation}")
-                    log.info(f"    - storage_method: {storage_method}")
-
                 except Exception as file_error:
                     log.error(f"[PdfxXBlock] STUDIO_SUBMIT - ❌ File processing error: {file_error}")
                     log.error(f"[PdfxXBlock] STUDIO_SUBMIT - File error type: {type(file_error).__name__}")
@@ -1281,7 +950,6 @@ class PdfxXBlock(XBlock):
 
             else:
                 # **STEP 3: HANDLE REGULAR FORM DATA (configuration updates)**
-                log.info(f"[PdfxXBlock] STUDIO_SUBMIT - STEP 3: Processing configuration update (no new file upload)")
 
                 # Update basic field values
                 self.display_name = form_data.get('display_name', self.display_name)
@@ -1291,21 +959,21 @@ class PdfxXBlock(XBlock):
 
                 if form_pdf_url:
                     # User provided a new URL - switch to URL mode
-                    log.info(f"[PdfxXBlock] STUDIO_SUBMIT - User provided new PDF URL: '{form_pdf_url}'")
                     self.pdf_url = form_pdf_url
                     self.pdf_file_path = ""  # Clear file path when using URL
                     self.pdf_file_asset_key = ""  # Clear asset key when using URL
+                    self.pdf_analysis = {}  # The analysis, index and text layer were of the uploaded file
+                    self.pdf_search_index = ""
+                    self.pdf_text_layer = ""
                     self.pdf_file_name = ""  # Clear file name when using URL
                 else:
                     # No new URL provided - preserve existing file configuration
-                    log.info(f"[PdfxXBlock] STUDIO_SUBMIT - No new URL provided, preserving existing file configuration")
                     # Don't update pdf_url, pdf_file_path, pdf_file_asset_key, or pdf_file_name
                     # These should remain as they were to preserve existing uploaded files
 
                     # Only update the file name if explicitly provided in form (for display purposes)
                     if 'pdf_file_name' in form_data and form_data['pdf_file_name'].strip():
                         self.pdf_file_name = form_data['pdf_file_name'].strip()
-                        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Updated file name for display: '{self.pdf_file_name}'")
 
                 # Handle boolean fields properly
                 if 'allow_download' in form_data:
@@ -1313,33 +981,10 @@ class PdfxXBlock(XBlock):
                 if 'allow_annotation' in form_data:
                     self.allow_annotation = str(form_data['allow_annotation']).lower() == 'true'
 
-                log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Updated fields for configuration update:")
-                log.info(f"    - display_name: '{self.display_name}'")
-                log.info(f"    - pdf_url: '{self.pdf_url}'")
-                log.info(f"    - pdf_file_name: '{self.pdf_file_name}'")
-                log.info(f"    - pdf_file_path: '{getattr(self, 'pdf_file_path', 'N/A')}'")
-                log.info(f"    - pdf_file_asset_key: '{getattr(self, 'pdf_file_asset_key', 'N/A')}'")
-                log.info(f"    - allow_download: {self.allow_download}")
-                log.info(f"    - allow_annotation: {self.allow_annotation}")
-
-            # **STEP 4: SAVE CHANGES**
-            log.info(f"[PdfxXBlock] STUDIO_SUBMIT - STEP 4: Saving changes to database...")
-
-            # Log field values before save
-            log.info(f"[PdfxXBlock] STUDIO_SUBMIT - BEFORE SAVE - Final field values:")
-            log.info(f"  - display_name: '{self.display_name}'")
-            log.info(f"  - pdf_url: length={len(self.pdf_url) if self.pdf_url else 0}, starts_with={'data:' if self.pdf_url and self.pdf_url.startswith('data:') else 'other'}")
-            log.info(f"  - pdf_file_path: '{getattr(self, 'pdf_file_path', 'N/A')}'")
-            log.info(f"  - pdf_file_asset_key: '{getattr(self, 'pdf_file_asset_key', 'N/A')}'")
-            log.info(f"  - pdf_file_name: '{self.pdf_file_name}'")
-            log.info(f"  - allow_download: {self.allow_download}")
-            log.info(f"  - allow_annotation: {self.allow_annotation}")
-
-            # Simple save - let XBlock handle scope issues
+            # **STEP 4: SAVE CHANGES** - let XBlock handle scope issues
             try:
-                # Actually call save() to persist the fields
-                self.save()
-                log.info(f"[PdfxXBlock] STUDIO_SUBMIT - ✅ Save completed successfully")
+                with Metrics.timer('studio_submit.save'):
+                    self.save()
             except Exception as save_error:
                 log.error(f"[PdfxXBlock] STUDIO_SUBMIT - ❌ Save error: {save_error}")
                 log.error(f"[PdfxXBlock] STUDIO_SUBMIT - Save error type: {type(save_error).__name__}")
@@ -1352,70 +997,39 @@ class PdfxXBlock(XBlock):
                     # For other errors, fail the request
                     return self._json_response({'result': 'error', 'message': f'Save failed: {str(save_error)}'})
 
-            # **STEP 5: VERIFICATION**
-            log.info(f"[PdfxXBlock] STUDIO_SUBMIT - STEP 5: Verifying saved data...")
-
-            # Verify fields were set correctly
-            log.info(f"[PdfxXBlock] STUDIO_SUBMIT - AFTER SAVE - Verification:")
-            log.info(f"  - display_name: '{self.display_name}'")
-            log.info(f"  - pdf_url: length={len(self.pdf_url) if self.pdf_url else 0}")
-            log.info(f"  - pdf_file_path: '{getattr(self, 'pdf_file_path', 'N/A')}'")
-            log.info(f"  - pdf_file_asset_key: '{getattr(self, 'pdf_file_asset_key', 'N/A')}'")
-            log.info(f"  - pdf_file_name: '{self.pdf_file_name}'")
-
-            # Test if get_pdf_url() works correctly
+            # **STEP 5: VERIFICATION** - the saved configuration must yield a PDF URL
             try:
-                test_url = self.get_pdf_url()
-                if test_url:
-                    log.info(f"[PdfxXBlock] STUDIO_SUBMIT - ✅ get_pdf_url() working correctly")
-                    log.info(f"[PdfxXBlock] STUDIO_SUBMIT - Generated URL: {test_url[:100]}...")
-                    if test_url.startswith('/xblock/'):
-                        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - URL type: Handler URL (serve_pdf_file)")
-                    elif test_url.startswith('data:'):
-                        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - URL type: Data URL")
-                    else:
-                        log.info(f"[PdfxXBlock] STUDIO_SUBMIT - URL type: External URL")
-                else:
+                if not self.get_pdf_url():
                     log.warning(f"[PdfxXBlock] STUDIO_SUBMIT - ⚠️ get_pdf_url() returned empty string")
             except Exception as url_error:
                 log.error(f"[PdfxXBlock] STUDIO_SUBMIT - ❌ get_pdf_url() failed: {url_error}")
 
             # **STEP 6: SUCCESS RESPONSE**
-            log.info(f"[PdfxXBlock] STUDIO_SUBMIT - STEP 6: Preparing success response...")
-
-            # Success response
             response_data = {'result': 'success'}
             if uploaded_file:
                 response_data['file_uploaded'] = True
                 response_data['file_name'] = self.pdf_file_name
                 response_data['storage_method'] = storage_method
                 response_data['storage_path'] = storage_path
+                response_data['deduplicated'] = deduplicated
 
-                log.info(f"[PdfxXBlock] STUDIO_SUBMIT - File upload response data:")
-                log.info(f"    - file_uploaded: {response_data['file_uploaded']}")
-                log.info(f"    - file_name: '{response_data['file_name']}'")
-                log.info(f"    - storage_method: '{response_data['storage_method']}'")
-                log.info(f"    - storage_path: '{response_data.get('storage_path', 'N/A')}'")
-
-            log.info(f"[PdfxXBlock] STUDIO_SUBMIT ================== SUCCESS END ==================")
+            self._debug_event('studio_submit.done', pdf_source=lambda: self._pdf_source(self.pdf_url or ''), **response_data)
             return self._json_response(response_data)
 
         except Exception as e:
-            log.error(f"[PdfxXBlock] STUDIO_SUBMIT ================== ERROR END ==================")
             log.error(f"[PdfxXBlock] STUDIO_SUBMIT - Error during processing: {e}")
             log.error(f"[PdfxXBlock] STUDIO_SUBMIT - Error type: {type(e).__name__}")
             import traceback
             log.error(f"[PdfxXBlock] STUDIO_SUBMIT - Full traceback: {traceback.format_exc()}")
             return self._json_response({'result': 'error', 'message': f'Failed to save settings: {str(e)}'})
 
+    @Metrics.timed('csrf.validate')
     def _validate_csrf_token(self, request):
         """Validate CSRF token for POST requests in Open edX context"""
         try:
-            log.info(f"[PdfxXBlock] _validate_csrf_token - Request type: {type(request)}")
-            log.info(f"[PdfxXBlock] _validate_csrf_token - Request dir: {[attr for attr in dir(request) if not attr.startswith('_')]}")
-
             # Get CSRF token from request headers - try multiple header formats
             csrf_token = None
+            token_source = None
             csrf_headers = ['X-CSRFToken', 'X-CSRF-Token', 'HTTP_X_CSRFTOKEN', 'HTTP_X_CSRF_TOKEN']
 
             # Check if request has headers attribute
@@ -1423,7 +1037,7 @@ class PdfxXBlock(XBlock):
                 for header_name in csrf_headers:
                     csrf_token = request.headers.get(header_name)
                     if csrf_token:
-                        log.info(f"[PdfxXBlock] Found CSRF token in header '{header_name}': {csrf_token[:8]}...")
+                        token_source = f'header:{header_name}'
                         break
 
             # If no headers attribute, try META (Django-style)
@@ -1431,7 +1045,7 @@ class PdfxXBlock(XBlock):
                 for header_name in csrf_headers:
                     csrf_token = request.META.get(header_name)
                     if csrf_token:
-                        log.info(f"[PdfxXBlock] Found CSRF token in META '{header_name}': {csrf_token[:8]}...")
+                        token_source = f'META:{header_name}'
                         break
 
             # Try accessing through webob request if available
@@ -1441,25 +1055,23 @@ class PdfxXBlock(XBlock):
                     environ_key = f'HTTP_{header_name.replace("-", "_").upper()}'
                     csrf_token = request.environ.get(environ_key)
                     if csrf_token:
-                        log.info(f"[PdfxXBlock] Found CSRF token in environ '{environ_key}': {csrf_token[:8]}...")
+                        token_source = f'environ:{environ_key}'
                         break
 
             if not csrf_token:
+                Metrics.incr('csrf.missing')
                 log.error(f"[PdfxXBlock] No CSRF token found in request")
-                log.error(f"[PdfxXBlock] Request headers available: {hasattr(request, 'headers')}")
-                log.error(f"[PdfxXBlock] Request META available: {hasattr(request, 'META')}")
-                log.error(f"[PdfxXBlock] Request environ available: {hasattr(request, 'environ')}")
-                if hasattr(request, 'headers'):
-                    log.error(f"[PdfxXBlock] Available headers: {list(request.headers.keys())}")
+                self._debug_event('csrf.missing', headers=lambda: list(request.headers.keys()) if hasattr(request, 'headers') else None)
                 return False
 
             # Try to get expected CSRF token from cookie
             expected_token = None
+            expected_source = None
 
             # Method 1: Try to get from cookies directly
             if hasattr(request, 'cookies') and 'csrftoken' in request.cookies:
                 expected_token = request.cookies['csrftoken']
-                log.info(f"[PdfxXBlock] Found expected token in cookies: {expected_token[:8]}...")
+                expected_source = 'cookies'
 
             # Method 2: Try Django's get_token if available
             if not expected_token:
@@ -1467,7 +1079,7 @@ class PdfxXBlock(XBlock):
                     from django.middleware.csrf import get_token
                     django_request = getattr(self.runtime, 'request', request)
                     expected_token = get_token(django_request)
-                    log.info(f"[PdfxXBlock] Got expected token from Django: {expected_token[:8]}...")
+                    expected_source = 'django'
                 except Exception as e:
                     log.warning(f"[PdfxXBlock] Could not get Django CSRF token: {e}")
 
@@ -1479,7 +1091,7 @@ class PdfxXBlock(XBlock):
                     match = re.search(r'csrftoken=([^;]+)', cookie_header)
                     if match:
                         expected_token = match.group(1)
-                        log.info(f"[PdfxXBlock] Parsed expected token from cookie header: {expected_token[:8]}...")
+                        expected_source = 'cookie_header'
 
             if not expected_token:
                 log.error(f"[PdfxXBlock] Could not retrieve expected CSRF token from any source")
@@ -1491,15 +1103,13 @@ class PdfxXBlock(XBlock):
 
             # Compare tokens
             token_valid = csrf_token == expected_token
-            log.info(f"[PdfxXBlock] CSRF token validation result: {token_valid}")
-            log.info(f"[PdfxXBlock] Received token: {csrf_token[:8]}...")
-            log.info(f"[PdfxXBlock] Expected token: {expected_token[:8]}...")
-
+            if not token_valid:
+                Metrics.incr('csrf.mismatch')
+            self._debug_event('csrf.validated', valid=token_valid, source=token_source, expected_source=expected_source)
             return token_valid
 
         except Exception as e:
             log.error(f"[PdfxXBlock] CSRF validation error: {e}")
-            log.error(f"[PdfxXBlock] Exception type: {type(e)}")
             import traceback
             log.error(f"[PdfxXBlock] Traceback: {traceback.format_exc()}")
             # In case of validation errors, be permissive for Open edX
@@ -1510,16 +1120,26 @@ class PdfxXBlock(XBlock):
         import json
         from webob import Response
 
+        with Metrics.timer('response.serialize'):
+            body = json.dumps(data)
         response = Response(
-            body=json.dumps(data),
+            body=body,
             content_type='application/json',
             charset='utf-8',
             status=status_code
         )
         return response
 
+    # Characters that could end or confuse a <script> element, as JSON escapes
+    SCRIPT_JSON_ESCAPES = {'<': '\\u003c', '>': '\\u003e', '&': '\\u0026'}
 
-
+    @classmethod
+    def _script_json(cls, data):
+        """Serialize data as compact JSON that is safe inside a <script type="application/json"> element"""
+        serialized = json.dumps(data, separators=(',', ':'))
+        for char, escape in cls.SCRIPT_JSON_ESCAPES.items():
+            serialized = serialized.replace(char, escape)
+        return serialized
 
     @XBlock.handler
     def save_annotations(self, request, suffix=''):
@@ -1531,15 +1151,9 @@ class PdfxXBlock(XBlock):
         - Different pages
         """
         import json
-        from webob import Response
 
-        log.info(f"[PdfxXBlock] 💾 save_annotations - START - Block: {self.location}")
-
-        # Validate CSRF token for POST requests
-        if request.method == 'POST':
-            if not self._validate_csrf_token(request):
-                log.error(f"[PdfxXBlock] 💾 save_annotations - CSRF validation failed")
-                return self._json_response({'result': 'error', 'message': 'CSRF validation failed'}, 403)
+        self._begin_request(request)
+        Metrics.incr(f'annotations.{request.method.lower()}')
 
         try:
             # Parse request data
@@ -1549,39 +1163,40 @@ class PdfxXBlock(XBlock):
             if request.method == 'GET':
                 # Load annotations
                 action = request.GET.get('action', 'load')
-                log.info(f"[PdfxXBlock] 💾 save_annotations - GET request, action: {action}")
-
-                if action == 'load':
-                    return self._handle_load_annotations(request)
 
             elif request.method == 'POST':
                 # Validate CSRF token for POST requests
-                log.info(f"[PdfxXBlock] 💾 save_annotations - Validating CSRF token for POST request")
                 if not self._validate_csrf_token(request):
                     log.error(f"[PdfxXBlock] 💾 save_annotations - CSRF validation failed")
                     return self._json_response({'result': 'error', 'message': 'CSRF validation failed'}, 403)
-                log.info(f"[PdfxXBlock] 💾 save_annotations - CSRF validation passed")
 
                 # Save annotations
-                if hasattr(request, 'body') and request.body:
-                    try:
-                        body_str = request.body.decode('utf-8') if isinstance(request.body, bytes) else str(request.body)
-                        data = json.loads(body_str)
-                        log.info(f"[PdfxXBlock] 💾 save_annotations - Parsed JSON data: {list(data.keys()) if isinstance(data, dict) else type(data)}")
-                    except json.JSONDecodeError as e:
-                        log.error(f"[PdfxXBlock] 💾 save_annotations - JSON decode error: {e}")
-                        return self._json_response({'result': 'error', 'message': 'Invalid JSON data'}, 400)
+                with Metrics.timer('annotations.parse'):
+                    if hasattr(request, 'body') and request.body:
+                        try:
+                            body_str = request.body.decode('utf-8') if isinstance(request.body, bytes) else str(request.body)
+                            data = json.loads(body_str)
+                        except json.JSONDecodeError as e:
+                            log.error(f"[PdfxXBlock] 💾 save_annotations - JSON decode error: {e}")
+                            return self._json_response({'result': 'error', 'message': 'Invalid JSON data'}, 400)
 
-                if not data and hasattr(request, 'POST'):
-                    data = dict(request.POST)
-                    log.info(f"[PdfxXBlock] 💾 save_annotations - Using POST data: {list(data.keys()) if isinstance(data, dict) else type(data)}")
+                    if not data and hasattr(request, 'POST'):
+                        data = dict(request.POST)
 
                 action = data.get('action', 'save') if data else 'save'
 
+            self._debug_event('annotations.request', method=request.method, action=action,
+                              keys=lambda: sorted(data) if isinstance(data, dict) else None,
+                              bytes=lambda: len(request.body or b''))
+
             if action == 'save':
-                return self._handle_save_annotations(request, data)
+                return self._handle_idempotent(request, data, self._handle_save_annotations)
+            elif action == 'apply_ops':
+                return self._handle_idempotent(request, data, self._handle_apply_ops)
             elif action == 'load':
                 return self._handle_load_annotations(request)
+            elif action == 'load_pages':
+                return self._handle_load_pages(request, data)
             else:
                 log.warning(f"[PdfxXBlock] 💾 save_annotations - Unknown action: {action}")
                 return self._json_response({'result': 'error', 'message': f'Unknown action: {action}'}, 400)
@@ -1592,71 +1207,552 @@ class PdfxXBlock(XBlock):
             log.error(f"[PdfxXBlock] 💾 save_annotations - Traceback: {traceback.format_exc()}")
             return self._json_response({'result': 'error', 'message': str(e)}, 500)
 
+    @XBlock.handler
+    def export_annotations(self, request, suffix=''):
+        """
+        Stream every student's annotations of this block as NDJSON or CSV (staff only).
+
+        Query parameters: format ('ndjson' or 'csv'), types (comma-separated
+        annotation types), pages ("first-last"), since and until (ISO 8601 dates).
+        """
+        import re
+        from webob import Response
+
+        self._begin_request(request)
+        if not self.is_staff_user():
+            log.warning(f"[PdfxXBlock] 📤 export_annotations - Refused for non-staff user")
+            return self._json_response({'result': 'error', 'message': 'Staff access required'}, 403)
+
+        params = request.GET
+        output_format = params.get('format', 'ndjson')
+        try:
+            exporter = AnnotationExporter.from_params(params)
+            rows = self._get_annotation_backend().iter_block(exporter.field_names)
+            chunks = exporter.stream(rows, output_format)
+        except (TypeError, ValueError) as e:
+            return self._json_response({'result': 'error', 'message': str(e)}, 400)
+        except ImportError:
+            log.error(f"[PdfxXBlock] 📤 export_annotations - Student states are only readable in the LMS")
+            return self._json_response({'result': 'error', 'message': 'Export is not available here'}, 501)
+
+        log.info(f"[PdfxXBlock] 📤 export_annotations - Streaming {output_format} export of {exporter.field_names}")
+        filename = re.sub(r'[^\w.-]+', '_', f"pdfx-annotations-{self.scope_ids.usage_id}.{output_format}")
+        response = Response(app_iter=chunks, content_type=AnnotationExporter.FORMATS[output_format], charset='utf-8')
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        response.headers['Cache-Control'] = 'private, no-store'
+        return response
+
+    @XBlock.handler
+    def browse_annotations(self, request, suffix=''):
+        """
+        Page through every student's annotations of this block (staff only).
+
+        Query parameters: limit (at most BROWSE_MAX_LIMIT), types (comma-separated
+        annotation types) and cursor, the nextCursor of the previous page.
+        Records are ordered by (user, page, id); nextCursor is null on the last page.
+        Browsing reads the index of the sqlite annotation backend, so it answers
+        501 when annotations are stored in fields.
+        """
+        self._begin_request(request)
+        if not self.is_staff_user():
+            log.warning(f"[PdfxXBlock] 🔎 browse_annotations - Refused for non-staff user")
+            return self._json_response({'success': False, 'error': 'Staff access required'}, 403)
+
+        params = request.GET
+        try:
+            limit = min(BROWSE_MAX_LIMIT, max(1, int(params.get('limit') or BROWSE_DEFAULT_LIMIT)))
+            after = AnnotationCursor.decode(params['cursor']) if params.get('cursor') else None
+            field_names = AnnotationExporter.from_params({'types': params.get('types')}).field_names
+        except (TypeError, ValueError) as e:
+            return self._json_response({'success': False, 'error': str(e)}, 400)
+
+        try:
+            rows, next_key = self._get_annotation_backend().browse(field_names, after, limit)
+        except NotImplementedError as e:
+            log.error(f"[PdfxXBlock] 🔎 browse_annotations - {e}")
+            return self._json_response({'success': False, 'error': str(e)}, 501)
+        except ImportError:
+            log.error(f"[PdfxXBlock] 🔎 browse_annotations - Student states are only readable in the LMS")
+            return self._json_response({'success': False, 'error': 'Browsing is not available here'}, 501)
+
+        log.info(f"[PdfxXBlock] 🔎 browse_annotations - Returning {len(rows)} records")
+        return self._json_response({
+            'success': True,
+            'records': [
+                {'user': user, 'type': field_name, 'page': page_key, 'annotation': annotation}
+                for user, field_name, page_key, annotation in rows
+            ],
+            'nextCursor': AnnotationCursor.encode(next_key) if next_key else None,
+            'limit': limit
+        })
+
+    @XBlock.handler
+    def rebuild_heatmap(self, request, suffix=''):
+        """
+        Recount the class highlight heatmap from every student's stored highlights (staff only).
+
+        Saves keep the heatmap current, but concurrent saves can lose counts and
+        highlights saved before the heatmap existed are not in it.
+        """
+        self._begin_request(request)
+        if not self.is_staff_user():
+            log.warning(f"[PdfxXBlock] 🔥 rebuild_heatmap - Refused for non-staff user")
+            return self._json_response({'success': False, 'error': 'Staff access required'}, 403)
+
+        heatmap = HighlightHeatmap({})
+        try:
+            with Metrics.timer('heatmap.rebuild'):
+                counted = heatmap.rebuild(self._get_annotation_backend().iter_block(['highlights']))
+        except ImportError:
+            log.error(f"[PdfxXBlock] 🔥 rebuild_heatmap - Student states are only readable in the LMS")
+            return self._json_response({'success': False, 'error': 'Rebuilding is not available here'}, 501)
+
+        self.highlight_heatmap = heatmap.pages
+        self.save()
+        log.info(f"[PdfxXBlock] 🔥 rebuild_heatmap - Counted {counted} highlights on {len(heatmap.pages)} pages")
+        return self._json_response({'success': True, 'highlights': counted, 'heatmap': heatmap.pages})
+
+    @XBlock.handler
+    @Metrics.timed('search_pdf')
+    def search_pdf(self, request, suffix=''):
+        """
+        Search the text of the uploaded PDF.
+
+        Query parameters: q (the words to find, all on one page) and limit
+        (at most SEARCH_MAX_LIMIT). Returns the matching pages in page order,
+        each with a snippet around the first match, and the total match count.
+        """
+        self._begin_request(request)
+        params = request.GET
+        query = (params.get('q') or '').strip()
+        try:
+            limit = min(SEARCH_MAX_LIMIT, max(1, int(params.get('limit') or SEARCH_DEFAULT_LIMIT)))
+        except (TypeError, ValueError) as e:
+            return self._json_response({'success': False, 'error': str(e)}, 400)
+        if not query:
+            return self._json_response({'success': False, 'error': 'Missing query'}, 400)
+        if not self.pdf_search_index:
+            return self._json_response({'success': False, 'error': 'This PDF has no search index'}, 404)
+
+        try:
+            with Metrics.timer('search_pdf.load'):
+                index = PdfTextIndex.load(self.pdf_search_index, lambda: self._read_asset(self.pdf_search_index))
+        except ImportError:
+            return self._json_response({'success': False, 'error': 'Search is not available here'}, 501)
+        except Exception as e:
+            log.error(f"[PdfxXBlock] 🔎 search_pdf - Could not load the search index: {e}")
+            return self._json_response({'success': False, 'error': 'Search index not found'}, 404)
+
+        matches, total = PdfTextIndex.search(index, query, limit)
+        self._debug_event('search_pdf.done', terms=lambda: len(PdfTextIndex.tokenize(query)), total=total)
+        return self._json_response({'success': True, 'query': query, 'matches': matches, 'total': total})
+
+    @XBlock.handler
+    @Metrics.timed('text_layer')
+    def text_layer(self, request, suffix=''):
+        """
+        Get the precomputed text runs of one page of the uploaded PDF: ?page=n.
+
+        Each run is [text, a, b, c, d, e, f, width] (see PdfTextLayer). student_view
+        puts the layer's asset name in the suffix; the name carries the PDF's
+        content hash, so responses for the current name are cached for PDF_CACHE_MAX_AGE.
+        """
+        from webob import Response
+
+        self._begin_request(request)
+        if not self.pdf_text_layer:
+            return self._json_response({'success': False, 'error': 'This PDF has no text layer'}, 404)
+        try:
+            page = int(request.GET.get('page'))
+        except (TypeError, ValueError):
+            return self._json_response({'success': False, 'error': 'Invalid page'}, 400)
+
+        try:
+            with Metrics.timer('text_layer.load'):
+                layer = PdfTextLayer.load(self.pdf_text_layer, lambda: self._read_asset(self.pdf_text_layer))
+        except ImportError:
+            return self._json_response({'success': False, 'error': 'The contentstore is only available in Open edX'}, 501)
+        except Exception as e:
+            log.error(f"[PdfxXBlock] 📄 text_layer - Could not load the text layer: {e}")
+            return self._json_response({'success': False, 'error': 'Text layer not found'}, 404)
+        if not 1 <= page <= len(layer['pages']):
+            return self._json_response({'success': False, 'error': 'No such page'}, 404)
+
+        asset_name = self.pdf_text_layer.rsplit('@', 1)[-1]
+        etag = f'"{asset_name}-{page}"'
+        if suffix == asset_name:
+            # Private: the text is the content of the PDF, served to enrolled users
+            cache_control = f'private, max-age={PDF_CACHE_MAX_AGE}, immutable'
+        else:
+            cache_control = 'private, no-cache'
+        headers = {'ETag': etag, 'Cache-Control': cache_control}
+
+        not_modified = etag.strip('"') in request.if_none_match  # webob compares unquoted tags
+        self._debug_event('text_layer.done', page=page, not_modified=not_modified, immutable=suffix == asset_name)
+        if not_modified:
+            Metrics.incr('text_layer.not_modified')
+            response = Response(status=304)
+        else:
+            body = json.dumps({'page': page, 'runs': layer['pages'][page - 1]}, separators=(',', ':'))
+            response = Response(body=body.encode('utf-8'), content_type='application/json', charset='utf-8')
+        response.headers.update(headers)
+        return response
+
+    @XBlock.handler
+    def instrumentation(self, request, suffix=''):
+        """
+        Get this process's handler timers and counters (staff only).
+
+        Timers are named after the handler phase, e.g. save.merge or
+        student_view.render. Query parameter reset=1 clears them after reading.
+        """
+        self._begin_request(request)
+        if not self.is_staff_user():
+            return self._json_response({'success': False, 'error': 'Staff access required'}, 403)
+
+        snapshot = Metrics.snapshot()
+        if request.GET.get('reset') in ('1', 'true'):
+            Metrics.reset()
+        return self._json_response({'success': True, **snapshot})
+
+    @XBlock.handler
+    def serve_pdf(self, request, suffix=''):
+        """
+        Stream the uploaded PDF from the contentstore, with byte-range support.
+
+        pdf.js fetches large documents in ranges, so the first pages render
+        before the whole file arrives. Honors Range (a single range), If-Range
+        and If-None-Match. get_pdf_url puts the asset name in the suffix. The
+        name is derived from the file's content hash, so the bytes behind a
+        name never change (re-uploading the same file keeps the same name) and
+        responses for the current name are cached for PDF_CACHE_MAX_AGE.
+        """
+        from webob import Response
+
+        asset_path = self._pdf_asset_path()
+        if not asset_path:
+            return self._json_response({'success': False, 'error': 'No uploaded PDF'}, 404)
+        try:
+            content = self._find_pdf_asset(asset_path)
+        except ImportError:
+            return self._json_response({'success': False, 'error': 'The contentstore is only available in Open edX'}, 501)
+        except Exception as e:
+            log.warning(f"[PdfxXBlock] 📄 serve_pdf - Asset {asset_path} not found: {e}")
+            return self._json_response({'success': False, 'error': 'PDF not found'}, 404)
+
+        etag = AssetStream.etag(content)
+        last_modified = AssetStream.http_date(getattr(content, 'last_modified_at', None))
+        if suffix and suffix == asset_path.rsplit('@', 1)[-1]:
+            visibility = 'private' if getattr(content, 'locked', False) else 'public'
+            cache_control = f'{visibility}, max-age={PDF_CACHE_MAX_AGE}, immutable'
+        else:
+            cache_control = 'private, no-cache'  # Old or missing asset name: revalidate
+        headers = {'ETag': etag, 'Accept-Ranges': 'bytes', 'Cache-Control': cache_control}
+        if last_modified:
+            headers['Last-Modified'] = last_modified
+
+        if etag.strip('"') in request.if_none_match:  # webob compares unquoted tags
+            Metrics.incr('serve_pdf.not_modified')
+            response = Response(status=304)
+            response.headers.update(headers)
+            return response
+
+        length = content.length
+        byte_range = None
+        if AssetStream.if_range_matches(request.headers.get('If-Range'), etag, last_modified):
+            try:
+                byte_range = AssetStream.parse_range(request.headers.get('Range'), length)
+            except ValueError:
+                response = Response(status=416)
+                response.headers.update(headers)
+                response.headers['Content-Range'] = f'bytes */{length}'
+                return response
+
+        first, last = byte_range or (0, length - 1)
+        response = Response(
+            status=206 if byte_range else 200,
+            content_type='application/pdf',
+            app_iter=AssetStream.iter_range(content, first, last) if length else [b''],
+            conditional_response=False
+        )
+        response.headers.update(headers)
+        response.content_length = last - first + 1 if length else 0
+        if byte_range:
+            response.headers['Content-Range'] = f'bytes {first}-{last}/{length}'
+        Metrics.incr('serve_pdf.partial' if byte_range else 'serve_pdf.full')
+        self._debug_event('serve_pdf', asset=asset_path, range=byte_range, length=length)
+        return response
+
+    def _pdf_asset_path(self):
+        """Get the contentstore asset key string of the uploaded PDF, or '' without one"""
+        from urllib.parse import urlparse
+        asset_url = (getattr(self, 'pdf_file_asset_key', '') or '').strip()
+        return urlparse(asset_url).path.lstrip('/') if asset_url else ''
+
+    def _find_pdf_asset(self, asset_path):
+        """Open the uploaded PDF in the contentstore as a stream (raises ImportError outside Open edX)"""
+        from xmodule.contentstore.django import contentstore
+        from opaque_keys.edx.keys import AssetKey
+        return contentstore().find(AssetKey.from_string(asset_path), as_stream=True)
+
+    def _ingest_pdf_upload(self, pdf_upload, filename, timer_name):
+        """
+        Store an uploaded PDF and record what the viewer needs before opening it.
+
+        Returns (asset_url, deduplicated). Raises ImportError outside Open edX.
+        """
+        asset_url, deduplicated = self._store_pdf_upload(pdf_upload, filename, timer_name)
+        with Metrics.timer('upload.analyze'):
+            self.pdf_analysis = self._analyze_pdf_upload(pdf_upload, reuse=deduplicated)
+        with Metrics.timer('upload.text'):
+            self.pdf_search_index, self.pdf_text_layer = self._store_text_assets(
+                pdf_upload, index=self._get_setting('index_pdf_text'), layer=self._get_setting('render_text_layer')
+            )
+        return asset_url, deduplicated
+
+    def _analyze_pdf_upload(self, pdf_upload, reuse=True):
+        """
+        Analyze an uploaded PDF once per content hash, keeping the analysis as a course asset next to it.
+
+        With reuse, a stored analysis of the same content is returned without parsing the PDF again.
+        An empty analysis (no pypdf, or a PDF it cannot parse) is not stored.
+        """
+        from xmodule.contentstore.django import contentstore
+        from xmodule.contentstore.content import StaticContent
+
+        content_store = contentstore()
+        asset_path = f"pdfs_{pdf_upload.sha256[:PDF_ASSET_HASH_LENGTH]}.analysis.json.gz"
+        asset_key = StaticContent.compute_location(self.location.course_key, asset_path)
+        if reuse and self._has_asset(content_store, asset_key):
+            try:
+                analysis = DerivedAsset.load(str(asset_key), lambda: content_store.find(asset_key).data)
+                Metrics.incr('upload.analysis_reused')
+                return analysis
+            except (OSError, EOFError, ValueError) as e:
+                log.warning(f"[PdfxXBlock] Stored PDF analysis unreadable, analyzing again: {e}")
+
+        analysis = PdfAnalyzer.analyze(pdf_upload.spool)
+        if analysis:
+            data = DerivedAsset.dumps(analysis)
+            content_store.save(StaticContent(asset_key, asset_path, 'application/gzip', data, length=len(data)))
+        return analysis
+
+    def _store_text_assets(self, pdf_upload, index=True, layer=True):
+        """
+        Store the search index and text layer of an uploaded PDF as course assets, once per content hash.
+
+        The text is extracted in one pass, and only when an asset is missing.
+        Returns (index key, layer key); a key is '' if not asked for or the PDF has no text.
+        """
+        from xmodule.contentstore.django import contentstore
+        from xmodule.contentstore.content import StaticContent
+
+        content_store = contentstore()
+        prefix = f"pdfs_{pdf_upload.sha256[:PDF_ASSET_HASH_LENGTH]}"
+        assets = {}
+        if index:
+            assets['index'] = f"{prefix}.index.json.gz"
+        if layer:
+            assets['layer'] = f"{prefix}.text.json.gz"
+        keys = {name: StaticContent.compute_location(self.location.course_key, path) for name, path in assets.items()}
+        missing = [name for name, key in keys.items() if not self._has_asset(content_store, key)]
+
+        if missing:
+            pages = PdfTextLayer.extract(pdf_upload.spool, runs='layer' in missing)
+            built = {
+                'index': lambda: PdfTextIndex.build([text for text, _ in pages]),
+                'layer': lambda: PdfTextLayer.build([runs for _, runs in pages]),
+            }
+            for name in missing:
+                value = built[name]()
+                if value is None:
+                    del keys[name]  # No text, e.g. a scan
+                    continue
+                data = DerivedAsset.dumps(value)
+                content_store.save(StaticContent(keys[name], assets[name], 'application/gzip', data, length=len(data)))
+
+        return str(keys.get('index', '')), str(keys.get('layer', ''))
+
+    @staticmethod
+    def _has_asset(content_store, asset_key, check=None):
+        """
+        Check that a course asset exists, and passes check(stream) if given, closing its stream.
+
+        Without a check, an empty asset counts as missing.
+        """
+        existing = content_store.find(asset_key, throw_on_not_found=False, as_stream=True)
+        if existing is None:
+            return False
+        try:
+            return check(existing) if check else existing.length > 0
+        finally:
+            existing.close()
+
+    def _read_asset(self, asset_key):
+        """Read a course asset whole (raises ImportError outside Open edX)"""
+        from xmodule.contentstore.django import contentstore
+        from opaque_keys.edx.keys import AssetKey
+        return contentstore().find(AssetKey.from_string(asset_key)).data
+
+    def _store_pdf_upload(self, pdf_upload, filename, timer_name):
+        """
+        Store an uploaded PDF as a course asset named after its SHA-256.
+
+        If the course already has the asset, it is reused without a second write.
+        Returns (asset_url, deduplicated). Raises ImportError outside Open edX.
+        """
+        from xmodule.contentstore.django import contentstore
+        from xmodule.contentstore.content import StaticContent
+
+        course_key = self.location.course_key
+        content_store = contentstore()
+        asset_path = f"pdfs_{pdf_upload.sha256[:PDF_ASSET_HASH_LENGTH]}.pdf"
+        asset_key = StaticContent.compute_location(course_key, asset_path)
+
+        deduplicated = self._has_asset(content_store, asset_key, pdf_upload.matches)
+        if deduplicated:
+            Metrics.incr('upload.deduplicated')
+        else:
+            # Create the static content from the one buffer or the spooled file
+            content = StaticContent(asset_key, filename, 'application/pdf', pdf_upload.data, length=pdf_upload.size)
+            with Metrics.timer(timer_name):
+                content_store.save(content)
+
+        # Generate the asset URL (same pattern as example-pdf.py)
+        try:
+            asset_url = StaticContent.serialize_asset_key_with_slash(asset_key)
+        except Exception as url_error:
+            log.error(f"[PdfxXBlock] Error generating asset URL: {url_error}")
+            asset_url = None
+        if not asset_url:
+            # Fallback to basic URL format
+            asset_url = f"/asset-v1:{str(course_key)}+type@asset+block@{asset_path}"
+        return asset_url, deduplicated
+
+    def _handle_idempotent(self, request, data, handler):
+        """
+        Run a save handler at most once per client idempotency key.
+
+        The key comes from 'idempotencyKey' in the body or the Idempotency-Key
+        header. Successful responses are remembered per block and user with a
+        digest of the request, and a retry with the same key gets the stored
+        response without touching fields. A key reused for another request
+        (another action or body) is refused with 422 rather than answered with
+        a response that does not belong to it.
+        """
+        idempotency_key = data.get('idempotencyKey') if isinstance(data, dict) else None
+        idempotency_key = idempotency_key or request.headers.get('Idempotency-Key')
+        if not idempotency_key:
+            return handler(request, data)
+        if not isinstance(idempotency_key, str) or len(idempotency_key) > 128:
+            return self._json_response({'result': 'error', 'message': 'Invalid idempotency key'}, 400)
+
+        store = IdempotencyStore.default()
+        user_id = self._get_request_context().user_id
+        store_key = IdempotencyStore.make_key(self.scope_ids.usage_id, user_id, idempotency_key)
+
+        request_digest = IdempotencyStore.request_digest(data)
+
+        stored = store.get(store_key)
+        if stored and stored.get('request') != request_digest:
+            log.warning(f"[PdfxXBlock] 💾 _handle_idempotent - Idempotency key {idempotency_key} reused for another request")
+            return self._json_response({
+                'result': 'error', 'message': 'Idempotency key was already used for a different request'
+            }, 422)
+        if stored:
+            log.info(f"[PdfxXBlock] 💾 _handle_idempotent - Replaying response for idempotency key {idempotency_key}")
+            response = self._json_response(json.loads(stored['body']), stored['status'])
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        response = handler(request, data)
+        if 200 <= response.status_code < 300:
+            store.set(store_key, {
+                'status': response.status_code, 'body': response.body.decode('utf-8'), 'request': request_digest
+            })
+        return response
+
     def _handle_save_annotations(self, request, data):
         """Handle saving annotations with proper validation and storage"""
-        log.info(f"[PdfxXBlock] 💾 _handle_save_annotations - Processing save request")
-
         if not data:
             log.warning(f"[PdfxXBlock] 💾 _handle_save_annotations - No data received")
             return self._json_response({'result': 'error', 'message': 'No data received'}, 400)
 
         try:
             # Extract and validate required fields
-            user_id = data.get('userId', self.get_user_info().get('id', 'anonymous'))
+            current_user_id = self._get_request_context().user_id
+            user_id = data.get('userId', current_user_id)
             course_id = data.get('courseId', str(self.location.course_key) if hasattr(self.location, 'course_key') else '')
             block_id = data.get('blockId', str(self.location) if hasattr(self.location, 'usage_id') else '')
-
-            log.info(f"[PdfxXBlock] 💾 _handle_save_annotations - Context: user={user_id}, course={course_id}, block={block_id}")
+            self._debug_event('save.received', user=user_id, course=course_id, block=block_id)
 
             # Validate that this is the correct user (prevent data tampering)
-            current_user_id = self.get_user_info().get('id', 'anonymous')
             if user_id != current_user_id:
                 log.error(f"[PdfxXBlock] 💾 _handle_save_annotations - User ID mismatch: provided={user_id}, actual={current_user_id}")
                 return self._json_response({'result': 'error', 'message': 'User ID mismatch'}, 403)
 
             annotation_data = data.get('data', {})
             deletions = data.get('deletions', [])
+            self._stroke_stats = {'pointsIn': 0, 'pointsOut': 0}
 
-            # Handle deletions first
-            if deletions:
-                log.info(f"[PdfxXBlock] 💾 _handle_save_annotations - Processing {len(deletions)} deletions")
-                self._handle_deletions(deletions)
+            with Metrics.timer('save.validate'):
+                conflict_response, merged_pages = self._check_base_revision(
+                    data, self._save_request_changes(annotation_data, deletions)
+                )
+            if conflict_response:
+                return conflict_response
 
-            if not annotation_data:
-                if deletions:
-                    # Only deletions, no new data
-                    log.info(f"[PdfxXBlock] 💾 _handle_save_annotations - Only deletions processed")
-                else:
-                    log.warning(f"[PdfxXBlock] 💾 _handle_save_annotations - No annotation data provided")
-                    return self._json_response({'result': 'error', 'message': 'No annotation data provided'}, 400)
+            if not annotation_data and not deletions:
+                log.warning(f"[PdfxXBlock] 💾 _handle_save_annotations - No annotation data provided")
+                return self._json_response({'result': 'error', 'message': 'No annotation data provided'}, 400)
 
-            log.info(f"[PdfxXBlock] 💾 _handle_save_annotations - Received annotation types: {list(annotation_data.keys())}")
+            # Refuse pages the backend cannot store before changing anything
+            invalid_pages = self._invalid_save_pages(annotation_data)
+            if invalid_pages:
+                log.warning(f"[PdfxXBlock] 💾 _handle_save_annotations - Invalid pages: {invalid_pages}")
+                return self._json_response({
+                    'result': 'error',
+                    'message': f'Invalid pages: {", ".join(invalid_pages)}',
+                    'invalidPages': invalid_pages
+                }, 400)
 
-            # Process each annotation type
             saved_types = []
-            for annotation_type, type_data in annotation_data.items():
-                try:
-                    success = self._save_annotation_type(annotation_type, type_data)
-                    if success:
-                        saved_types.append(annotation_type)
-                        log.info(f"[PdfxXBlock] 💾 _handle_save_annotations - Saved {annotation_type}: {len(type_data) if isinstance(type_data, dict) else 'N/A'} items")
-                except Exception as e:
-                    log.error(f"[PdfxXBlock] 💾 _handle_save_annotations - Error saving {annotation_type}: {e}")
+            saved_ids = []
+            limit_exceeded = None
+            with Metrics.timer('save.merge'):
+                # Handle deletions first
+                if deletions:
+                    self._handle_deletions(deletions)
 
-            # Update current page if provided
-            if 'currentPage' in annotation_data:
-                try:
-                    page_num = int(annotation_data['currentPage'])
-                    if page_num != self.current_page:
-                        self.current_page = page_num
-                        log.info(f"[PdfxXBlock] 💾 _handle_save_annotations - Updated current page: {self.current_page}")
-                except (ValueError, TypeError):
-                    log.warning(f"[PdfxXBlock] 💾 _handle_save_annotations - Invalid current page value: {annotation_data['currentPage']}")
+                # Process each annotation type
+                for annotation_type, type_data in annotation_data.items():
+                    try:
+                        success = self._save_annotation_type(annotation_type, type_data, saved_ids)
+                        if success:
+                            saved_types.append(annotation_type)
+                    except AnnotationLimitError as e:
+                        log.warning(f"[PdfxXBlock] 💾 _handle_save_annotations - Refused {annotation_type}: {e}")
+                        limit_exceeded = e.to_dict()
+                        break
+                    except Exception as e:
+                        log.error(f"[PdfxXBlock] 💾 _handle_save_annotations - Error saving {annotation_type}: {e}")
 
-            # Save all changes to the XBlock
+                # Update current page if provided
+                if 'currentPage' in annotation_data:
+                    try:
+                        page_num = int(annotation_data['currentPage'])
+                        if page_num != self.current_page:
+                            self.current_page = page_num
+                    except (ValueError, TypeError):
+                        log.warning(f"[PdfxXBlock] 💾 _handle_save_annotations - Invalid current page value: {annotation_data['currentPage']}")
+
+            # Save all changes to the XBlock; a save refused before changing anything keeps the revision
+            if not limit_exceeded or saved_types or saved_ids or deletions:
+                self._bump_revision()
             try:
-                self.save()
-                log.info(f"[PdfxXBlock] 💾 _handle_save_annotations - XBlock saved successfully")
+                with Metrics.timer('save.save'):
+                    self._get_annotation_backend().commit()
+                    self.save()
             except Exception as e:
                 log.error(f"[PdfxXBlock] 💾 _handle_save_annotations - Error saving XBlock: {e}")
 
@@ -1664,20 +1760,308 @@ class PdfxXBlock(XBlock):
                 'result': 'success',
                 'message': f'Annotations saved successfully: {", ".join(saved_types)}',
                 'saved_types': saved_types,
+                'savedIds': saved_ids,
                 'deletions_processed': len(deletions),
+                'strokePoints': self._stroke_stats,
                 'currentPage': self.current_page,
+                'revision': self.annotation_revision,
+                'mergedPages': merged_pages,
+                'usage': self._get_annotation_usage().to_dict(),
                 'timestamp': int(time.time() * 1000)
             }
 
-            log.info(f"[PdfxXBlock] 💾 _handle_save_annotations - Success: {len(saved_types)} types saved, {len(deletions)} deletions processed")
+            if limit_exceeded:
+                # Annotations saved before the limit was reached are kept, and listed in savedIds
+                response_data.update(result='error', message=limit_exceeded['message'], error=limit_exceeded)
+                return self._json_response(response_data, 413)
+
+            self._debug_event('save.done', types=saved_types, deletions=len(deletions),
+                              revision=self.annotation_revision, strokePoints=self._stroke_stats)
             return self._json_response(response_data, 200)
 
         except Exception as e:
             log.error(f"[PdfxXBlock] 💾 _handle_save_annotations - Error processing save: {e}")
+            self._get_annotation_backend().rollback()
             import traceback
             log.error(f"[PdfxXBlock] 💾 _handle_save_annotations - Traceback: {traceback.format_exc()}")
             return self._json_response({'result': 'error', 'message': str(e)}, 500)
 
+    def _invalid_save_pages(self, annotation_data):
+        """Get the pages of a legacy save that the annotation backend cannot store, as 'type/page' strings"""
+        backend = self._get_annotation_backend()
+        invalid = []
+        for annotation_type, type_data in annotation_data.items():
+            if annotation_type == 'clear_action' or not isinstance(type_data, dict):
+                continue
+            for page_key, page_data in type_data.items():
+                # Opaque page data has no annotation ids, so only the fields can hold it
+                opaque = not isinstance(page_data, list) and not isinstance(backend, FieldAnnotationBackend)
+                if opaque or not backend.accepts_page(str(page_key)):
+                    invalid.append(f'{annotation_type}/{page_key}')
+        return invalid
+
+    def _handle_apply_ops(self, request, data):
+        """
+        Apply an ordered list of annotation operations (delta sync).
+
+        Each operation is a dict such as:
+            {'op': 'add' | 'update', 'id': ..., 'type': ..., 'page': ..., 'annotation': {...}}
+            {'op': 'delete', 'id': ..., 'type': ..., 'page': ...}
+            {'op': 'clear', 'page': ...}  (omit 'page' to clear everything)
+
+        Only the touched page lists are modified, so the cost of a save is
+        proportional to the number of operations, not to the stored state.
+        """
+        if not data:
+            return self._json_response({'result': 'error', 'message': 'No data received'}, 400)
+
+        try:
+            current_user_id = self._get_request_context().user_id
+            user_id = data.get('userId', current_user_id)
+            if user_id != current_user_id:
+                log.error(f"[PdfxXBlock] 💾 _handle_apply_ops - User ID mismatch: provided={user_id}, actual={current_user_id}")
+                return self._json_response({'result': 'error', 'message': 'User ID mismatch'}, 403)
+
+            operations = data.get('ops')
+            if not isinstance(operations, list):
+                return self._json_response({'result': 'error', 'message': 'ops must be a list'}, 400)
+
+            with Metrics.timer('apply_ops.validate'):
+                conflict_response, merged_pages = self._check_base_revision(data, [
+                    (operation.get('op'), operation.get('id'), operation.get('page'))
+                    for operation in operations if isinstance(operation, dict)
+                ])
+            if conflict_response:
+                return conflict_response
+
+            current_time = int(time.time() * 1000)
+            applied = 0
+            rejected = []
+            self._stroke_stats = {'pointsIn': 0, 'pointsOut': 0}
+
+            limit_exceeded = None
+
+            with Metrics.timer('apply_ops.merge'):
+                for index, operation in enumerate(operations):
+                    try:
+                        error = self._apply_annotation_op(operation, current_user_id, current_time)
+                    except AnnotationLimitError as e:
+                        log.warning(f"[PdfxXBlock] 💾 _handle_apply_ops - Rejected operation {index}: {e}")
+                        limit_exceeded = e.to_dict()
+                        rejected.append({
+                            'index': index,
+                            'id': operation.get('id'),
+                            'code': limit_exceeded['code'],
+                            'message': str(e)
+                        })
+                        continue
+                    if error:
+                        rejected.append({
+                            'index': index,
+                            'id': operation.get('id') if isinstance(operation, dict) else None,
+                            'message': error
+                        })
+                    else:
+                        applied += 1
+            Metrics.incr('apply_ops.applied', applied)
+            Metrics.incr('apply_ops.rejected', len(rejected))
+
+            changed = applied > 0
+            if 'currentPage' in data:
+                try:
+                    page_num = int(data['currentPage'])
+                    if page_num != self.current_page:
+                        self.current_page = page_num
+                        changed = True
+                except (ValueError, TypeError):
+                    log.warning(f"[PdfxXBlock] 💾 _handle_apply_ops - Invalid current page value: {data['currentPage']}")
+
+            if changed:
+                self._bump_revision()
+            with Metrics.timer('apply_ops.save'):
+                self._get_annotation_backend().commit()
+                self.save()
+
+            self._debug_event('apply_ops.done', applied=applied, rejected=rejected, revision=self.annotation_revision)
+            return self._json_response({
+                'result': 'success',
+                'applied': applied,
+                'rejected': rejected,
+                'strokePoints': self._stroke_stats,
+                'currentPage': self.current_page,
+                'revision': self.annotation_revision,
+                'mergedPages': merged_pages,
+                'usage': self._get_annotation_usage().to_dict(),
+                'limitExceeded': limit_exceeded,
+                'timestamp': current_time
+            })
+
+        except Exception as e:
+            log.error(f"[PdfxXBlock] 💾 _handle_apply_ops - Error applying operations: {e}")
+            self._get_annotation_backend().rollback()
+            import traceback
+            log.error(f"[PdfxXBlock] 💾 _handle_apply_ops - Traceback: {traceback.format_exc()}")
+            return self._json_response({'result': 'error', 'message': str(e)}, 500)
+
+    def _apply_annotation_op(self, operation, user_id, current_time):
+        """Apply a single delta operation in place. Returns an error message or None."""
+        if not isinstance(operation, dict):
+            return 'Operation must be an object'
+
+        op = operation.get('op')
+        if op not in ANNOTATION_OPERATIONS:
+            return f'Unknown operation: {op}'
+
+        page_num = operation.get('page')
+        if op == 'clear':
+            if page_num:
+                self._clear_page_annotations(page_num)
+            else:
+                self._clear_all_annotations()
+            return None
+
+        annotation_id = operation.get('id')
+        field_name = ANNOTATION_FIELD_MAPPING.get(operation.get('type'))
+        if not annotation_id:
+            return 'Missing annotation id'
+        if not field_name:
+            return f"Unknown annotation type: {operation.get('type')}"
+        try:
+            page_key = str(int(page_num))
+        except (ValueError, TypeError):
+            return f'Invalid page: {page_num}'
+
+        if op == 'delete':
+            self._remove_annotation(annotation_id)
+            return None
+
+        annotation = operation.get('annotation')
+        if not isinstance(annotation, dict):
+            return 'Missing annotation payload'
+        annotation = dict(annotation, id=annotation_id)
+        self._upsert_annotation(
+            field_name, page_key,
+            self._clean_annotation(annotation, user_id, current_time, annotation_id)
+        )
+        return None
+
+    def _get_annotation_backend(self):
+        """
+        Get the storage backend chosen by the annotation_backend setting.
+
+        The sqlite backend is used once pdfx-migrate-annotations has moved every
+        student's field annotations of the block into the database; until then
+        the block keeps the fields, so no read misses students not yet moved.
+        """
+        backend = getattr(self, '_annotation_backend', None)
+        if backend is not None:
+            return backend
+
+        backend = FieldAnnotationBackend(self)
+        if self._get_setting('annotation_backend') == 'sqlite':
+            usage_id = self.scope_ids.usage_id
+            course_id = getattr(usage_id, 'course_key', '')
+            path = self._annotation_db_path()
+            if SqliteAnnotationBackend.is_migrated(path, course_id, usage_id):
+                backend = SqliteAnnotationBackend(path, course_id, usage_id, self.scope_ids.user_id)
+            elif str(usage_id) not in self._unmigrated_warned:
+                self._unmigrated_warned.add(str(usage_id))
+                log.warning(f"[PdfxXBlock] 💾 _get_annotation_backend - {usage_id} keeps field storage "
+                            f"until pdfx-migrate-annotations moves it to SQLite")
+
+        self._annotation_backend = backend
+        return backend
+
+    def _annotation_db_path(self):
+        """
+        Get the database file of the sqlite backend as an absolute path.
+
+        A relative annotation_db_path is resolved against the platform's
+        DATA_DIR, never against the current directory of the worker.
+        """
+        path = self._get_setting('annotation_db_path')
+        if os.path.isabs(path):
+            return path
+        try:
+            from django.conf import settings
+            data_dir = getattr(settings, 'DATA_DIR', None)
+        except Exception:  # Django missing or not configured
+            data_dir = None
+        if not data_dir:
+            raise ValueError(f"annotation_db_path must be an absolute path without a DATA_DIR setting: {path}")
+        return os.path.join(str(data_dir), path)
+
+    def _upsert_annotation(self, field_name, page_key, annotation):
+        """Insert or replace one annotation on one page of a field, in place"""
+        if field_name in STROKE_FIELDS:
+            tolerance = self._get_setting('stroke_simplify_tolerance')
+            if tolerance:
+                annotation, points_in, points_out = StrokeSimplifier.simplify_annotation(annotation, tolerance)
+                stroke_stats = getattr(self, '_stroke_stats', None)
+                if stroke_stats is not None:
+                    stroke_stats['pointsIn'] += points_in
+                    stroke_stats['pointsOut'] += points_out
+            if self._get_setting('compact_strokes'):
+                annotation = StrokeCodec.encode_annotation(annotation, self._get_setting('stroke_precision'))
+
+        annotation = dict(annotation, revision=self.annotation_revision + 1)
+        backend = self._get_annotation_backend()
+        stored = backend.get(annotation['id'])
+
+        # Check the limits before touching anything, so a refused save changes nothing
+        usage = self._get_annotation_usage()
+        count_delta, bytes_delta = 1, AnnotationUsage.measure(annotation)
+        if stored:
+            count_delta = 0
+            bytes_delta -= AnnotationUsage.measure(stored[2])
+        usage.check(count_delta, bytes_delta)
+
+        if stored:
+            self._touch_page(stored[1])
+        self._touch_page(page_key)
+        replaced = backend.upsert(field_name, page_key, annotation)
+        usage.apply(count_delta, bytes_delta)
+        if stored and stored[0] == 'highlights':
+            self._update_heatmap(stored[1], stored[2], -1)
+        if field_name == 'highlights':
+            self._update_heatmap(page_key, annotation, 1)
+        return replaced
+
+    def _remove_annotation(self, annotation_id):
+        """Remove one annotation by id, in place. Returns the removed annotation or None."""
+        backend = self._get_annotation_backend()
+        stored = backend.get(annotation_id)
+        if not stored:
+            return None
+        self._touch_page(stored[1])
+        removed = backend.remove(annotation_id)
+        self._discard_annotations(stored[0], stored[1], [removed])
+        return removed
+
+    def _discard_annotations(self, field_name, page_key, page_annotations):
+        """Take removed annotations of one page out of the usage totals and the heatmap"""
+        count, size = AnnotationUsage.measure_page(page_annotations)
+        self._get_annotation_usage().apply(-count, -size)
+        if field_name == 'highlights' and isinstance(page_annotations, list):
+            for annotation in page_annotations:
+                self._update_heatmap(page_key, annotation, -1)
+        return count
+
+    def _update_heatmap(self, page_key, annotation, delta):
+        """Count a highlight in (delta=1) or out of (delta=-1) the class heatmap"""
+        HighlightHeatmap(self.highlight_heatmap).add(page_key, annotation, delta)
+
+    def _get_annotation_usage(self):
+        """Get the running usage totals, measuring the stored state once if they are missing"""
+        usage = AnnotationUsage(
+            self.annotation_usage, MAX_ANNOTATION_COUNT, self._get_setting('annotation_storage_limit')
+        )
+        if not self.annotation_usage and not getattr(self, '_annotation_usage_built', False):
+            # Legacy state saved before usage was tracked
+            usage.rebuild(self._get_annotation_backend().load(ANNOTATION_FIELDS).values())
+            self._annotation_usage_built = True
+        return usage
+
     def _handle_deletions(self, deletions):
         """Handle annotation deletions"""
         try:
@@ -1693,89 +2077,195 @@ class PdfxXBlock(XBlock):
                     log.warning(f"[PdfxXBlock] 💾 _handle_deletions - Incomplete deletion data: {deletion}")
                     continue
 
-                # Map annotation type to field for available tools: highlight, scribble, text, stamp
-                field_mapping = {
-                    'highlights': 'highlights',
-                    'highlight': 'highlights',
-                    'drawing_strokes': 'drawing_strokes',
-                    'scribble': 'marker_strokes',
-                    'marker_strokes': 'marker_strokes',
-                    'text_annotations': 'text_annotations',
-                    'text': 'text_annotations',
-                    'shape_annotations': 'shape_annotations',
-                    'stamp': 'shape_annotations'
-                }
-
-                field_name = field_mapping.get(annotation_type, 'shape_annotations')  # fallback to shape_annotations
-
-                if hasattr(self, field_name):
-                    current_data = dict(getattr(self, field_name))
-                    page_key = str(page_num)
-
-                    if page_key in current_data and isinstance(current_data[page_key], list):
-                        # Remove annotation with matching ID
-                        original_count = len(current_data[page_key])
-                        current_data[page_key] = [
-                            ann for ann in current_data[page_key]
-                            if ann.get('id') != annotation_id
-                        ]
-
-                        # Remove empty pages
-                        if not current_data[page_key]:
-                            del current_data[page_key]
-
-                        # Update field
-                        setattr(self, field_name, current_data)
-
-                        removed_count = original_count - len(current_data.get(page_key, []))
-                        if removed_count > 0:
-                            log.info(f"[PdfxXBlock] 💾 _handle_deletions - Removed {removed_count} annotation(s) of type {annotation_type} from page {page_num}")
+                if self._remove_annotation(annotation_id) is not None:
+                    Metrics.incr('save.deletions')
 
         except Exception as e:
             log.error(f"[PdfxXBlock] 💾 _handle_deletions - Error processing deletions: {e}")
             import traceback
             log.error(f"[PdfxXBlock] 💾 _handle_deletions - Traceback: {traceback.format_exc()}")
 
-    def _handle_load_annotations(self, request):
-        """Handle loading annotations for the current user"""
-        log.info(f"[PdfxXBlock] 💾 _handle_load_annotations - Loading annotations")
+    def _bump_revision(self):
+        """Advance the per-user annotation revision after a change"""
+        self.annotation_revision += 1
+
+    def _load_etag(self, payload):
+        """
+        Get the ETag of a load response.
 
+        The annotations and their usage totals are covered by the revision;
+        the rest of the payload (staff highlights, view settings) changes
+        without a save, so a digest of it is part of the tag.
+        """
+        digest = hashlib.blake2b(
+            json.dumps(payload, sort_keys=True, default=str).encode('utf-8'), digest_size=8
+        ).hexdigest()
+        return f'"{self.annotation_revision}-{digest}"'
+
+    def _not_modified(self, etag):
+        """Answer a conditional load whose ETag still matches"""
+        Metrics.incr('load.not_modified')
+        from webob import Response
+        return Response(status=304, headers={'ETag': etag, 'Cache-Control': 'private, no-cache'})
+
+    @staticmethod
+    def _etag_matches(request, etag):
+        """Check whether a request's If-None-Match header matches an ETag"""
+        if_none_match = request.headers.get('If-None-Match')
+        if not if_none_match:
+            return False
+        candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+        return '*' in candidates or etag in candidates or f'W/{etag}' in candidates
+
+    def _touch_page(self, page_key):
+        """Record that a page changes in the revision being saved"""
+        self.page_revisions[str(page_key)] = self.annotation_revision + 1
+
+    def _check_base_revision(self, data, changes):
+        """
+        Check a save made against 'baseRevision' for conflicts with later saves.
+
+        Changes that only touch annotations nobody else changed since the base
+        revision are merged by annotation id. Otherwise nothing is applied and a
+        409 response carries the current state of just the conflicting pages.
+
+        Returns (conflict_response, merged_pages): the 409 response or None, and
+        the pages changed by other saves since the base revision.
+        """
+        base_revision = data.get('baseRevision')
+        if base_revision is None:
+            return None, []
         try:
-            user_info = self.get_user_info()
-            user_id = user_info.get('id', 'anonymous')
+            base_revision = int(base_revision)
+        except (ValueError, TypeError):
+            return self._json_response({'result': 'error', 'message': 'Invalid baseRevision'}, 400), []
 
-            log.info(f"[PdfxXBlock] 💾 _handle_load_annotations - Loading for user: {user_id}")
+        if base_revision >= self.annotation_revision:
+            return None, []
 
-            # Load annotation types for available tools: highlight, scribble, text, stamp
-            loaded_data = {
-                'highlights': dict(self.highlights),
-                'drawing_strokes': dict(self.drawing_strokes),
-                'marker_strokes': dict(self.marker_strokes),
-                'text_annotations': dict(self.text_annotations),
-                'shape_annotations': dict(self.shape_annotations),
+        changed_pages = sorted(
+            (page_key for page_key, revision in self.page_revisions.items() if revision > base_revision),
+            key=lambda page_key: int(page_key) if page_key.isdigit() else 0
+        )
+        conflicting_pages = self._conflicting_pages(changes, base_revision)
+        if not conflicting_pages:
+            log.info(f"[PdfxXBlock] 💾 _check_base_revision - Merging save from revision {base_revision} into {self.annotation_revision}")
+            return None, changed_pages
+
+        log.warning(f"[PdfxXBlock] 💾 _check_base_revision - Conflict on pages {conflicting_pages} (base {base_revision}, current {self.annotation_revision})")
+        page_ranges = [(int(page_key), int(page_key)) for page_key in conflicting_pages if page_key.isdigit()]
+        return self._json_response({
+            'result': 'conflict',
+            'message': 'Annotations changed since baseRevision',
+            'revision': self.annotation_revision,
+            'conflicts': conflicting_pages,
+            'pages': self._load_annotation_pages(page_ranges),
+        }, 409), changed_pages
+
+    def _conflicting_pages(self, changes, base_revision):
+        """
+        Find the pages where changes would overwrite work saved after base_revision.
+
+        Each change is an (op, annotation_id, page) tuple using the apply_ops
+        operation names. A change conflicts if it touches an annotation saved
+        after the base revision, updates or deletes an annotation removed
+        after it, or clears a page changed after it.
+        """
+        backend = self._get_annotation_backend()
+        conflicting_pages = set()
+
+        for op, annotation_id, page_num in changes:
+            page_key = str(page_num) if page_num else None
+            if op == 'clear':
+                if page_key is None:
+                    conflicting_pages.update(
+                        key for key, revision in self.page_revisions.items() if revision > base_revision
+                    )
+                elif self.page_revisions.get(page_key, 0) > base_revision:
+                    conflicting_pages.add(page_key)
+                continue
+
+            if not annotation_id:
+                continue
+            stored = backend.get(annotation_id)
+            if stored:
+                _, stored_page, annotation = stored
+                if annotation.get('revision', 0) > base_revision:
+                    conflicting_pages.add(stored_page)
+            elif op in ('update', 'delete') and page_key and self.page_revisions.get(page_key, 0) > base_revision:
+                conflicting_pages.add(page_key)
+
+        return sorted(conflicting_pages, key=lambda key: int(key) if key.isdigit() else 0)
+
+    @staticmethod
+    def _save_request_changes(annotation_data, deletions):
+        """Describe a 'save' request as (op, annotation_id, page) changes"""
+        changes = []
+        if isinstance(annotation_data, dict):
+            for annotation_type, type_data in annotation_data.items():
+                if not isinstance(type_data, dict):
+                    continue
+                for page_key, page_annotations in type_data.items():
+                    if not isinstance(page_annotations, list):
+                        continue
+                    for annotation in page_annotations:
+                        if not isinstance(annotation, dict):
+                            continue
+                        if annotation_type == 'clear_action':
+                            clear_data = annotation.get('data', {})
+                            page_num = clear_data.get('pageNum') if clear_data.get('action') == 'clear_page' else None
+                            changes.append(('clear', None, page_num))
+                        else:
+                            changes.append(('add', annotation.get('id'), page_key))
+        for deletion in deletions if isinstance(deletions, list) else []:
+            if isinstance(deletion, dict):
+                changes.append(('delete', deletion.get('id'), deletion.get('pageNum')))
+        return changes
+
+    def _handle_load_annotations(self, request):
+        """Handle loading annotations for the current user"""
+        try:
+            request_context = self._get_request_context()
+            user_id = request_context.user_id
+
+            # Everything but the annotations and their usage, which only saves change and the revision covers
+            state = {
                 'currentPage': self.current_page,
                 'brightness': self.brightness,
                 'is_grayscale': self.is_grayscale
             }
-
-            # Add staff highlights if user is staff
             if self.is_staff_user():
-                loaded_data['staff_highlights'] = dict(self.staff_highlights)
-                log.info(f"[PdfxXBlock] 💾 _handle_load_annotations - Added staff highlights for staff user")
+                state['staff_highlights'] = self.staff_highlights
+
+            # Nothing changed since the client's last load: answer before reading any annotation field
+            etag = self._load_etag([state, user_id, request_context.is_staff])
+            if self._etag_matches(request, etag):
+                return self._not_modified(etag)
+            usage = self._get_annotation_usage().to_dict()
 
-            # Count total annotations for logging
-            total_annotations = sum(len(data) if isinstance(data, dict) else 0 for data in loaded_data.values() if isinstance(data, dict))
-            log.info(f"[PdfxXBlock] 💾 _handle_load_annotations - Loaded {total_annotations} total annotations across all types")
+            # Load annotation types for available tools: highlight, scribble, text, stamp
+            with Metrics.timer('load.read'):
+                loaded_data = self._load_annotation_pages(None)
+            loaded_data.update(state)
+
+            self._debug_event('load.done', user=user_id, revision=self.annotation_revision, pages=lambda: {
+                field_name: len(pages) for field_name, pages in loaded_data.items() if isinstance(pages, dict)
+            })
 
             response_data = {
                 'success': True,
                 'data': loaded_data,
                 'user_id': user_id,
-                'is_staff': self.is_staff_user(),
+                'is_staff': request_context.is_staff,
+                'revision': self.annotation_revision,
+                'usage': usage,
                 'timestamp': int(time.time() * 1000)
             }
 
-            return self._json_response(response_data, 200)
+            response = self._json_response(response_data, 200)
+            response.headers['ETag'] = etag
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
 
         except Exception as e:
             log.error(f"[PdfxXBlock] 💾 _handle_load_annotations - Error loading annotations: {e}")
@@ -1783,75 +2273,132 @@ class PdfxXBlock(XBlock):
             log.error(f"[PdfxXBlock] 💾 _handle_load_annotations - Traceback: {traceback.format_exc()}")
             return self._json_response({'success': False, 'error': str(e)}, 500)
 
-    def _save_annotation_type(self, annotation_type, data):
-        """Save a specific type of annotation"""
+    def _get_page_window(self, center_page):
+        """Get the (first, last) pages within preload_pages of a page"""
+        preload = max(0, int(self._get_setting('preload_pages') or 0))
+        center_page = max(1, int(center_page or 1))
+        return max(1, center_page - preload), center_page + preload
+
+    @staticmethod
+    def _parse_page_ranges(pages):
+        """
+        Parse requested pages into a list of (first, last) ranges.
+
+        Accepts "3-7,10" strings or lists of page numbers and [first, last] pairs.
+        Raises ValueError for malformed ranges or too many pages.
+        """
+        if isinstance(pages, str):
+            pages = [part.split('-', 1) if '-' in part else part for part in pages.split(',') if part.strip()]
+        if not isinstance(pages, list) or not pages:
+            raise ValueError('pages must be a non-empty list of pages or page ranges')
+
+        page_ranges = []
+        for item in pages:
+            first, last = item if isinstance(item, (list, tuple)) and len(item) == 2 else (item, item)
+            first, last = int(first), int(last)
+            if first < 1 or last < first:
+                raise ValueError(f'Invalid page range: {first}-{last}')
+            page_ranges.append((first, last))
+
+        if sum(last - first + 1 for first, last in page_ranges) > MAX_PAGES_PER_LOAD:
+            raise ValueError(f'At most {MAX_PAGES_PER_LOAD} pages can be loaded at once')
+        return page_ranges
+
+    @staticmethod
+    def _select_pages(pages_by_key, page_ranges):
+        """Get the entries of a per-page dict whose page falls in one of the ranges"""
+        selected = {}
+        for first, last in page_ranges:
+            for page_num in range(first, last + 1):
+                page_key = str(page_num)
+                if page_key in pages_by_key:
+                    selected[page_key] = pages_by_key[page_key]
+        return selected
+
+    def _load_annotation_pages(self, page_ranges):
+        """Get the annotations of every annotation field on the given page ranges (None for all pages)"""
+        loaded_data = self._get_annotation_backend().load(ANNOTATION_FIELDS, page_ranges)
+        for field_name in STROKE_FIELDS:
+            loaded_data[field_name] = StrokeCodec.decode_strokes(loaded_data[field_name])
+        return loaded_data
+
+    def _handle_load_pages(self, request, data):
+        """
+        Handle loading the annotations of some pages only.
+
+        Pages come from the 'pages' parameter of the JSON body or the query string,
+        e.g. "3-7,10" or [[3, 7], 10]. The viewer uses this to fetch the pages
+        that were not embedded by student_view as the reader moves through the PDF.
+        Loads carry an ETag, and a reload of pages that did not change since
+        (If-None-Match) is answered with 304.
+        """
+        params = data if data else request.GET
+        try:
+            page_ranges = self._parse_page_ranges(params.get('pages'))
+        except (TypeError, ValueError) as e:
+            return self._json_response({'success': False, 'error': str(e)}, 400)
+
+        user_id = self._get_request_context().user_id
+        staff_highlights = self._select_pages(self.staff_highlights, page_ranges) if self.is_staff_user() else None
+        etag = self._load_etag([page_ranges, staff_highlights, user_id])
+        if self._etag_matches(request, etag):
+            return self._not_modified(etag)
+
+        loaded_data = self._load_annotation_pages(page_ranges)
+        if staff_highlights is not None:
+            loaded_data['staff_highlights'] = staff_highlights
+
+        self._debug_event('load_pages.done', pages=page_ranges)
+        response = self._json_response({
+            'success': True,
+            'data': loaded_data,
+            'pages': [list(page_range) for page_range in page_ranges],
+            'revision': self.annotation_revision,
+            'user_id': user_id,
+            'timestamp': int(time.time() * 1000)
+        })
+        response.headers['ETag'] = etag
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def _save_annotation_type(self, annotation_type, data, saved_ids=None):
+        """Save a specific type of annotation, adding the ids of the saved annotations to saved_ids"""
         try:
             # Handle clear actions first
             if annotation_type == 'clear_action':
                 return self._handle_clear_action(data)
 
-            # Map annotation types to XBlock fields for available tools: highlight, scribble, text, stamp
-            field_mapping = {
-                'highlights': 'highlights',
-                'highlight': 'highlights',
-                'drawing_strokes': 'drawing_strokes',
-                'draw': 'drawing_strokes',
-                'scribble': 'marker_strokes',
-                'marker_strokes': 'marker_strokes',
-                'text_annotations': 'text_annotations',
-                'text': 'text_annotations',
-                'shape_annotations': 'shape_annotations',
-                'shape': 'shape_annotations',
-                'stamp': 'shape_annotations'  # stamps are stored as shape annotations
-            }
-
-            field_name = field_mapping.get(annotation_type, 'shape_annotations')  # fallback to shape_annotations
+            field_name = ANNOTATION_FIELD_MAPPING.get(annotation_type, 'shape_annotations')  # fallback to shape_annotations
 
             if hasattr(self, field_name):
-                current_data = getattr(self, field_name)
+                backend = self._get_annotation_backend()
 
                 # If data is None or empty, clear the field
                 if not data:
-                    setattr(self, field_name, {})
-                    log.info(f"[PdfxXBlock] 💾 _save_annotation_type - Cleared {field_name}")
+                    for page_key, page_annotations in backend.clear_field(field_name).items():
+                        self._touch_page(page_key)
+                        self._discard_annotations(field_name, page_key, page_annotations)
+                    self._debug_event('save.cleared', field=field_name)
                     return True
 
-                # Merge new data with existing data
+                # Merge new data into the existing field, in place, through the id index
                 if isinstance(data, dict):
-                    # Get existing data and merge with new data
-                    existing_data = dict(current_data) if current_data else {}
-
                     # Validate and clean new data structure
                     cleaned_new_data = self._validate_annotation_data(data)
 
-                    # Merge: combine existing data with new data
                     for page_key, page_annotations in cleaned_new_data.items():
-                        if page_key in existing_data:
-                            # Merge annotations for this page
-                            existing_page_annotations = existing_data[page_key] if isinstance(existing_data[page_key], list) else []
-
-                            # Create a set of existing annotation IDs to avoid duplicates
-                            existing_ids = {ann.get('id') for ann in existing_page_annotations if isinstance(ann, dict)}
-
-                            # Add new annotations that don't already exist
-                            for new_annotation in page_annotations:
-                                if isinstance(new_annotation, dict) and new_annotation.get('id') not in existing_ids:
-                                    existing_page_annotations.append(new_annotation)
-                                elif isinstance(new_annotation, dict) and new_annotation.get('id') in existing_ids:
-                                    # Update existing annotation with same ID
-                                    for i, existing_ann in enumerate(existing_page_annotations):
-                                        if isinstance(existing_ann, dict) and existing_ann.get('id') == new_annotation.get('id'):
-                                            existing_page_annotations[i] = new_annotation
-                                            break
-
-                            existing_data[page_key] = existing_page_annotations
-                        else:
-                            # New page, add all annotations
-                            existing_data[page_key] = page_annotations
-
-                    setattr(self, field_name, existing_data)
-                    total_annotations = sum(len(page_data) if isinstance(page_data, list) else 1 for page_data in existing_data.values())
-                    log.info(f"[PdfxXBlock] 💾 _save_annotation_type - Merged {field_name}: {len(existing_data)} pages, {total_annotations} total annotations")
+                        if not isinstance(page_annotations, list):
+                            # Opaque page data has no annotation ids, so only the fields can hold it
+                            if isinstance(backend, FieldAnnotationBackend):
+                                getattr(self, field_name)[page_key] = page_annotations
+                                self._touch_page(page_key)
+                            continue
+                        for new_annotation in page_annotations:
+                            self._upsert_annotation(field_name, page_key, new_annotation)
+                            if saved_ids is not None:
+                                saved_ids.append(new_annotation['id'])
+
+                    self._debug_event('save.merged', field=field_name, pages=lambda: sorted(cleaned_new_data))
                     return True
                 else:
                     log.warning(f"[PdfxXBlock] 💾 _save_annotation_type - Invalid data format for {annotation_type}: {type(data)}")
@@ -1860,6 +2407,8 @@ class PdfxXBlock(XBlock):
                 log.warning(f"[PdfxXBlock] 💾 _save_annotation_type - Unknown field: {field_name}")
                 return False
 
+        except AnnotationLimitError:
+            raise
         except Exception as e:
             log.error(f"[PdfxXBlock] 💾 _save_annotation_type - Error saving {annotation_type}: {e}")
             return False
@@ -1912,18 +2461,13 @@ class PdfxXBlock(XBlock):
             page_key = str(page_num)
             cleared_count = 0
 
+            self._touch_page(page_key)
+
             # Clear from all annotation fields
-            annotation_fields = ['highlights', 'drawing_strokes', 'marker_strokes', 'text_annotations', 'shape_annotations']
-
-            for field_name in annotation_fields:
-                if hasattr(self, field_name):
-                    current_data = dict(getattr(self, field_name))
-                    if page_key in current_data:
-                        if isinstance(current_data[page_key], list):
-                            cleared_count += len(current_data[page_key])
-                        del current_data[page_key]
-                        setattr(self, field_name, current_data)
-                        log.info(f"[PdfxXBlock] 🧹 _clear_page_annotations - Cleared {field_name} for page {page_num}")
+            removed = self._get_annotation_backend().clear_page(page_key, ANNOTATION_FIELDS)
+            for field_name, page_annotations in removed.items():
+                cleared_count += self._discard_annotations(field_name, page_key, page_annotations)
+                log.info(f"[PdfxXBlock] 🧹 _clear_page_annotations - Cleared {field_name} for page {page_num}")
 
             log.info(f"[PdfxXBlock] 🧹 _clear_page_annotations - Cleared {cleared_count} annotations from page {page_num}")
             return cleared_count
@@ -1938,19 +2482,14 @@ class PdfxXBlock(XBlock):
             cleared_count = 0
 
             # Clear all annotation fields
-            annotation_fields = ['highlights', 'drawing_strokes', 'marker_strokes', 'text_annotations', 'shape_annotations']
-
-            for field_name in annotation_fields:
-                if hasattr(self, field_name):
-                    current_data = dict(getattr(self, field_name))
-                    # Count annotations before clearing
-                    for page_data in current_data.values():
-                        if isinstance(page_data, list):
-                            cleared_count += len(page_data)
+            backend = self._get_annotation_backend()
+            for field_name in ANNOTATION_FIELDS:
+                for page_key, page_data in backend.clear_field(field_name).items():
+                    self._touch_page(page_key)
+                    cleared_count += self._discard_annotations(field_name, page_key, page_data)
+                log.info(f"[PdfxXBlock] 🧹 _clear_all_annotations - Cleared all {field_name}")
 
-                    # Clear the field
-                    setattr(self, field_name, {})
-                    log.info(f"[PdfxXBlock] 🧹 _clear_all_annotations - Cleared all {field_name}")
+            self.annotation_usage = {'count': 0, 'bytes': 0}
 
             log.info(f"[PdfxXBlock] 🧹 _clear_all_annotations - Cleared {cleared_count} total annotations from entire PDF")
             return cleared_count
@@ -1966,7 +2505,7 @@ class PdfxXBlock(XBlock):
 
         cleaned_data = {}
         current_time = int(time.time() * 1000)
-        user_id = self.get_user_info().get('id', 'anonymous')
+        user_id = self._get_request_context().user_id
 
         for page_key, page_data in data.items():
             try:
@@ -1978,16 +2517,10 @@ class PdfxXBlock(XBlock):
                     cleaned_annotations = []
                     for annotation in page_data:
                         if isinstance(annotation, dict):
-                            # Ensure required fields
-                            cleaned_annotation = {
-                                'id': annotation.get('id', f"ann_{current_time}_{len(cleaned_annotations)}"),
-                                'type': annotation.get('type', 'unknown'),
-                                'userId': user_id,  # Always use current user
-                                'timestamp': annotation.get('timestamp', current_time),
-                                'data': annotation.get('data', {}),
-                                'config': annotation.get('config', {})
-                            }
-                            cleaned_annotations.append(cleaned_annotation)
+                            cleaned_annotations.append(self._clean_annotation(
+                                annotation, user_id, current_time,
+                                f"ann_{current_time}_{len(cleaned_annotations)}"
+                            ))
 
                     if cleaned_annotations:
                         cleaned_data[str(page_num)] = cleaned_annotations
@@ -2002,6 +2535,17 @@ class PdfxXBlock(XBlock):
 
         return cleaned_data
 
+    def _clean_annotation(self, annotation, user_id, current_time, default_id):
+        """Build the stored form of a single annotation, keeping only known keys"""
+        return {
+            'id': annotation.get('id', default_id),
+            'type': annotation.get('type', 'unknown'),
+            'userId': user_id,  # Always use current user
+            'timestamp': annotation.get('timestamp', current_time),
+            'data': annotation.get('data', {}),
+            'config': annotation.get('config', {})
+        }
+
     def save(self):
         """Simple save method - let XBlock handle the scoping"""
         try:
@@ -2096,15 +2640,12 @@ class PdfxXBlock(XBlock):
         ]
 
     @XBlock.handler
+    @Metrics.timed('upload_pdf')
     def upload_pdf(self, request, suffix=''):
         """
         Handle PDF file upload - alternative handler for dedicated file uploads.
         This can be used as a separate endpoint for file uploads.
         """
-        log.info(f"[PdfxXBlock] =============== upload_pdf START ===============")
-        log.info(f"[PdfxXBlock] upload_pdf - Block: {getattr(self, 'location', 'unknown')}")
-        log.info(f"[PdfxXBlock] upload_pdf - Request method: {request.method}")
-
         response_data = {}
         status_code = 200
 
@@ -2115,9 +2656,8 @@ class PdfxXBlock(XBlock):
                 response_data = {'result': 'error', 'message': 'No file uploaded'}
                 status_code = 400
             else:
-                upload = request.params['file'].file
-                filename = request.params['file'].filename
-                log.info(f"[PdfxXBlock] upload_pdf - Processing file: {filename}")
+                upload = request.params['file']
+                filename = upload.filename
 
                 # Validate file type
                 if not filename.lower().endswith('.pdf'):
@@ -2125,95 +2665,45 @@ class PdfxXBlock(XBlock):
                     response_data = {'result': 'error', 'message': 'Only PDF files are allowed'}
                     status_code = 400
                 else:
-                    # Generate a unique filename
-                    safe_filename = filename.replace(' ', '_')
-                    unique_id = str(uuid.uuid4())[:8]
-                    unique_filename = f"{unique_id}_{safe_filename}"
-                    log.info(f"[PdfxXBlock] upload_pdf - Generated unique filename: {unique_filename}")
-
-                    # Get the course key from the XBlock's location
-                    course_key = self.location.course_key
-                    log.info(f"[PdfxXBlock] upload_pdf - Course key: {course_key}")
-
-                    # Import ContentStore and StaticContent
+                    # Read the file once, in chunks, refusing it as soon as it is too large
                     try:
-                        from xmodule.contentstore.django import contentstore
-                        from xmodule.contentstore.content import StaticContent
-                        from opaque_keys.edx.keys import AssetKey
-
-                        # Get content store
-                        content_store = contentstore()
-                        log.info(f"[PdfxXBlock] upload_pdf - Got contentstore: {type(content_store)}")
-
-                        # Create asset key - use a simpler name pattern (same as example-pdf.py)
-                        asset_path = f"pdfs_{unique_id}_{safe_filename}"
-                        asset_key = StaticContent.compute_location(course_key, asset_path)
-                        log.info(f"[PdfxXBlock] upload_pdf - Generated asset key: {asset_key}")
-
-                        # Read the file content
-                        file_content = upload.read()
-                        log.info(f"[PdfxXBlock] upload_pdf - Read file content: {len(file_content)} bytes")
-
-                        # Validate PDF content
-                        if not file_content.startswith(b'%PDF'):
-                            log.error(f"[PdfxXBlock] upload_pdf - Invalid PDF content")
-                            response_data = {'result': 'error', 'message': 'Invalid PDF file content'}
-                            status_code = 400
-                        else:
-                            # Create the static content (same pattern as example-pdf.py)
-                            content = StaticContent(
-                                asset_key,
-                                filename,  # Use original filename for display
-                                'application/pdf',
-                                file_content,
-                                length=len(file_content)
-                            )
-                            log.info(f"[PdfxXBlock] upload_pdf - Created StaticContent object")
-
-                            # Save the content to contentstore
-                            content_store.save(content)
-                            log.info(f"[PdfxXBlock] upload_pdf - ✅ Successfully saved to contentstore!")
-
-                            # Generate the asset URL (same pattern as example-pdf.py)
-                            try:
-                                asset_url = StaticContent.serialize_asset_key_with_slash(asset_key)
-                                log.info(f"[PdfxXBlock] upload_pdf - Generated asset URL: {asset_url}")
-
-                                # If this doesn't work, try constructing it manually
-                                if not asset_url:
-                                    log.warning(f"[PdfxXBlock] upload_pdf - serialize_asset_key_with_slash returned empty, using manual construction")
-                                    asset_url = f"/asset-v1:{str(course_key)}+type@asset+block@{asset_path}"
-                                    log.info(f"[PdfxXBlock] upload_pdf - Manual asset URL: {asset_url}")
-
-                            except Exception as url_error:
-                                log.error(f"[PdfxXBlock] upload_pdf - Error generating asset URL: {url_error}")
-                                # Fallback to basic URL format
-                                asset_url = f"/asset-v1:{str(course_key)}+type@asset+block@{asset_path}"
-                                log.info(f"[PdfxXBlock] upload_pdf - Fallback asset URL: {asset_url}")
+                        with Metrics.timer('upload_pdf.read'):
+                            pdf_upload = PdfUpload.read(upload)
+                    except PdfUploadError as upload_error:
+                        Metrics.incr(f'upload.{upload_error.code}')
+                        log.warning(f"[PdfxXBlock] upload_pdf - ❌ Upload refused: {upload_error}")
+                        response_data = upload_error.to_dict()
+                        status_code = 413 if upload_error.code == 'file_too_large' else 400
+                        pdf_upload = None
+
+                    if pdf_upload:
+                        try:
+                            # Store it under its content hash, reusing an identical asset of the course, and analyze it
+                            asset_url, deduplicated = self._ingest_pdf_upload(pdf_upload, filename, 'upload_pdf.store')
 
                             # Update XBlock fields
                             self.pdf_file_name = filename
                             self.pdf_file_asset_key = asset_url
                             self.pdf_url = ""  # Clear the URL field since we're using an uploaded file
 
-                            log.info(f"[PdfxXBlock] upload_pdf - ✅ PDF file uploaded successfully: {filename}")
-                            log.info(f"[PdfxXBlock] upload_pdf - Asset URL: {asset_url}")
-
                             response_data = {
                                 'result': 'success',
                                 'filename': filename,
                                 'asset_url': asset_url,
-                                'file_size': len(file_content)
+                                'file_size': pdf_upload.size,
+                                'deduplicated': deduplicated
                             }
 
-                    except ImportError as import_error:
-                        log.error(f"[PdfxXBlock] upload_pdf - ❌ Contentstore import failed: {import_error}")
-                        response_data = {'result': 'error', 'message': f'ContentStore not available: {import_error}'}
-                        status_code = 500
-                    except Exception as contentstore_error:
-                        log.error(f"[PdfxXBlock] upload_pdf - ❌ Contentstore operation failed: {contentstore_error}")
-                        response_data = {'result': 'error', 'message': f'File upload failed: {contentstore_error}'}
-                        status_code = 500
+                        except ImportError as import_error:
+                            log.error(f"[PdfxXBlock] upload_pdf - ❌ Contentstore import failed: {import_error}")
+                            response_data = {'result': 'error', 'message': f'ContentStore not available: {import_error}'}
+                            status_code = 500
+                        except Exception as contentstore_error:
+                            log.error(f"[PdfxXBlock] upload_pdf - ❌ Contentstore operation failed: {contentstore_error}")
+                            response_data = {'result': 'error', 'message': f'File upload failed: {contentstore_error}'}
+                            status_code = 500
+                        finally:
+                            pdf_upload.close()
 
         except Exception as e:
             log.error(f"[PdfxXBlock] upload_pdf - ❌ General error: {e}")
@@ -2222,12 +2712,5 @@ class PdfxXBlock(XBlock):
             response_data = {'result': 'error', 'message': f'Upload failed: {str(e)}'}
             status_code = 500
 
-        # Return appropriate response
-        from webob import Response
-        import json
-        response = Response(json.dumps(response_data))
-        response.content_type = 'application/json'
-        response.status_code = status_code
-
-        log.info(f"[PdfxXBlock] upload_pdf =============== END (status: {status_code}) ===============")
-        return response
\ No newline at end of file
+        self._debug_event('upload_pdf.done', status=status_code, **response_data)
+        return self._json_response(response_data, status_code)
\ No newline at end of file
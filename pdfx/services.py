@@ -6,12 +6,44 @@ such as processing, storage, and annotation management.
 """
 
 import os
+import io
+import re
+import csv
 import json
+import time
 import logging
 import base64
-from datetime import datetime
+import gzip
+import hashlib
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from functools import cached_property
+from importlib.metadata import PackageNotFoundError, version as package_version
+from importlib.resources import files
 from urllib.parse import urlparse
 
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is optional
+    np = None
+
+try:
+    import pypdf
+except ImportError:  # pragma: no cover - installed with the package; analysis and text are skipped without it
+    pypdf = None
+
+from .config import (
+    ANNOTATION_FIELD_MAPPING, ANNOTATION_FIELDS, BROWSE_DEFAULT_LIMIT, EXPORT_CHUNK_SIZE,
+    IDEMPOTENCY_KEY_TIMEOUT, IDEMPOTENCY_MAX_KEYS, MAX_FILE_SIZE, PDF_DERIVED_CACHE_SIZE, PDF_OUTLINE_MAX_ITEMS,
+    PDF_STREAM_CHUNK_SIZE, PDF_UPLOAD_CHUNK_SIZE, PDF_UPLOAD_SPOOL_SIZE, SEARCH_SNIPPET_CHARS, STROKE_FIELDS
+)
+from .instrumentation import DebugEvents
+from .models import AnnotationIndex, CompressedDict, PreservedDict, StrokeCodec
+
 logger = logging.getLogger(__name__)
 
 
@@ -64,6 +96,547 @@ class PdfService:
         return metadata
 
 
+class PdfUploadError(Exception):
+    """Raised when an uploaded file is refused."""
+
+    def __init__(self, code, message):
+        """
+        Initialize the error.
+
+        Args:
+            code (str): 'not_a_pdf' or 'file_too_large'.
+            message (str): The message shown to the author.
+        """
+        super().__init__(message)
+        self.code = code
+
+    def to_dict(self):
+        """
+        Convert the error to a dictionary for JSON responses.
+
+        Returns:
+            dict: The structured error.
+        """
+        return {'result': 'error', 'code': self.code, 'message': str(self)}
+
+
+class PdfUpload:
+    """
+    An uploaded PDF, read once in chunks.
+
+    The header is checked from the first chunk, the size, SHA-256 and MD5
+    (what GridFS records as the content digest) are computed as the chunks arrive, and reading stops as soon as the size
+    limit is passed. The bytes are kept in a spooled temporary file, in
+    memory up to the spool size and on disk beyond, so an upload is never
+    held twice.
+    """
+
+    MAGIC = b'%PDF'
+
+    def __init__(self, spool, size, sha256, spool_size, md5=None):
+        """
+        Initialize the upload. Use PdfUpload.read to create one.
+
+        Args:
+            spool (SpooledTemporaryFile): The bytes of the upload.
+            size (int): The size in bytes.
+            sha256 (str): The hex SHA-256 of the bytes.
+            spool_size (int): The size above which the spool is on disk.
+            md5 (str): The hex MD5 of the bytes.
+        """
+        self.spool = spool
+        self.size = size
+        self.sha256 = sha256
+        self.spool_size = spool_size
+        self.md5 = md5
+
+    @classmethod
+    def read(cls, upload, max_size=MAX_FILE_SIZE, chunk_size=PDF_UPLOAD_CHUNK_SIZE,
+             spool_size=PDF_UPLOAD_SPOOL_SIZE):
+        """
+        Read and check an uploaded file.
+
+        Args:
+            upload: The uploaded file: a webob FieldStorage or Django
+                UploadedFile (read through its .file) or a file object.
+            max_size (int): The largest accepted size in bytes.
+            chunk_size (int): Bytes read at a time.
+            spool_size (int): Bytes kept in memory before spooling to disk.
+
+        Returns:
+            PdfUpload: The checked upload.
+
+        Raises:
+            PdfUploadError: If the file is not a PDF or is too large.
+        """
+        stream = getattr(upload, 'file', upload)
+        spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        digest = hashlib.sha256()
+        md5 = hashlib.md5()
+        head = b''
+        size = 0
+        try:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                if len(head) < len(cls.MAGIC):
+                    head += chunk[:len(cls.MAGIC) - len(head)]
+                    if not cls.MAGIC.startswith(head):
+                        raise PdfUploadError('not_a_pdf', 'Uploaded file is not a valid PDF')
+                size += len(chunk)
+                if size > max_size:
+                    raise PdfUploadError(
+                        'file_too_large', f'Uploaded file is larger than {max_size // (1024 * 1024)}MB'
+                    )
+                digest.update(chunk)
+                md5.update(chunk)
+                spool.write(chunk)
+            if head != cls.MAGIC:
+                raise PdfUploadError('not_a_pdf', 'Uploaded file is not a valid PDF')
+        except BaseException:
+            spool.close()
+            raise
+        spool.seek(0)
+        return cls(spool, size, digest.hexdigest(), spool_size, md5.hexdigest())
+
+    @property
+    def data(self):
+        """
+        Get the bytes for the contentstore.
+
+        The spool itself is handed over, rewound, whether it is in memory or
+        on disk: the contentstore reads it in chunks, so the upload is not
+        copied into a second buffer.
+
+        Returns:
+            file: The spooled temporary file.
+        """
+        self.spool.seek(0)
+        return self.spool
+
+    def matches(self, content):
+        """
+        Check that a stored asset holds exactly these bytes.
+
+        The store's content digest (GridFS MD5) is compared when it has one;
+        otherwise the asset is read in chunks and its SHA-256 compared, so a
+        truncated or partial earlier write is never mistaken for the upload.
+
+        Args:
+            content: A contentstore StaticContentStream.
+
+        Returns:
+            bool: True if the asset has the same length and content.
+        """
+        if content.length != self.size:
+            return False
+        digest = getattr(content, 'content_digest', None)
+        if digest:
+            return digest == self.md5
+        stored = hashlib.sha256()
+        for chunk in content.stream_data():
+            stored.update(chunk)
+        return stored.hexdigest() == self.sha256
+
+    def close(self):
+        """Discard the spooled bytes."""
+        self.spool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PdfAnalyzer:
+    """
+    Reads what the viewer needs before it opens a PDF: page count, page sizes,
+    title, author and outline.
+
+    The PDF is parsed once, at upload, with pypdf (a pure-Python parser
+    installed with the package). Without pypdf, or for a PDF it cannot parse, the
+    analysis is empty and the viewer learns everything from pdf.js as before.
+    """
+
+    @classmethod
+    def analyze(cls, stream):
+        """
+        Analyze a PDF.
+
+        Args:
+            stream: A seekable binary file object holding the PDF.
+
+        Returns:
+            dict: {'numPages', 'pageSizes': [[width, height, count], ...],
+                'title', 'author', 'outline': [{'title', 'page', 'items'}, ...]},
+                or {} if the PDF could not be analyzed.
+        """
+        if pypdf is None:
+            return {}
+        try:
+            stream.seek(0)
+            reader = pypdf.PdfReader(stream)
+            metadata = reader.metadata or {}
+            return {
+                'numPages': len(reader.pages),
+                'pageSizes': cls.page_sizes(reader),
+                'title': str(metadata.get('/Title') or ''),
+                'author': str(metadata.get('/Author') or ''),
+                'outline': cls.outline(reader, reader.outline, [PDF_OUTLINE_MAX_ITEMS]),
+            }
+        except Exception as e:
+            logger.warning(f"PdfAnalyzer - Could not analyze PDF: {e}")
+            return {}
+        finally:
+            stream.seek(0)
+
+    @staticmethod
+    def page_sizes(reader):
+        """
+        Get the displayed page sizes, run-length encoded.
+
+        Args:
+            reader (pypdf.PdfReader): The PDF.
+
+        Returns:
+            list: [width, height, count] runs in points, rotation applied.
+        """
+        runs = []
+        for page in reader.pages:
+            box = page.cropbox
+            width, height = round(float(box.width), 1), round(float(box.height), 1)
+            if page.rotation % 180:
+                width, height = height, width
+            if runs and runs[-1][:2] == [width, height]:
+                runs[-1][2] += 1
+            else:
+                runs.append([width, height, 1])
+        return runs
+
+    @classmethod
+    def outline(cls, reader, items, budget):
+        """
+        Convert a pypdf outline to nested entries with 1-based page numbers.
+
+        Args:
+            reader (pypdf.PdfReader): The PDF.
+            items (list): pypdf outline items; a nested list holds the children
+                of the item before it.
+            budget (list): [entries left], shared across levels so huge outlines are cut.
+
+        Returns:
+            list: {'title', 'page', 'items'} entries; page is None without a destination.
+        """
+        entries = []
+        for item in items:
+            if budget[0] <= 0:
+                break
+            if isinstance(item, list):
+                if entries:
+                    entries[-1]['items'] = cls.outline(reader, item, budget)
+                continue
+            try:
+                page_index = reader.get_destination_page_number(item)
+            except Exception:
+                page_index = None
+            budget[0] -= 1
+            entries.append({
+                'title': str(item.title or ''),
+                'page': page_index + 1 if page_index is not None and page_index >= 0 else None,
+                'items': [],
+            })
+        return entries
+
+    @staticmethod
+    def expand_page_sizes(analysis):
+        """
+        Expand the page size runs of an analysis.
+
+        Args:
+            analysis (dict): The result of analyze().
+
+        Returns:
+            list: (page number, width, height) per page.
+        """
+        pages = []
+        for width, height, count in analysis.get('pageSizes') or []:
+            for _ in range(count):
+                pages.append((len(pages) + 1, width, height))
+        return pages
+
+
+class DerivedAsset:
+    """
+    Gzipped JSON derived from an uploaded PDF and stored as a course asset.
+
+    Derived assets are named after the PDF's content hash and never change,
+    so once read they are kept in a small per-process cache, keyed by asset key.
+    """
+
+    _lock = threading.Lock()
+    _cache = OrderedDict()
+
+    @staticmethod
+    def dumps(value):
+        """Serialize a derived asset to gzipped JSON."""
+        return gzip.compress(json.dumps(value, separators=(',', ':')).encode('utf-8'), mtime=0)
+
+    @classmethod
+    def load(cls, key, read):
+        """
+        Get a derived asset, read once per process.
+
+        Args:
+            key (str): The asset key.
+            read (callable): Returns the gzipped JSON of the asset.
+
+        Returns:
+            dict: The asset.
+        """
+        with cls._lock:
+            if key in cls._cache:
+                cls._cache.move_to_end(key)
+                return cls._cache[key]
+        value = json.loads(gzip.decompress(read()).decode('utf-8'))
+        with cls._lock:
+            cls._cache[key] = value
+            while len(cls._cache) > PDF_DERIVED_CACHE_SIZE:
+                cls._cache.popitem(last=False)
+        return value
+
+    @classmethod
+    def clear(cls):
+        """Forget the cached assets."""
+        with cls._lock:
+            cls._cache.clear()
+
+
+class PdfTextLayer(DerivedAsset):
+    """
+    Per-page text runs with positions, extracted once at upload for the viewer's text layer.
+
+    The layer is {'version', 'pages': [[run, ...], ...]}. Each run is
+    [text, a, b, c, d, e, f, width] in the shape of a pdf.js text item: the
+    transform is the text matrix times the CTM, scaled by the font size, and
+    the width is estimated from the font's mean glyph width, then clipped at
+    the next run on the same line.
+    """
+
+    VERSION = 1
+    DEFAULT_GLYPH_WIDTH = 0.5  # In text space units per font size unit
+
+    _warned_without_pypdf = False
+
+    @classmethod
+    def warn_without_pypdf(cls):
+        """Log, once per process, that text extraction is asked for but pypdf is missing."""
+        if not cls._warned_without_pypdf:
+            cls._warned_without_pypdf = True
+            logger.warning(
+                "PdfTextLayer - pypdf is not installed: uploaded PDFs get no search index (index_pdf_text) "
+                "or text layer (render_text_layer)"
+            )
+
+    @classmethod
+    def extract(cls, stream, runs=True):
+        """
+        Extract the text of each page of a PDF, with its runs.
+
+        Args:
+            stream: A seekable binary file object holding the PDF.
+            runs (bool): Also collect the positioned runs.
+
+        Returns:
+            list: (text, runs) per page, or [] without pypdf or for an unreadable PDF.
+        """
+        if pypdf is None:
+            cls.warn_without_pypdf()
+            return []
+        try:
+            stream.seek(0)
+            pages = []
+            glyph_widths = {}
+            for page in pypdf.PdfReader(stream).pages:
+                page_runs = []
+
+                def visitor(text, cm, tm, font, font_size):
+                    cls.add_run(page_runs, text, cm, tm, font, font_size, glyph_widths)
+
+                try:
+                    text = page.extract_text(visitor_text=visitor if runs else None) or ''
+                except Exception:
+                    text, page_runs = '', []
+                pages.append((text, cls.clip_widths(page_runs)))
+            return pages
+        except Exception as e:
+            logger.warning(f"PdfTextLayer - Could not extract text: {e}")
+            return []
+        finally:
+            stream.seek(0)
+
+    @classmethod
+    def add_run(cls, runs, text, cm, tm, font, font_size, glyph_widths):
+        """
+        Add a text run reported by pypdf, skipping blank ones.
+
+        Args:
+            runs (list): The runs of the page.
+            text (str): The run text.
+            cm (list): The current transformation matrix.
+            tm (list): The text matrix.
+            font: The PDF font dictionary, or None.
+            font_size (float): The font size.
+            glyph_widths (dict): Mean glyph widths already computed, by font.
+        """
+        text = text.replace('\n', '')
+        if not text.strip():
+            return
+        a = tm[0] * cm[0] + tm[1] * cm[2]
+        b = tm[0] * cm[1] + tm[1] * cm[3]
+        c = tm[2] * cm[0] + tm[3] * cm[2]
+        d = tm[2] * cm[1] + tm[3] * cm[3]
+        e = tm[4] * cm[0] + tm[5] * cm[2] + cm[4]
+        f = tm[4] * cm[1] + tm[5] * cm[3] + cm[5]
+        font_key = id(font)
+        if font_key not in glyph_widths:
+            glyph_widths[font_key] = cls.glyph_width(font)
+        width = len(text) * glyph_widths[font_key] * font_size * (a * a + b * b) ** 0.5
+        runs.append([text] + [round(value * font_size, 2) for value in (a, b, c, d)] + [round(e, 2), round(f, 2), round(width, 2)])
+
+    @classmethod
+    def glyph_width(cls, font):
+        """Get the mean glyph width of a font from its /Widths, if it has them."""
+        try:
+            widths = [float(width) for width in font.get('/Widths', [])]
+        except Exception:
+            widths = []
+        widths = [width for width in widths if width > 0]
+        return sum(widths) / len(widths) / 1000 if widths else cls.DEFAULT_GLYPH_WIDTH
+
+    @staticmethod
+    def clip_widths(runs):
+        """Clip each horizontal run at the start of the next run on its line."""
+        for run, next_run in zip(runs, runs[1:]):
+            if run[2] == 0 and abs(next_run[6] - run[6]) < 0.5 and next_run[5] > run[5]:
+                run[7] = min(run[7], round(next_run[5] - run[5], 2))
+        return runs
+
+    @classmethod
+    def build(cls, page_runs):
+        """
+        Build the text layer of a PDF.
+
+        Args:
+            page_runs (list): The runs of each page.
+
+        Returns:
+            dict: The layer, or None if the PDF has no text.
+        """
+        if not any(page_runs):
+            return None
+        return {'version': cls.VERSION, 'pages': page_runs}
+
+
+class PdfTextIndex(DerivedAsset):
+    """
+    A per-page inverted index of the text of a PDF, built once at upload.
+
+    The index is {'version', 'pages': [page text], 'terms': {term: [page numbers]}},
+    stored as gzipped JSON in a course asset. Searches intersect the page lists
+    of the query terms and cut snippets from the page text.
+    """
+
+    VERSION = 1
+    WORD_PATTERN = re.compile(r'\w+')
+
+    @staticmethod
+    def extract_pages(stream):
+        """
+        Extract the text of each page of a PDF.
+
+        Args:
+            stream: A seekable binary file object holding the PDF.
+
+        Returns:
+            list: The text of each page, or [] without pypdf or for an unreadable PDF.
+        """
+        return [text for text, _ in PdfTextLayer.extract(stream, runs=False)]
+
+    @classmethod
+    def tokenize(cls, text):
+        """Split text into lowercase words."""
+        return cls.WORD_PATTERN.findall(text.lower())
+
+    @classmethod
+    def build(cls, page_texts):
+        """
+        Build the index of a PDF.
+
+        Args:
+            page_texts (list): The text of each page.
+
+        Returns:
+            dict: The index, or None if the PDF has no text (e.g. a scan).
+        """
+        pages = [' '.join(text.split()) for text in page_texts]
+        terms = {}
+        for number, text in enumerate(pages, 1):
+            for term in set(cls.tokenize(text)):
+                terms.setdefault(term, []).append(number)
+        if not terms:
+            return None
+        return {'version': cls.VERSION, 'pages': pages, 'terms': terms}
+
+    @classmethod
+    def search(cls, index, query, limit):
+        """
+        Find the pages containing every word of a query.
+
+        Args:
+            index (dict): The index.
+            query (str): The words to find.
+            limit (int): The most pages to return.
+
+        Returns:
+            tuple: ([{'page', 'snippet'}] in page order, total number of matching pages).
+        """
+        terms = list(dict.fromkeys(cls.tokenize(query)))
+        if not terms:
+            return [], 0
+        # Intersect the rarest lists first
+        page_lists = sorted((index['terms'].get(term, []) for term in terms), key=len)
+        pages = set(page_lists[0])
+        for page_list in page_lists[1:]:
+            pages.intersection_update(page_list)
+        matches = sorted(pages)
+        return [
+            {'page': page, 'snippet': cls.snippet(index['pages'][page - 1], terms)}
+            for page in matches[:limit]
+        ], len(matches)
+
+    @staticmethod
+    def snippet(text, terms):
+        """
+        Cut the text around the first match of a query.
+
+        Args:
+            text (str): The page text.
+            terms (list): The query words.
+
+        Returns:
+            str: Up to SEARCH_SNIPPET_CHARS characters each side of the match.
+        """
+        pattern = '|'.join(rf'(?<!\w){re.escape(term)}(?!\w)' for term in terms)
+        match = re.search(pattern, text, re.IGNORECASE)
+        if not match:
+            return text[:2 * SEARCH_SNIPPET_CHARS]
+        start = max(0, match.start() - SEARCH_SNIPPET_CHARS)
+        end = min(len(text), match.end() + SEARCH_SNIPPET_CHARS)
+        return ('…' if start else '') + text[start:end] + ('…' if end < len(text) else '')
+
+
 class AnnotationService:
     """Service for handling annotation operations."""
 
@@ -204,4 +777,1452 @@ class ThumbnailService:
         Returns:
             str: The thumbnail URL.
         """
-        return f"/xblock/{xblock_id}/handler/get_pdf_thumbnail?id={thumbnail_id}"
\ No newline at end of file
+        return f"/xblock/{xblock_id}/handler/get_pdf_thumbnail?id={thumbnail_id}"
+
+
+class TemplateCache:
+    """
+    Process-wide cache of compiled Mako templates.
+
+    Compiling a template lexes it and builds a Python module; rendering a
+    compiled template is cheap and thread-safe. Templates are keyed by
+    their package path and the installed package version, so an upgrade
+    never serves a stale template. In dev mode the file mtime is checked
+    on every lookup so template edits show up without a restart.
+    """
+
+    _templates = {}
+    _lock = threading.Lock()
+    _version = None
+
+    @classmethod
+    def package_version(cls):
+        """
+        Get the installed version of the package.
+
+        Returns:
+            str: The version, or 'dev' for an uninstalled checkout.
+        """
+        if cls._version is None:
+            try:
+                cls._version = package_version('pdfx-xblock')
+            except PackageNotFoundError:
+                cls._version = 'dev'
+        return cls._version
+
+    @staticmethod
+    def _mtime(resource):
+        """Get the modification time of a package resource, or None if it is not a file."""
+        try:
+            return os.stat(str(resource)).st_mtime_ns
+        except OSError:
+            return None
+
+    @classmethod
+    def get(cls, path, check_mtime=False):
+        """
+        Get a compiled template, compiling it on first use.
+
+        Args:
+            path (str): The template path inside the package, e.g. 'static/html/pdfx.html'.
+            check_mtime (bool): Recompile when the file changed since it was compiled.
+
+        Returns:
+            mako.template.Template: The compiled template.
+        """
+        from mako.template import Template
+
+        key = (path, cls.package_version())
+        resource = files(__package__).joinpath(path)
+        mtime = cls._mtime(resource) if check_mtime else None
+
+        entry = cls._templates.get(key)
+        if entry is not None and (not check_mtime or entry[0] == mtime):
+            return entry[1]
+
+        template = Template(resource.read_text(encoding='utf-8'))
+        with cls._lock:
+            cls._templates[key] = (mtime, template)
+        logger.debug(f"Compiled template {path}")
+        return template
+
+    @classmethod
+    def clear(cls):
+        """Forget every compiled template."""
+        with cls._lock:
+            cls._templates.clear()
+
+
+class StrokeSimplifier:
+    """
+    Service for simplifying freehand strokes with the Ramer-Douglas-Peucker algorithm.
+
+    Points are dropped when they lie within ``tolerance`` of the segment
+    joining the points kept around them. The first and last points of a
+    stroke are always kept. NumPy is used when it is installed, with a
+    pure-Python fallback producing the same result.
+    """
+
+    # Below this many points the Python loop is faster than NumPy's per-call overhead
+    NUMPY_MIN_POINTS = 64
+
+    @staticmethod
+    def _keep_mask_python(xs, ys, tolerance):
+        """
+        Compute which points RDP keeps, in pure Python.
+
+        Args:
+            xs (list): The x coordinates.
+            ys (list): The y coordinates.
+            tolerance (float): The maximum distance of a dropped point.
+
+        Returns:
+            list: One bool per point, True if the point is kept.
+        """
+        count = len(xs)
+        keep = [False] * count
+        keep[0] = keep[-1] = True
+        tolerance_sq = tolerance * tolerance
+        stack = [(0, count - 1)]
+
+        while stack:
+            start, end = stack.pop()
+            if end - start < 2:
+                continue
+
+            x0, y0 = xs[start], ys[start]
+            dx, dy = xs[end] - x0, ys[end] - y0
+            segment_sq = dx * dx + dy * dy
+            farthest, farthest_sq = start, -1.0
+            for i in range(start + 1, end):
+                px, py = xs[i] - x0, ys[i] - y0
+                if segment_sq:
+                    t = min(1.0, max(0.0, (px * dx + py * dy) / segment_sq))
+                    px, py = px - t * dx, py - t * dy
+                distance_sq = px * px + py * py
+                if distance_sq > farthest_sq:
+                    farthest, farthest_sq = i, distance_sq
+
+            if farthest_sq > tolerance_sq:
+                keep[farthest] = True
+                stack.append((start, farthest))
+                stack.append((farthest, end))
+
+        return keep
+
+    @staticmethod
+    def _keep_mask_numpy(xs, ys, tolerance):
+        """
+        Compute which points RDP keeps, measuring each span's distances with NumPy.
+
+        Args:
+            xs (list): The x coordinates.
+            ys (list): The y coordinates.
+            tolerance (float): The maximum distance of a dropped point.
+
+        Returns:
+            list: One bool per point, True if the point is kept.
+        """
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        keep = np.zeros(len(xs), dtype=bool)
+        keep[0] = keep[-1] = True
+        tolerance_sq = tolerance * tolerance
+        stack = [(0, len(xs) - 1)]
+
+        while stack:
+            start, end = stack.pop()
+            if end - start < 2:
+                continue
+
+            dx, dy = xs[end] - xs[start], ys[end] - ys[start]
+            segment_sq = dx * dx + dy * dy
+            px = xs[start + 1:end] - xs[start]
+            py = ys[start + 1:end] - ys[start]
+            if segment_sq:
+                t = np.clip((px * dx + py * dy) / segment_sq, 0.0, 1.0)
+                px = px - t * dx
+                py = py - t * dy
+            distances_sq = px * px + py * py
+            offset = int(np.argmax(distances_sq))
+
+            if distances_sq[offset] > tolerance_sq:
+                farthest = start + 1 + offset
+                keep[farthest] = True
+                stack.append((start, farthest))
+                stack.append((farthest, end))
+
+        return keep.tolist()
+
+    @classmethod
+    def simplify_points(cls, points, tolerance):
+        """
+        Simplify a list of stroke points.
+
+        Args:
+            points (list): Point dicts with numeric 'x' and 'y' keys.
+            tolerance (float): The maximum distance of a dropped point,
+                in the units of the coordinates.
+
+        Returns:
+            list: The kept points, in order. The input is returned unchanged
+            if it is too short or has invalid coordinates.
+        """
+        if tolerance <= 0 or len(points) < 3:
+            return points
+
+        try:
+            xs = [float(point['x']) for point in points]
+            ys = [float(point['y']) for point in points]
+        except (KeyError, TypeError, ValueError):
+            return points
+
+        if np is not None and len(points) >= cls.NUMPY_MIN_POINTS:
+            keep = cls._keep_mask_numpy(xs, ys, tolerance)
+        else:
+            keep = cls._keep_mask_python(xs, ys, tolerance)
+
+        return [point for point, kept in zip(points, keep) if kept]
+
+    @classmethod
+    def simplify_annotation(cls, annotation, tolerance):
+        """
+        Simplify the stroke points of a scribble or drawing annotation.
+
+        Args:
+            annotation (dict): The annotation, with points in
+                ``data.strokeData.points``.
+            tolerance (float): The maximum distance of a dropped point, in
+                page units. It is scaled by ``strokeData.originalScale``
+                because points are captured in zoomed pixels.
+
+        Returns:
+            tuple: (annotation, points_in, points_out). The annotation is a
+            copy if points were dropped, else the input itself.
+        """
+        data = annotation.get('data')
+        stroke_data = data.get('strokeData') if isinstance(data, dict) else None
+        points = stroke_data.get('points') if isinstance(stroke_data, dict) else None
+        if not isinstance(points, list) or not all(isinstance(point, dict) for point in points):
+            return annotation, 0, 0
+
+        scale = stroke_data.get('originalScale') or 1
+        if not isinstance(scale, (int, float)) or scale <= 0:
+            scale = 1
+        simplified = cls.simplify_points(points, tolerance * scale)
+        if len(simplified) == len(points):
+            return annotation, len(points), len(points)
+
+        # The recorded SVG path still holds every point, so drop it and let
+        # the viewer rebuild it from the simplified points
+        stroke_data = {key: value for key, value in stroke_data.items() if key != 'pathData'}
+        stroke_data['points'] = simplified
+        simplified_annotation = dict(annotation, data=dict(data, strokeData=stroke_data))
+        return simplified_annotation, len(points), len(simplified)
+
+
+class IdempotencyStore:
+    """
+    Store of recently applied save requests, keyed by client idempotency key.
+
+    Responses are kept in the Django cache when one is configured, so
+    retries reaching another LMS worker are replayed too. Without Django
+    (tests, local runs) a bounded in-memory LRU stands in for it.
+    """
+
+    _default = None
+
+    def __init__(self, cache=None, timeout=IDEMPOTENCY_KEY_TIMEOUT, max_entries=IDEMPOTENCY_MAX_KEYS):
+        """
+        Initialize the store.
+
+        Args:
+            cache: A Django cache, or None to keep entries in memory.
+            timeout (int): Seconds an entry is kept.
+            max_entries (int): Entries kept in memory before the oldest are evicted.
+        """
+        self.cache = cache
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def default(cls):
+        """
+        Get the process-wide store, using the Django cache if available.
+
+        Returns:
+            IdempotencyStore: The shared store.
+        """
+        if cls._default is None:
+            cache = None
+            try:
+                from django.core.cache import cache as django_cache
+                django_cache.get('pdfx:idempotency:probe')
+                cache = django_cache
+            except Exception:  # Django missing or not configured
+                logger.debug("Django cache unavailable, keeping idempotency keys in memory")
+            cls._default = cls(cache)
+        return cls._default
+
+    @staticmethod
+    def make_key(*parts):
+        """
+        Build a cache-safe key from its parts.
+
+        Args:
+            *parts: The block, user and client key.
+
+        Returns:
+            str: The store key.
+        """
+        digest = hashlib.sha256('\x1f'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+        return f'pdfx:idempotency:{digest}'
+
+    @staticmethod
+    def request_digest(data):
+        """
+        Fingerprint a request body, so a reused key can be told apart from a retry.
+
+        Args:
+            data (dict): The parsed request body; the client key itself is left out.
+
+        Returns:
+            str: The digest.
+        """
+        if isinstance(data, dict):
+            data = {name: value for name, value in data.items() if name != 'idempotencyKey'}
+        body = json.dumps(data, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Get the entry stored for a key.
+
+        Args:
+            key (str): The store key.
+
+        Returns:
+            dict: The stored entry, or None if unknown or expired.
+        """
+        if self.cache is not None:
+            return self.cache.get(key)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """
+        Store an entry for a key.
+
+        Args:
+            key (str): The store key.
+            value (dict): The entry, JSON-serializable.
+        """
+        if self.cache is not None:
+            self.cache.set(key, value, self.timeout)
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.timeout, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class RequestContext:
+    """
+    Who is making the current request, resolved once per request.
+
+    The user, staff role and course are looked up on first use and then
+    reused by every view, handler and helper of the request. The email
+    needs a database lookup of the Django user, so it is only resolved
+    when a caller reads it.
+    """
+
+    ANONYMOUS_USER = {'id': 'anonymous', 'username': '', 'anonymous_id': None, 'django_user': None}
+
+    def __init__(self, block, request=None):
+        """
+        Initialize the context.
+
+        Args:
+            block: The XBlock handling the request.
+            request: The webob request of a handler, or None for views.
+        """
+        self.block = block
+        self.request = request
+
+    def _user_service(self):
+        """Get the runtime's user service, or None."""
+        return self.block.runtime.service(self.block, 'user')
+
+    @cached_property
+    def current_user(self):
+        """Get the user service's current user, or None."""
+        user_service = self._user_service()
+        return user_service.get_current_user() if user_service else None
+
+    @cached_property
+    def user(self):
+        """
+        Get the current user, without the email.
+
+        Returns:
+            dict: id, username, and the anonymous_id or Django user to read the email from.
+        """
+        try:
+            current_user = self.current_user
+            if current_user and hasattr(current_user, 'opt_attrs'):
+                user_id = current_user.opt_attrs.get('edx-platform.user_id')
+                if user_id and current_user.opt_attrs.get('edx-platform.is_authenticated', False):
+                    return {
+                        'id': str(user_id),
+                        'username': current_user.opt_attrs.get('edx-platform.username', ''),
+                        'anonymous_id': current_user.opt_attrs.get('edx-platform.anonymous_user_id'),
+                        'django_user': None
+                    }
+                logger.info("RequestContext - User not authenticated or no user ID")
+
+            # Fallback: the runtime's own user
+            user = getattr(self.block.runtime, 'user', None)
+            if user and getattr(user, 'id', None) and user.is_authenticated:
+                return {
+                    'id': str(user.id),
+                    'username': getattr(user, 'username', ''),
+                    'anonymous_id': None,
+                    'django_user': user
+                }
+        except Exception as e:
+            logger.error(f"RequestContext - Error getting user: {e}")
+
+        return dict(self.ANONYMOUS_USER)
+
+    @property
+    def user_id(self):
+        """Get the current user's id, 'anonymous' if unknown."""
+        return self.user['id']
+
+    @property
+    def username(self):
+        """Get the current user's username."""
+        return self.user['username']
+
+    @cached_property
+    def email(self):
+        """Get the current user's email, looking up the Django user on first access."""
+        django_user = self.user['django_user']
+        try:
+            if django_user is None and self.user['anonymous_id']:
+                user_service = self._user_service()
+                if hasattr(user_service, 'get_user_by_anonymous_id'):
+                    django_user = user_service.get_user_by_anonymous_id(self.user['anonymous_id'])
+        except Exception as e:
+            logger.warning(f"RequestContext - Could not get email: {e}")
+        return getattr(django_user, 'email', '') or ''
+
+    @cached_property
+    def is_staff(self):
+        """Check if the current user is course staff, an instructor or global staff."""
+        try:
+            current_user = self.current_user
+            if current_user and hasattr(current_user, 'opt_attrs'):
+                opt_attrs = current_user.opt_attrs
+                return bool(
+                    opt_attrs.get('edx-platform.user_is_staff', False)
+                    or opt_attrs.get('edx-platform.user_is_global_staff', False)
+                    or opt_attrs.get('edx-platform.user_role', '') in ('staff', 'instructor')
+                )
+
+            # Fallback to runtime attribute
+            return bool(getattr(self.block.runtime, 'user_is_staff', False))
+        except Exception as e:
+            logger.error(f"RequestContext - Error checking staff status: {e}")
+            return False
+
+    @cached_property
+    def events(self):
+        """Get the request's debug events, sampled when the debug_mode setting is on."""
+        enabled = self.block._get_setting('debug_mode')
+        return DebugEvents(enabled, self.block._get_setting('debug_sample_rate') if enabled else 0)
+
+    @cached_property
+    def course_id(self):
+        """Get the current course id, '' outside a course."""
+        course_id = getattr(self.block.runtime, 'course_id', None)
+        return str(course_id) if course_id else ''
+
+
+class AnnotationBackend:
+    """
+    Storage of one user's annotations in one block.
+
+    Annotations are grouped by field (see ANNOTATION_FIELDS) and page, and
+    are addressed by id. Backends change only the annotations they are
+    given, so the cost of a save follows the size of the change.
+    """
+
+    def get(self, annotation_id):
+        """
+        Find a stored annotation.
+
+        Args:
+            annotation_id (str): The annotation ID.
+
+        Returns:
+            tuple: (field_name, page_key, annotation), or None if unknown.
+        """
+        raise NotImplementedError
+
+    def upsert(self, field_name, page_key, annotation):
+        """
+        Store an annotation, replacing the stored one with the same id.
+
+        Args:
+            field_name (str): The field to store the annotation in.
+            page_key (str): The page the annotation belongs to.
+            annotation (dict): The annotation, with an 'id' key.
+
+        Returns:
+            bool: True if an existing annotation was replaced.
+        """
+        raise NotImplementedError
+
+    def remove(self, annotation_id):
+        """
+        Remove an annotation.
+
+        Args:
+            annotation_id (str): The annotation ID.
+
+        Returns:
+            dict: The removed annotation, or None if it was not found.
+        """
+        raise NotImplementedError
+
+    def load(self, field_names, page_ranges=None):
+        """
+        Load stored annotations.
+
+        Args:
+            field_names (iterable): The fields to load.
+            page_ranges (list): (first, last) page ranges, or None for all pages.
+
+        Returns:
+            dict: {field_name: {page_key: [annotation, ...]}} for every field.
+        """
+        raise NotImplementedError
+
+    def clear_page(self, page_key, field_names):
+        """
+        Remove every annotation of a page.
+
+        Args:
+            page_key (str): The page to clear.
+            field_names (iterable): The fields to clear the page from.
+
+        Returns:
+            dict: The removed annotations, {field_name: [annotation, ...]}.
+        """
+        raise NotImplementedError
+
+    def clear_field(self, field_name):
+        """
+        Remove every annotation of a field.
+
+        Args:
+            field_name (str): The field to clear.
+
+        Returns:
+            dict: The removed annotations, {page_key: [annotation, ...]}.
+        """
+        raise NotImplementedError
+
+    def iter_block(self, field_names=ANNOTATION_FIELDS):
+        """
+        Iterate the annotations of every user of the block, one at a time.
+
+        Args:
+            field_names (iterable): The fields to read.
+
+        Yields:
+            tuple: (user, field_name, page_key, annotation)
+        """
+        raise NotImplementedError
+
+    def browse(self, field_names=ANNOTATION_FIELDS, after=None, limit=BROWSE_DEFAULT_LIMIT):
+        """
+        Get one page of the block's annotations, in (user, page, id) order.
+
+        Browsing is backed by the (user, page, id) index of the sqlite
+        backend. Field-stored annotations live in each student's user
+        state, with no index across students, so paging them would mean
+        reading every state on every request; the field backend does not
+        browse.
+
+        Args:
+            field_names (iterable): The fields to read.
+            after (tuple): The key returned with the previous page, or None.
+            limit (int): The maximum number of rows.
+
+        Returns:
+            tuple: (rows, next_key), where rows are (user, field_name, page_key,
+            annotation) tuples and next_key is the key to browse after, or
+            None on the last page.
+
+        Raises:
+            NotImplementedError: The backend has no index to browse.
+        """
+        raise NotImplementedError('Browsing needs the sqlite annotation backend (see pdfx-migrate-annotations)')
+
+    def commit(self):
+        """Make the changes since the last commit durable."""
+
+    def rollback(self):
+        """Discard the changes since the last commit."""
+
+    def accepts_page(self, page_key):
+        """
+        Check whether annotations can be stored under a page key.
+
+        Args:
+            page_key (str): The page key.
+
+        Returns:
+            bool: True if upsert takes the page key.
+        """
+        return True
+
+
+class FieldAnnotationBackend(AnnotationBackend):
+    """
+    Annotations kept in the block's user_state Dict fields.
+
+    Changes are made in place through the block's AnnotationIndex and
+    persisted with the rest of the block state by block.save().
+    """
+
+    def __init__(self, block):
+        """
+        Initialize the backend.
+
+        Args:
+            block: The XBlock holding the annotation fields.
+        """
+        self.block = block
+        self._index_built = False
+
+    def _index(self):
+        """Get the id index over the fields, building it on first use."""
+        index = AnnotationIndex(self.block.annotation_index, lambda field_name: getattr(self.block, field_name))
+        if not self.block.annotation_index and not self._index_built:
+            # Legacy state saved before the index existed
+            index.rebuild(ANNOTATION_FIELDS)
+            self._index_built = True
+        return index
+
+    def get(self, annotation_id):
+        location = self._index().locate(annotation_id)
+        if not location:
+            return None
+        field_name, page_key, slot = location
+        return field_name, page_key, getattr(self.block, field_name)[page_key][slot]
+
+    def upsert(self, field_name, page_key, annotation):
+        return self._index().upsert(field_name, page_key, annotation)
+
+    def remove(self, annotation_id):
+        return self._index().remove(annotation_id)
+
+    def load(self, field_names, page_ranges=None):
+        loaded = {}
+        for field_name in field_names:
+            pages = getattr(self.block, field_name)
+            if page_ranges is None:
+                loaded[field_name] = dict(pages)
+                continue
+            loaded[field_name] = {}
+            for first, last in page_ranges:
+                for page_num in range(first, last + 1):
+                    page_key = str(page_num)
+                    if page_key in pages:
+                        loaded[field_name][page_key] = pages[page_key]
+        return loaded
+
+    def clear_page(self, page_key, field_names):
+        removed = {}
+        for field_name in field_names:
+            pages = getattr(self.block, field_name)
+            if page_key in pages:
+                removed[field_name] = pages.pop(page_key)
+        self._index().drop_page(page_key, field_names)
+        return removed
+
+    def clear_field(self, field_name):
+        removed = dict(getattr(self.block, field_name))
+        setattr(self.block, field_name, {})
+        self._index().drop_field(field_name)
+        return removed
+
+    def iter_block(self, field_names=ANNOTATION_FIELDS):
+        return self.iter_user_states(self.block.scope_ids.usage_id, field_names)
+
+    @classmethod
+    def iter_user_states(cls, usage_key, field_names=ANNOTATION_FIELDS):
+        """
+        Iterate the annotations held in the user state of every student.
+
+        States are read one student at a time through the LMS user state
+        client, so memory does not grow with enrollment.
+
+        Args:
+            usage_key: The block usage key.
+            field_names (iterable): The fields to read.
+
+        Returns:
+            generator: (username, field_name, page_key, annotation) tuples.
+
+        Raises:
+            ImportError: Outside the LMS.
+        """
+        from lms.djangoapps.courseware.user_state_client import DjangoXBlockUserStateClient
+
+        return cls.iter_states(DjangoXBlockUserStateClient().iter_all_for_block(usage_key), field_names)
+
+    @staticmethod
+    def iter_states(user_states, field_names=ANNOTATION_FIELDS):
+        """
+        Iterate the annotations of raw user states.
+
+        Args:
+            user_states (iterable): Objects with username and state (the
+                JSON values of the block fields) attributes.
+            field_names (iterable): The fields to read.
+
+        Yields:
+            tuple: (username, field_name, page_key, annotation)
+        """
+        field_names = list(field_names)
+        codec = CompressedDict()
+        for user_state in user_states:
+            for field_name in field_names:
+                if field_name not in user_state.state:
+                    continue
+                pages = codec.from_json(user_state.state[field_name]) or {}
+                if field_name in STROKE_FIELDS:
+                    pages = StrokeCodec.decode_strokes(pages)
+                for page_key in sorted(pages, key=lambda key: int(key) if str(key).isdigit() else 0):
+                    page_annotations = pages[page_key]
+                    for annotation in page_annotations if isinstance(page_annotations, list) else []:
+                        yield user_state.username, field_name, page_key, annotation
+
+
+class SqliteAnnotationBackend(AnnotationBackend):
+    """
+    One row per annotation in a SQLite database.
+
+    Rows are keyed and clustered by (course, block, user, page, id), so a
+    page load is a range scan and a save writes only the changed rows
+    instead of the whole user state. Each thread keeps its own connection.
+    """
+
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS pdfx_annotation (
+            course_id TEXT NOT NULL,
+            block_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            page INTEGER NOT NULL,
+            id TEXT NOT NULL,
+            field TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (course_id, block_id, user_id, page, id)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS pdfx_annotation_id
+        ON pdfx_annotation (course_id, block_id, user_id, id)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS pdfx_migration (
+            course_id TEXT NOT NULL,
+            block_id TEXT NOT NULL,
+            migrated_at TEXT NOT NULL,
+            PRIMARY KEY (course_id, block_id)
+        )
+        """,
+    )
+
+    OWNER_FILTER = 'course_id = ? AND block_id = ? AND user_id = ?'
+    FETCH_SIZE = 500  # Rows read at a time when iterating the block
+
+    _local = threading.local()
+    _migrated = set()  # (path, course, block) seen migrated; a block is never unmigrated
+
+    def __init__(self, path, course_id, block_id, user_id, usernames=None):
+        """
+        Initialize the backend.
+
+        Args:
+            path (str): The SQLite database file.
+            course_id (str): The course key.
+            block_id (str): The block usage id.
+            user_id (str): The user id.
+            usernames (callable): Maps an iterable of user ids to a dict of
+                usernames, so rows of every user name them as the field
+                backend does (default: lms_usernames).
+        """
+        self.path = path
+        self.owner = (str(course_id), str(block_id), str(user_id))
+        self.usernames = usernames or self.lms_usernames
+
+    @staticmethod
+    def lms_usernames(user_ids):
+        """
+        Look up the usernames of LMS user ids.
+
+        Args:
+            user_ids (iterable): The user ids.
+
+        Returns:
+            dict: user id -> username, empty outside the LMS.
+        """
+        ids = [int(user_id) for user_id in user_ids if str(user_id).isdigit()]
+        if not ids:
+            return {}
+        try:
+            from django.contrib.auth import get_user_model
+            users = get_user_model().objects.filter(pk__in=ids).values_list('pk', 'username')
+            return {str(pk): username for pk, username in users}
+        except Exception as e:  # Django missing or not configured
+            logger.debug(f"Usernames are not available: {e}")
+            return {}
+
+    @classmethod
+    def connect(cls, path):
+        """
+        Get this thread's connection to a database, creating the schema once.
+
+        Args:
+            path (str): The SQLite database file.
+
+        Returns:
+            sqlite3.Connection: The connection.
+        """
+        connections = getattr(cls._local, 'connections', None)
+        if connections is None:
+            connections = cls._local.connections = {}
+        connection = connections.get(path)
+        if connection is None:
+            connection = sqlite3.connect(path)
+            with connection:
+                for statement in cls.SCHEMA:
+                    connection.execute(statement)
+            connections[path] = connection
+        return connection
+
+    @property
+    def connection(self):
+        """This thread's connection to the backend's database."""
+        return self.connect(self.path)
+
+    @classmethod
+    def is_migrated(cls, path, course_id, block_id):
+        """
+        Check whether every student's field annotations of a block were moved into a database.
+
+        Args:
+            path (str): The SQLite database file.
+            course_id (str): The course key.
+            block_id (str): The block usage id.
+
+        Returns:
+            bool: True once pdfx-migrate-annotations finished for the block.
+        """
+        key = (path, str(course_id), str(block_id))
+        if key in cls._migrated:
+            return True
+        row = cls.connect(path).execute(
+            'SELECT 1 FROM pdfx_migration WHERE course_id = ? AND block_id = ?', key[1:]
+        ).fetchone()
+        if row is not None:
+            cls._migrated.add(key)
+        return row is not None
+
+    @classmethod
+    def mark_migrated(cls, path, course_id, block_id):
+        """
+        Record that a block reads and writes its annotations in a database from now on.
+
+        Args:
+            path (str): The SQLite database file.
+            course_id (str): The course key.
+            block_id (str): The block usage id.
+        """
+        connection = cls.connect(path)
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO pdfx_migration (course_id, block_id, migrated_at) VALUES (?, ?, ?)',
+                (str(course_id), str(block_id), datetime.now(timezone.utc).isoformat())
+            )
+
+    def migrate_state(self, state, field_names=ANNOTATION_FIELDS):
+        """
+        Move the annotations of one student's raw user state into this backend.
+
+        Only annotations the database can store (objects with an id, on a
+        numbered page) are moved; anything else stays in the state, so
+        nothing is lost. An annotation that already has a row is not
+        overwritten: the row is newer than its field copy.
+
+        Args:
+            state (dict): The JSON values of the block fields, as the user
+                state client returns them.
+            field_names (iterable): The fields to move.
+
+        Returns:
+            tuple: (moved count, changed state), where the changed state maps
+            each emptied field to its new JSON value; empty if nothing moved.
+
+        A field whose stored value cannot be read keeps that value: only
+        the annotations added since are moved.
+        """
+        codec = CompressedDict()
+        moved = left = 0
+        changed = {}
+        for field_name in field_names:
+            if field_name not in state:
+                continue
+            pages = codec.from_json(state[field_name]) or {}
+            kept = PreservedDict(raw=pages.raw) if isinstance(pages, PreservedDict) else {}
+            for page_key, page_annotations in pages.items():
+                if not isinstance(page_annotations, list) or not self.accepts_page(page_key):
+                    kept[page_key] = page_annotations
+                    left += len(page_annotations) if isinstance(page_annotations, list) else 1
+                    continue
+                kept_annotations = []
+                for annotation in page_annotations:
+                    if isinstance(annotation, dict) and annotation.get('id'):
+                        if self.get(annotation['id']) is None:
+                            self.upsert(field_name, page_key, annotation)
+                        moved += 1
+                    else:
+                        kept_annotations.append(annotation)
+                if kept_annotations:
+                    kept[page_key] = kept_annotations
+                    left += len(kept_annotations)
+            if kept != pages:
+                changed[field_name] = codec.to_json(kept)
+        if changed:
+            # Slots moved; the index is rebuilt from the fields on next use
+            changed['annotation_index'] = codec.to_json({})
+        if left:
+            logger.warning(f"Left {left} annotations without an id or page number in the user state")
+        return moved, changed
+
+    def get(self, annotation_id):
+        row = self.connection.execute(
+            f'SELECT field, page, data FROM pdfx_annotation WHERE {self.OWNER_FILTER} AND id = ?',
+            self.owner + (annotation_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        field_name, page, data = row
+        return field_name, str(page), json.loads(data)
+
+    def accepts_page(self, page_key):
+        return str(page_key).isdigit()
+
+    def upsert(self, field_name, page_key, annotation):
+        if not self.accepts_page(page_key):
+            raise ValueError(f'Invalid page: {page_key}')
+        page = int(page_key)
+        connection = self.connection
+        replaced = connection.execute(
+            f'DELETE FROM pdfx_annotation WHERE {self.OWNER_FILTER} AND id = ?',
+            self.owner + (annotation['id'],)
+        ).rowcount > 0
+        connection.execute(
+            'INSERT INTO pdfx_annotation (course_id, block_id, user_id, page, id, field, data) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            self.owner + (page, annotation['id'], field_name, json.dumps(annotation, separators=(',', ':')))
+        )
+        return replaced
+
+    def remove(self, annotation_id):
+        stored = self.get(annotation_id)
+        if stored is None:
+            return None
+        self.connection.execute(
+            f'DELETE FROM pdfx_annotation WHERE {self.OWNER_FILTER} AND id = ?',
+            self.owner + (annotation_id,)
+        )
+        return stored[2]
+
+    def load(self, field_names, page_ranges=None):
+        field_names = list(field_names)
+        loaded = {field_name: {} for field_name in field_names}
+        if not field_names:
+            return loaded
+
+        query = (
+            f'SELECT field, page, data FROM pdfx_annotation WHERE {self.OWNER_FILTER} '
+            f'AND field IN ({", ".join("?" * len(field_names))})'
+        )
+        params = self.owner + tuple(field_names)
+        if page_ranges is not None:
+            if not page_ranges:
+                return loaded
+            query += ' AND (' + ' OR '.join('page BETWEEN ? AND ?' for _ in page_ranges) + ')'
+            params += tuple(page for page_range in page_ranges for page in page_range)
+
+        for field_name, page, data in self.connection.execute(query + ' ORDER BY page, id', params):
+            loaded[field_name].setdefault(str(page), []).append(json.loads(data))
+        return loaded
+
+    def clear_page(self, page_key, field_names):
+        field_names = list(field_names)
+        removed = {
+            field_name: page_annotations.get(str(page_key), [])
+            for field_name, page_annotations in self.load(field_names, [(int(page_key), int(page_key))]).items()
+            if page_annotations
+        }
+        self.connection.execute(
+            f'DELETE FROM pdfx_annotation WHERE {self.OWNER_FILTER} AND page = ? '
+            f'AND field IN ({", ".join("?" * len(field_names))})',
+            self.owner + (int(page_key),) + tuple(field_names)
+        )
+        return removed
+
+    def clear_field(self, field_name):
+        removed = self.load([field_name])[field_name]
+        self.connection.execute(
+            f'DELETE FROM pdfx_annotation WHERE {self.OWNER_FILTER} AND field = ?',
+            self.owner + (field_name,)
+        )
+        return removed
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def iter_block(self, field_names=ANNOTATION_FIELDS):
+        field_names = list(field_names)
+        rows = self.connection.execute(
+            'SELECT user_id, field, page, data FROM pdfx_annotation WHERE course_id = ? AND block_id = ? '
+            f'AND field IN ({", ".join("?" * len(field_names))}) ORDER BY user_id, page, id',
+            self.owner[:2] + tuple(field_names)
+        )
+        while True:
+            chunk = rows.fetchmany(self.FETCH_SIZE)
+            if not chunk:
+                break
+            yield from self.decode_rows(chunk)
+
+    def browse(self, field_names=ANNOTATION_FIELDS, after=None, limit=BROWSE_DEFAULT_LIMIT):
+        field_names = list(field_names)
+        query = (
+            'SELECT user_id, field, page, data, id FROM pdfx_annotation WHERE course_id = ? AND block_id = ? '
+            f'AND field IN ({", ".join("?" * len(field_names))})'
+        )
+        params = self.owner[:2] + tuple(field_names)
+        if after is not None:
+            # Keyset pagination: seek the primary key past the last row seen
+            query += ' AND (user_id, page, id) > (?, ?, ?)'
+            params += tuple(after)
+        rows = self.connection.execute(query + ' ORDER BY user_id, page, id LIMIT ?', params + (limit + 1,)).fetchall()
+
+        next_key = None
+        if len(rows) > limit:
+            user_id, _, page, _, annotation_id = rows[limit - 1]
+            next_key = (user_id, page, annotation_id)
+        return self.decode_rows([row[:4] for row in rows[:limit]]), next_key
+
+    def decode_rows(self, rows):
+        """
+        Decode (user_id, field, page, data) rows, naming users by username.
+
+        Args:
+            rows (list): Rows of the pdfx_annotation table.
+
+        Returns:
+            list: (user, field_name, page_key, annotation) tuples.
+        """
+        usernames = self.usernames({row[0] for row in rows})
+        decoded = []
+        for user_id, field_name, page, data in rows:
+            annotation = json.loads(data)
+            if field_name in STROKE_FIELDS:
+                annotation = StrokeCodec.decode_annotation(annotation)
+            decoded.append((usernames.get(user_id, user_id), field_name, str(page), annotation))
+        return decoded
+
+
+class AnnotationCursor:
+    """Opaque browse cursors wrapping the (user, page, id) key of the last row returned."""
+
+    @staticmethod
+    def encode(key):
+        """
+        Encode a browse key as a cursor.
+
+        Args:
+            key (tuple): (user, page number, annotation id)
+
+        Returns:
+            str: The URL-safe cursor.
+        """
+        return base64.urlsafe_b64encode(json.dumps(list(key), separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode(cursor):
+        """
+        Decode a cursor into a browse key.
+
+        Args:
+            cursor (str): The cursor returned by encode.
+
+        Returns:
+            tuple: (user, page number, annotation id)
+
+        Raises:
+            ValueError: If the cursor is malformed.
+        """
+        try:
+            user, page_num, annotation_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        except (TypeError, ValueError, UnicodeError):
+            raise ValueError('Invalid cursor')
+        if not isinstance(user, str) or not isinstance(page_num, int) or not isinstance(annotation_id, str):
+            raise ValueError('Invalid cursor')
+        return user, page_num, annotation_id
+
+
+class AnnotationExporter:
+    """
+    Stream the annotations of a block as NDJSON or CSV.
+
+    Rows flow from an AnnotationBackend.iter_block generator through the
+    filters to the writer one at a time, and output is produced in chunks of about
+    EXPORT_CHUNK_SIZE bytes, so memory stays flat whatever the enrollment.
+    """
+
+    FORMATS = {
+        'ndjson': 'application/x-ndjson',
+        'csv': 'text/csv',
+    }
+
+    CSV_COLUMNS = ('user', 'type', 'page', 'id', 'timestamp', 'revision', 'data', 'config')
+
+    def __init__(self, types=None, page_range=None, since=None, until=None):
+        """
+        Initialize the exporter.
+
+        Args:
+            types (iterable): Annotation types or field names to keep, or None for all.
+            page_range (tuple): (first, last) pages to keep, or None for all.
+            since (datetime): Keep annotations created at or after this time.
+            until (datetime): Keep annotations created before this time.
+
+        Raises:
+            ValueError: If a type is unknown.
+        """
+        self.field_names = list(ANNOTATION_FIELDS)
+        if types:
+            unknown = [annotation_type for annotation_type in types if annotation_type not in ANNOTATION_FIELD_MAPPING]
+            if unknown:
+                raise ValueError(f"Unknown annotation types: {', '.join(unknown)}")
+            wanted = {ANNOTATION_FIELD_MAPPING[annotation_type] for annotation_type in types}
+            self.field_names = [field_name for field_name in ANNOTATION_FIELDS if field_name in wanted]
+        self.page_range = page_range
+        self.since = since.timestamp() * 1000 if since else None
+        self.until = until.timestamp() * 1000 if until else None
+
+    @classmethod
+    def from_params(cls, params):
+        """
+        Build an exporter from request or command line parameters.
+
+        Args:
+            params (dict): Optional 'types' (comma-separated), 'pages'
+                ("first-last" or a single page), 'since' and 'until'
+                (ISO 8601 dates, UTC unless they carry an offset).
+
+        Returns:
+            AnnotationExporter: The exporter.
+
+        Raises:
+            ValueError: If a parameter is malformed.
+        """
+        types = [annotation_type.strip() for annotation_type in (params.get('types') or '').split(',')]
+        page_range = None
+        if params.get('pages'):
+            first, _, last = str(params['pages']).partition('-')
+            page_range = (int(first), int(last or first))
+            if page_range[0] < 1 or page_range[1] < page_range[0]:
+                raise ValueError(f"Invalid page range: {params['pages']}")
+        return cls(
+            types=[annotation_type for annotation_type in types if annotation_type] or None,
+            page_range=page_range,
+            since=cls.parse_date(params.get('since')),
+            until=cls.parse_date(params.get('until')),
+        )
+
+    @staticmethod
+    def parse_date(value):
+        """
+        Parse an ISO 8601 date or datetime.
+
+        Args:
+            value (str): The date, or None.
+
+        Returns:
+            datetime: The aware datetime, or None.
+        """
+        if not value:
+            return None
+        parsed = datetime.fromisoformat(value)
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+    def matches(self, page_key, annotation):
+        """
+        Check an annotation against the page and date filters.
+
+        Args:
+            page_key (str): The page of the annotation.
+            annotation (dict): The annotation.
+
+        Returns:
+            bool: True if the annotation is kept.
+        """
+        if self.page_range:
+            try:
+                page_num = int(page_key)
+            except (TypeError, ValueError):
+                return False
+            if not self.page_range[0] <= page_num <= self.page_range[1]:
+                return False
+        if self.since is not None or self.until is not None:
+            timestamp = annotation.get('timestamp')
+            if not isinstance(timestamp, (int, float)):
+                return False
+            if self.since is not None and timestamp < self.since:
+                return False
+            if self.until is not None and timestamp >= self.until:
+                return False
+        return True
+
+    def records(self, rows):
+        """
+        Filter annotation rows into export records.
+
+        Args:
+            rows (iterable): (user, field_name, page_key, annotation) tuples,
+                as yielded by AnnotationBackend.iter_block(self.field_names).
+
+        Yields:
+            dict: One record per kept annotation.
+        """
+        for user, field_name, page_key, annotation in rows:
+            if not isinstance(annotation, dict) or not self.matches(page_key, annotation):
+                continue
+            yield {
+                'user': user,
+                'type': field_name,
+                'page': page_key,
+                'id': annotation.get('id'),
+                'timestamp': annotation.get('timestamp'),
+                'revision': annotation.get('revision'),
+                'data': annotation.get('data', {}),
+                'config': annotation.get('config', {}),
+            }
+
+    @staticmethod
+    def _chunked(lines):
+        """Join encoded lines into chunks of about EXPORT_CHUNK_SIZE bytes."""
+        chunk = []
+        size = 0
+        for line in lines:
+            chunk.append(line)
+            size += len(line)
+            if size >= EXPORT_CHUNK_SIZE:
+                yield b''.join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            yield b''.join(chunk)
+
+    @staticmethod
+    def iter_ndjson(records):
+        """
+        Write records as newline-delimited JSON.
+
+        Args:
+            records (iterable): The records.
+
+        Yields:
+            bytes: Encoded lines.
+        """
+        for record in records:
+            yield (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+
+    @classmethod
+    def iter_csv(cls, records):
+        """
+        Write records as CSV, with nested data and config as JSON.
+
+        Args:
+            records (iterable): The records.
+
+        Yields:
+            bytes: The encoded header, then one encoded row per record.
+        """
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(cls.CSV_COLUMNS)
+        for record in records:
+            writer.writerow([
+                json.dumps(record[column], separators=(',', ':')) if column in ('data', 'config') else record[column]
+                for column in cls.CSV_COLUMNS
+            ])
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode('utf-8')
+
+    def stream(self, rows, output_format='ndjson'):
+        """
+        Export annotation rows in chunks.
+
+        Args:
+            rows (iterable): (user, field_name, page_key, annotation) tuples.
+            output_format (str): 'ndjson' or 'csv'.
+
+        Returns:
+            generator: Chunks of encoded output.
+
+        Raises:
+            ValueError: If the format is unknown.
+        """
+        if output_format not in self.FORMATS:
+            raise ValueError(f"Unknown export format: {output_format}")
+        writer = self.iter_csv if output_format == 'csv' else self.iter_ndjson
+        return self._chunked(writer(self.records(rows)))
+
+
+class AssetStream:
+    """Conditional and byte-range serving of a contentstore asset, read chunk by chunk."""
+
+    RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+    @staticmethod
+    def etag(content):
+        """
+        Get the strong ETag of an asset.
+
+        Args:
+            content: A contentstore StaticContent or StaticContentStream.
+
+        Returns:
+            str: The quoted ETag, from the content digest when the store has one.
+        """
+        digest = getattr(content, 'content_digest', None)
+        if not digest:
+            parts = (content.location, content.length, getattr(content, 'last_modified_at', ''))
+            digest = hashlib.sha256('\x1f'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:32]
+        return f'"{digest}"'
+
+    @staticmethod
+    def http_date(value):
+        """Format a datetime as an HTTP date, or None."""
+        if not value:
+            return None
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return format_datetime(value.astimezone(timezone.utc), usegmt=True)
+
+    @classmethod
+    def if_range_matches(cls, if_range, etag, last_modified):
+        """
+        Check an If-Range precondition: the range applies only to the representation it names.
+
+        Args:
+            if_range (str): The If-Range header, or None.
+            etag (str): The current ETag.
+            last_modified (str): The current Last-Modified HTTP date, or None.
+
+        Returns:
+            bool: True if the Range header should be honored.
+        """
+        if not if_range:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith(('"', 'W/')):
+            return if_range == etag  # Weak validators never match If-Range
+        return last_modified is not None and if_range == last_modified
+
+    @classmethod
+    def parse_range(cls, header, length):
+        """
+        Resolve a Range header against the asset length.
+
+        Only single ranges are served; several ranges or a malformed header
+        get the whole asset, as RFC 9110 allows.
+
+        Args:
+            header (str): The Range header, or None.
+            length (int): The asset length in bytes.
+
+        Returns:
+            tuple: (first, last) inclusive byte offsets, or None for the whole asset.
+
+        Raises:
+            ValueError: If the range cannot be satisfied (416).
+        """
+        match = cls.RANGE_PATTERN.match((header or '').replace(' ', ''))
+        if not match or match.groups() == ('', ''):
+            return None
+        first, last = match.groups()
+        if not first:
+            # Suffix range: the last N bytes
+            if int(last) == 0:
+                raise ValueError('Unsatisfiable range')
+            return max(0, length - int(last)), length - 1
+        first = int(first)
+        last = min(int(last), length - 1) if last else length - 1
+        if first >= length or last < first:
+            raise ValueError('Unsatisfiable range')
+        return first, last
+
+    @staticmethod
+    def iter_range(content, first, last, chunk_size=PDF_STREAM_CHUNK_SIZE):
+        """
+        Iterate the bytes first..last of an asset without loading it whole.
+
+        Args:
+            content: A StaticContentStream (read from the store as it goes)
+                or an in-memory StaticContent (sliced).
+            first (int): First byte offset.
+            last (int): Last byte offset, inclusive.
+            chunk_size (int): Bytes per chunk of in-memory assets.
+
+        Returns:
+            generator: The byte chunks.
+        """
+        if hasattr(content, 'stream_data_in_range'):
+            yield from content.stream_data_in_range(first, last)
+            return
+        data = memoryview(content.data)
+        for start in range(first, last + 1, chunk_size):
+            yield bytes(data[start:min(start + chunk_size, last + 1)])
@@ -83,6 +83,8 @@ class AnnotationStorage extends SimpleEventEmitter {
             maxRetries: 5, // Limit to 5 retries maximum
             retryDelay: 1000, // Base delay of 1 second
             maxRetryDelay: 30000, // Maximum delay of 30 seconds
+            maxPageLoads: 20, // Page loads kept for revalidation
+            debug: false, // Log save/load details to the console (the debug_mode setting)
             ...options.config
         };
 
@@ -91,6 +93,13 @@ class AnnotationStorage extends SimpleEventEmitter {
         // Cache
         this.annotationCache = new Map();
         this.dirtyPages = new Set();
+        this.persistedIds = new Set(); // Annotation ids already stored on the server
+        this.lastLoad = null; // ETag and data of the last full load, for conditional reloads
+        this.pageLoads = new Map(); // Pages parameter -> ETag and data of its last load, for conditional reloads
+        this.revision = null; // Server revision our view of the annotations is based on
+        this.conflictPages = new Set(); // Pages changed by another session, reloaded after our next save
+        this.usage = null; // Stored annotation count and bytes, with the server limits
+        this.inFlightBatch = null; // Save batch awaiting a server answer, resent as is on retry
 
         // Save state
         this.isSaving = false;
@@ -206,36 +215,84 @@ class AnnotationStorage extends SimpleEventEmitter {
         console.log(`[AnnotationStorage] SAVE_QUEUE: Processing save queue - saveQueue: ${this.saveQueue.length}, deleteQueue: ${this.deleteQueue.length}`);
 
         try {
-            // Prepare data to save with proper user context
-            const saveData = this._prepareSaveData();
+            // A failed batch is resent as is, under the same idempotency key, so the
+            // server replays its response if it already applied the first attempt
+            if (!this.inFlightBatch) {
+                // Prepare data to save with proper user context
+                const saveData = this._prepareSaveData();
+
+                if (!saveData || (Object.keys(saveData).length === 0 && this.deleteQueue.length === 0)) {
+                    this._debug(`SAVE_QUEUE: No data to save - saveData: ${!!saveData}, deleteQueue: ${this.deleteQueue.length}`);
+                    this.isSaving = false;
+                    return;
+                }
 
-            if (!saveData || (Object.keys(saveData).length === 0 && this.deleteQueue.length === 0)) {
-                console.log(`[AnnotationStorage] SAVE_QUEUE: No data to save - saveData: ${!!saveData}, deleteQueue: ${this.deleteQueue.length}`);
-                this.isSaving = false;
-                return;
+                this.inFlightBatch = {
+                    idempotencyKey: this._generateIdempotencyKey(),
+                    createdAt: Date.now(),
+                    saveData: saveData,
+                    operations: this._prepareOperations(),
+                    currentPage: this.currentPage,
+                    baseRevision: this.revision
+                };
             }
+            const { idempotencyKey, createdAt, saveData, operations, currentPage, baseRevision } = this.inFlightBatch;
 
             console.log(`[AnnotationStorage] SAVE_REQUEST: Sending request to server for user: ${this.userId}, block: ${this.blockId}, handlerUrl: ${this.handlerUrl}`);
             console.log(`[AnnotationStorage] SAVE_REQUEST: Save data structure:`, Object.keys(saveData));
 
                             // Save to server with user context
                 if (this.handlerUrl) {
+                    // Send only the changed annotations as ordered delta operations
                     const requestData = {
-                        action: 'save',
+                        action: 'apply_ops',
+                        idempotencyKey: idempotencyKey,
                         userId: this.userId,
                         courseId: this.courseId,
                         blockId: this.blockId,
-                        data: saveData,
-                        deletions: this.deleteQueue, // Include deletions
-                        currentPage: this.currentPage, // Include current page
-                        timestamp: Date.now()
+                        ops: operations,
+                        currentPage: currentPage, // Include current page
+                        timestamp: createdAt
                     };
+                    if (baseRevision !== null) {
+                        requestData.baseRevision = baseRevision;
+                    }
 
                 console.log(`[AnnotationStorage] SAVE_REQUEST: About to make POST request to ${this.handlerUrl}`);
                 const response = await this._makeRequest('POST', this.handlerUrl, requestData);
                 console.log(`[AnnotationStorage] SAVE_RESPONSE: Received response:`, response);
 
-                if (response.result === 'success') {
+                if (response.result === 'conflict') {
+                    this.inFlightBatch = null;
+                    this._handleSaveConflict(response);
+                } else if (response.result === 'success') {
+                    this.inFlightBatch = null;
+                    this._markOperationsPersisted(operations);
+                    if (response.revision !== undefined) {
+                        this.revision = response.revision;
+                    }
+                    // Pages another tab saved since our last load; our changes were merged by id
+                    const changedPages = new Set([...(response.mergedPages || []).map(page => String(page)), ...this.conflictPages]);
+                    this.conflictPages.clear();
+                    if (changedPages.size > 0) {
+                        this.emit('pagesChangedRemotely', [...changedPages]);
+                    }
+                    if (response.rejected && response.rejected.length > 0) {
+                        this._debug(`SAVE_RESPONSE: Server rejected ${response.rejected.length} operations:`, response.rejected);
+                    }
+                    if (response.usage) {
+                        this.usage = response.usage;
+                    }
+                    if (response.limitExceeded) {
+                        // Retrying would be refused again, so the rejected operations are dropped
+                        this.emit('error', {
+                            type: 'limit_exceeded',
+                            message: response.limitExceeded.message,
+                            limit: response.limitExceeded.limit,
+                            usage: response.usage
+                        });
+                    }
+
                     // FIXED: Only clear the annotations that were actually saved in this batch
                     // Create a set of saved annotation IDs to track what was actually processed
                     const savedAnnotationIds = new Set();
@@ -251,13 +308,14 @@ class AnnotationStorage extends SimpleEventEmitter {
                         });
                     });
 
-                    // Only remove items from saveQueue that were actually saved
+                    // Only remove items from saveQueue that were actually saved, and not changed since
                     this.saveQueue = this.saveQueue.filter(item =>
-                        item.type !== 'save' || !savedAnnotationIds.has(item.annotation.id)
+                        item.type !== 'save' || !savedAnnotationIds.has(item.annotation.id) || item.timestamp > createdAt
                     );
 
-                    // Clear delete queue (these are always processed completely)
-                    this.deleteQueue = [];
+                    // Remove the deletions sent in this batch
+                    const sentDeletions = new Set(operations.filter(operation => operation.op === 'delete').map(operation => operation.id));
+                    this.deleteQueue = this.deleteQueue.filter(deletion => !sentDeletions.has(deletion.id));
 
                     // Only clear dirty pages that had annotations saved
                     const savedPages = new Set();
@@ -292,6 +350,87 @@ class AnnotationStorage extends SimpleEventEmitter {
         }
     }
 
+    /**
+     * Log save and load details, only when the block's debug mode is on
+     */
+    _debug(message, ...details) {
+        if (this.config.debug) {
+            console.log(`[AnnotationStorage] ${message}`, ...details);
+        }
+    }
+
+    /**
+     * Generate a key identifying one save batch across its retries
+     */
+    _generateIdempotencyKey() {
+        if (window.crypto && typeof window.crypto.randomUUID === 'function') {
+            return window.crypto.randomUUID();
+        }
+        return `${this.blockId}-${Date.now()}-${Math.random().toString(36).substr(2, 12)}`;
+    }
+
+    /**
+     * Handle a 409 from a save based on an outdated revision.
+     * Queued saves and deletes are kept: they are keyed by annotation id, so they
+     * are applied again on top of the server's pages when resent against the new
+     * revision. The conflicting pages are reloaded once that save went through.
+     */
+    _handleSaveConflict(response) {
+        const conflictPages = (response.conflicts || []).map(page => String(page));
+        conflictPages.forEach(page => this.conflictPages.add(page));
+
+        this.revision = response.revision;
+        this._rememberPersisted(response.pages || {});
+        this._showConflictNotification(conflictPages);
+        this.emit('saveConflict', { conflicts: conflictPages, pages: response.pages || {} });
+
+        if (this.saveQueue.length > 0 || this.deleteQueue.length > 0) {
+            setTimeout(() => this._processSaveQueue(), 0);
+        }
+    }
+
+    /**
+     * Tell the user that another session changed pages they are editing
+     */
+    _showConflictNotification(pages) {
+        const noticeId = `annotation-conflict-${this.blockId}`;
+        let notice = document.getElementById(noticeId);
+
+        if (!notice) {
+            notice = document.createElement('div');
+            notice.id = noticeId;
+            notice.className = 'annotation-conflict-notification';
+            notice.style.cssText = `
+                position: fixed;
+                top: 20px;
+                right: 20px;
+                background: #f0ad4e;
+                color: #222;
+                padding: 15px 20px;
+                border-radius: 5px;
+                box-shadow: 0 4px 12px rgba(0,0,0,0.3);
+                z-index: 10000;
+                max-width: 400px;
+                font-family: Arial, sans-serif;
+                font-size: 14px;
+                line-height: 1.4;
+            `;
+            document.body.appendChild(notice);
+        }
+
+        const pageList = pages.length > 0 ? ` (page${pages.length === 1 ? '' : 's'} ${pages.join(', ')})` : '';
+        notice.innerHTML = `
+            <div style="font-weight: bold; margin-bottom: 8px;">Annotations changed in another window</div>
+            <div>Your changes${pageList} are being saved on top of theirs, and the pages will reload with both.</div>
+        `;
+
+        setTimeout(() => {
+            if (notice.parentNode) {
+                notice.remove();
+            }
+        }, 10000);
+    }
+
     /**
      * Prepare save data with enhanced structure and user context
      */
@@ -343,6 +482,71 @@ class AnnotationStorage extends SimpleEventEmitter {
         return dataByType;
     }
 
+    /**
+     * Convert the save and delete queues into ordered delta operations
+     */
+    _prepareOperations() {
+        const operations = [];
+
+        this.saveQueue.forEach(item => {
+            if (item.type !== 'save') {
+                return;
+            }
+
+            const annotation = item.annotation;
+            const pageNum = annotation.pageNum || 1;
+
+            if (annotation.type === 'clear_action') {
+                const clearData = annotation.data || {};
+                if (clearData.action === 'clear_page' && clearData.pageNum) {
+                    operations.push({ op: 'clear', page: clearData.pageNum });
+                } else if (clearData.action === 'clear_all') {
+                    operations.push({ op: 'clear' });
+                }
+                return;
+            }
+
+            if (annotation.data && annotation.data._deleted) {
+                operations.push({ op: 'delete', id: annotation.id, type: annotation.type, page: pageNum });
+                return;
+            }
+
+            operations.push({
+                op: this.persistedIds.has(annotation.id) ? 'update' : 'add',
+                id: annotation.id,
+                type: annotation.type,
+                page: pageNum,
+                annotation: {
+                    id: annotation.id,
+                    type: annotation.type,
+                    pageNum: annotation.pageNum,
+                    timestamp: annotation.timestamp || Date.now(),
+                    data: annotation.data || {},
+                    config: annotation.config || {}
+                }
+            });
+        });
+
+        this.deleteQueue.forEach(deletion => {
+            operations.push({ op: 'delete', id: deletion.id, type: deletion.type, page: deletion.pageNum });
+        });
+
+        return operations;
+    }
+
+    /**
+     * Remember which annotation ids the server now holds
+     */
+    _markOperationsPersisted(operations) {
+        operations.forEach(operation => {
+            if (operation.op === 'add' || operation.op === 'update') {
+                this.persistedIds.add(operation.id);
+            } else if (operation.op === 'delete') {
+                this.persistedIds.delete(operation.id);
+            }
+        });
+    }
+
     /**
      * Start auto-save with enhanced timing based on tool activity
      */
@@ -410,12 +614,13 @@ class AnnotationStorage extends SimpleEventEmitter {
     /**
      * Enhanced HTTP request with better error handling
      */
-    async _makeRequest(method, url, data = null) {
+    async _makeRequest(method, url, data = null, extraHeaders = {}) {
         const options = {
             method: method,
             headers: {
                 'Content-Type': 'application/json',
-                'X-Requested-With': 'XMLHttpRequest'
+                'X-Requested-With': 'XMLHttpRequest',
+                ...extraHeaders
             },
             credentials: 'same-origin'
         };
@@ -453,12 +658,25 @@ class AnnotationStorage extends SimpleEventEmitter {
 
             const response = await fetch(url, options);
 
+            if (response.status === 304) {
+                return { notModified: true };
+            }
+
+            if (response.status === 409) {
+                // Save conflict: the body carries the current state of the conflicting pages
+                return await response.json();
+            }
+
             if (!response.ok) {
                 throw new Error(`HTTP ${response.status}: ${response.statusText}`);
             }
 
             const responseData = await response.json();
             console.log(`[AnnotationStorage] Response received:`, responseData.result || responseData.success ? 'success' : 'error');
+            const etag = response.headers.get('ETag');
+            if (etag && responseData && typeof responseData === 'object') {
+                responseData.etag = etag;
+            }
 
             return responseData;
 
@@ -577,6 +795,7 @@ class AnnotationStorage extends SimpleEventEmitter {
             const failedDeleteCount = this.deleteQueue.length;
             this.saveQueue = [];
             this.deleteQueue = [];
+            this.inFlightBatch = null;
 
             console.error(`[AnnotationStorage] SAVE_ERROR: Cleared ${failedSaveCount} pending saves and ${failedDeleteCount} pending deletions`);
 
@@ -695,10 +914,29 @@ class AnnotationStorage extends SimpleEventEmitter {
             // Add user context to load request
             const loadUrl = `${this.handlerUrl}?action=load&userId=${encodeURIComponent(this.userId)}&blockId=${encodeURIComponent(this.blockId)}&courseId=${encodeURIComponent(this.courseId)}&timestamp=${Date.now()}`;
 
-            const response = await this._makeRequest('GET', loadUrl);
+            // Revalidate the last full load: the server answers 304 if nothing changed since
+            const headers = this.lastLoad && this.lastLoad.etag ? { 'If-None-Match': this.lastLoad.etag } : {};
+            const response = await this._makeRequest('GET', loadUrl, null, headers);
+
+            if (response.notModified && this.lastLoad) {
+                this._debug(`Annotations unchanged since ${this.lastLoad.etag}`);
+                const mergedData = { ...existingData, ...this.lastLoad.data };
+                this.emit('annotationsLoaded', mergedData);
+                return mergedData;
+            }
 
             if (response.success && response.data) {
                 console.log(`[AnnotationStorage] Loaded annotations from server:`, Object.keys(response.data));
+                this.lastLoad = { etag: response.etag, data: response.data };
+                if (response.revision !== undefined) {
+                    this.revision = response.revision;
+                }
+                if (response.usage) {
+                    this.usage = response.usage;
+                }
+
+                // Annotations returned by the server are updated, not re-added, on the next save
+                this._rememberPersisted(response.data);
 
                 // Merge with existing data
                 const mergedData = { ...existingData, ...response.data };
@@ -718,6 +956,65 @@ class AnnotationStorage extends SimpleEventEmitter {
         }
     }
 
+    /**
+     * Load the annotations of some pages only
+     * @param {Array} pageRanges - [first, last] page ranges
+     * @returns {Object|null} Annotations by type and page, or null if the request failed
+     */
+    async loadPages(pageRanges) {
+        if (!this.handlerUrl || pageRanges.length === 0) {
+            return null;
+        }
+
+        try {
+            const pages = pageRanges.map(([first, last]) => first === last ? `${first}` : `${first}-${last}`).join(',');
+            const loadUrl = `${this.handlerUrl}?action=load_pages&pages=${encodeURIComponent(pages)}&timestamp=${Date.now()}`;
+
+            // Revalidate an earlier load of the same pages: the server answers 304 if nothing changed since
+            const lastLoad = this.pageLoads.get(pages);
+            const headers = lastLoad && lastLoad.etag ? { 'If-None-Match': lastLoad.etag } : {};
+            const response = await this._makeRequest('GET', loadUrl, null, headers);
+
+            if (response.notModified && lastLoad) {
+                return lastLoad.data;
+            }
+
+            if (response.success && response.data) {
+                this._rememberPersisted(response.data);
+                if (response.etag) {
+                    this.pageLoads.delete(pages);
+                    this.pageLoads.set(pages, { etag: response.etag, data: response.data });
+                    if (this.pageLoads.size > this.config.maxPageLoads) {
+                        this.pageLoads.delete(this.pageLoads.keys().next().value);
+                    }
+                }
+                if (response.revision !== undefined) {
+                    // Saves are now based on what we just saw, including other sessions' changes
+                    this.revision = Math.max(this.revision === null ? 0 : this.revision, response.revision);
+                }
+                return response.data;
+            }
+            this._debug(`Failed to load pages ${pages}:`, response);
+        } catch (error) {
+            console.error(`[AnnotationStorage] Error loading pages:`, error);
+        }
+        return null;
+    }
+
+    /**
+     * Remember the ids of annotations loaded from the server
+     */
+    _rememberPersisted(data) {
+        Object.values(data).forEach(typeData => {
+            if (!typeData || typeof typeData !== 'object') return;
+            Object.values(typeData).forEach(pageAnnotations => {
+                if (Array.isArray(pageAnnotations)) {
+                    pageAnnotations.forEach(annotation => annotation && annotation.id && this.persistedIds.add(annotation.id));
+                }
+            });
+        });
+    }
+
     /**
      * Bind methods to this context
      */
@@ -726,6 +1023,7 @@ class AnnotationStorage extends SimpleEventEmitter {
         this._processSaveQueue = this._processSaveQueue.bind(this);
         this.setToolActive = this.setToolActive.bind(this);
         this.loadAnnotations = this.loadAnnotations.bind(this);
+        this.loadPages = this.loadPages.bind(this);
     }
 
     /**
@@ -911,6 +1209,15 @@ class PdfxViewer {
         // Page tracking state
         this.currentPage = config.currentPage || 1;
 
+        // Pages whose annotations are loaded; student_view embeds a window around the current page
+        this.loadedPages = new Set();
+        if (config.loadedPages) {
+            const [first, last] = config.loadedPages;
+            for (let page = first; page <= last; page++) {
+                this.loadedPages.add(page);
+            }
+        }
+
         // Debug configuration
         console.log(`[PdfxViewer] Initializing with config:`, config);
         console.log(`[PdfxViewer] PDF URL:`, config.pdfUrl);
@@ -921,6 +1228,15 @@ class PdfxViewer {
         this.init();
     }
 
+    /**
+     * Log viewer details, only when the block's debug mode is on
+     */
+    _debug(message, ...details) {
+        if (this.config.debug) {
+            console.log(`[PdfxViewer] ${message}`, ...details);
+        }
+    }
+
     /**
      * Initialize annotation storage system
      */
@@ -937,9 +1253,13 @@ class PdfxViewer {
                 userId: this.config.userId,
                 courseId: this.config.courseId,
                 handlerUrl: this.config.handlerUrl,
-                allowAnnotation: this.config.allowAnnotation
+                allowAnnotation: this.config.allowAnnotation,
+                config: {debug: this.config.debug}
             });
 
+            // Reload pages another session changed under us, once our own changes to them are saved
+            this.annotationStorage.on('pagesChangedRemotely', pages => this.refreshPages(pages));
+
             // Initialize AnnotationInterface
             this.annotationInterface = new AnnotationInterface(this.annotationStorage, {
                 blockId: this.blockId,
@@ -1172,6 +1492,11 @@ class PdfxViewer {
             outerContainer.classList.remove('loadingInProgress');
         }
 
+        // Text layers come from the server's precomputed runs instead of getTextContent
+        if (this.config.textLayerUrl) {
+            this.useServerTextRuns(pdfDocument);
+        }
+
         // Set document in services (following Mozilla pattern)
         this.pdfLinkService.setDocument(pdfDocument);
         this.pdfViewer.setDocument(pdfDocument);
@@ -1243,6 +1568,91 @@ class PdfxViewer {
         }
     }
 
+    /**
+     * Make every page's text layer read the runs precomputed at upload.
+     *
+     * pdf.js's TextLayerBuilder reads a page's text from pdfPage.streamTextContent(),
+     * so each page is given a stream of the fetched runs instead; the text layer,
+     * its zoom updates and text selection for HighlightTool stay with pdf.js.
+     */
+    useServerTextRuns(pdfDocument) {
+        const getPage = pdfDocument.getPage.bind(pdfDocument);
+        pdfDocument.getPage = pageNumber => getPage(pageNumber).then(pdfPage => {
+            if (!pdfPage.pdfxServerTextRuns) {
+                const streamTextContent = pdfPage.streamTextContent.bind(pdfPage);
+                pdfPage.streamTextContent = params => this.streamServerTextContent(pageNumber, () => streamTextContent(params));
+                pdfPage.pdfxServerTextRuns = true;
+            }
+            return pdfPage;
+        });
+    }
+
+    /**
+     * Fetch the precomputed text runs of a page, once per page
+     */
+    fetchTextRuns(pageNumber) {
+        if (!this.textRunRequests) {
+            this.textRunRequests = new Map();
+        }
+        if (!this.textRunRequests.has(pageNumber)) {
+            const separator = this.config.textLayerUrl.includes('?') ? '&' : '?';
+            const request = fetch(`${this.config.textLayerUrl}${separator}page=${pageNumber}`, { credentials: 'same-origin' })
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error(`HTTP ${response.status}`);
+                    }
+                    return response.json();
+                });
+            request.catch(() => this.textRunRequests.delete(pageNumber));
+            this.textRunRequests.set(pageNumber, request);
+        }
+        return this.textRunRequests.get(pageNumber);
+    }
+
+    /**
+     * A pdf.js text content stream of a page's precomputed runs, falling back
+     * to pdf.js's own extraction if they cannot be fetched
+     */
+    streamServerTextContent(pageNumber, fallback) {
+        return new ReadableStream({
+            start: async (controller) => {
+                try {
+                    const { runs } = await this.fetchTextRuns(pageNumber);
+                    controller.enqueue({
+                        // Each run is [text, a, b, c, d, e, f, width] in PDF units
+                        items: runs.map(([str, a, b, c, d, e, f, width]) => ({
+                            str,
+                            dir: 'ltr',
+                            width,
+                            height: Math.hypot(c, d),
+                            transform: [a, b, c, d, e, f],
+                            fontName: 'pdfx',
+                            hasEOL: false
+                        })),
+                        styles: { pdfx: { fontFamily: 'sans-serif', ascent: 0.8, descent: -0.2, vertical: false } },
+                        lang: null
+                    });
+                    controller.close();
+                } catch (error) {
+                    this._debug(`Precomputed text of page ${pageNumber} unavailable, extracting it:`, error);
+                    try {
+                        const reader = fallback().getReader();
+                        for (;;) {
+                            const { value, done } = await reader.read();
+                            if (done) {
+                                break;
+                            }
+                            controller.enqueue(value);
+                        }
+                        controller.close();
+                    } catch (fallbackError) {
+                        controller.error(fallbackError);
+                    }
+                }
+            }
+        });
+    }
+
     // Close document (following Mozilla pattern)
     async close() {
         if (!this.pdfLoadingTask) {
@@ -1309,6 +1719,7 @@ class PdfxViewer {
                     pageNumberInput.value = pageNumber;
                 }
                 this.saveCurrentPage(pageNumber);
+                this.loadPageWindow(pageNumber);
 
                 // Emit custom event for other components (like ToolManager)
                 document.dispatchEvent(new CustomEvent('pageChanged', {
@@ -1324,6 +1735,13 @@ class PdfxViewer {
                 this.updateZoomDisplay(scale);
             });
 
+            // Staff only: paint the class highlight heatmap beside each rendered page
+            if (this.config.classHeatmap && Object.keys(this.config.classHeatmap).length > 0) {
+                this.eventBus.on('pagerendered', (evt) => {
+                    this.renderClassHeatmap(evt.pageNumber, evt.source && evt.source.div);
+                });
+            }
+
             // Listen for when pages are actually rendered and ready
             this.eventBus.on('pagesloaded', () => {
                 console.log('[PdfxViewer] All pages loaded and ready');
@@ -1894,6 +2312,25 @@ class PdfxViewer {
             nextBtn.addEventListener('click', () => this.nextPage());
         }
 
+        // Outline rendered by student_view from the upload-time analysis
+        const outline = document.getElementById(`outline-${this.blockId}`);
+        if (outline) {
+            outline.addEventListener('click', (e) => {
+                const link = e.target.closest('a[data-page]');
+                if (!link) {
+                    return;
+                }
+                e.preventDefault();
+                const pageNumber = parseInt(link.dataset.page);
+                if (this.pdfDocument) {
+                    this.goToPage(pageNumber);
+                } else {
+                    // Not open yet: load() starts at this page
+                    this.config.currentPage = pageNumber;
+                }
+            });
+        }
+
         if (pageInput) {
             pageInput.addEventListener('change', (e) => {
                 const pageNumber = parseInt(e.target.value);
@@ -1991,7 +2428,9 @@ class PdfxViewer {
 
             console.log(`[PdfxViewer] Loading annotations with existing data:`, Object.keys(existingData));
 
-            const loadedData = await this.annotationStorage.loadAnnotations(existingData);
+            // Refresh the embedded page window only; other pages are loaded as the reader reaches them
+            const pageData = await this.annotationStorage.loadPages(this._loadedPageRanges());
+            const loadedData = { ...existingData, ...(pageData || {}) };
 
             console.log(`[PdfxViewer] Successfully loaded annotations:`, Object.keys(loadedData));
 
@@ -2018,6 +2457,100 @@ class PdfxViewer {
         }
     }
 
+    /**
+     * Load and render the annotations of the pages around a page that are not loaded yet
+     */
+    async loadPageWindow(pageNumber) {
+        if (!this.annotationStorage) return;
+
+        const preload = this.config.preloadPages || 0;
+        const numPages = this.pdfDocument ? this.pdfDocument.numPages : pageNumber + preload;
+        const missing = [];
+        for (let page = Math.max(1, pageNumber - preload); page <= Math.min(numPages, pageNumber + preload); page++) {
+            if (!this.loadedPages.has(page)) {
+                missing.push(page);
+                this.loadedPages.add(page);
+            }
+        }
+        if (missing.length === 0) return;
+
+        const pageData = await this.annotationStorage.loadPages(this._toPageRanges(missing));
+        if (!pageData) {
+            // Retry on the next page change
+            missing.forEach(page => this.loadedPages.delete(page));
+            return;
+        }
+
+        const configKeys = {
+            highlights: 'highlights',
+            drawing_strokes: 'drawingStrokes',
+            marker_strokes: 'markerStrokes',
+            text_annotations: 'textAnnotations',
+            shape_annotations: 'shapeAnnotations'
+        };
+        Object.entries(configKeys).forEach(([type, configKey]) => {
+            this.config[configKey] = { ...(this.config[configKey] || {}), ...(pageData[type] || {}) };
+        });
+
+        this._debug(`Loaded annotations for pages: ${missing.join(', ')}`);
+        this.renderLoadedAnnotations(pageData);
+    }
+
+    /**
+     * Forget the loaded annotations of some pages and reload those in the current window
+     */
+    refreshPages(pages) {
+        pages.forEach(page => this.loadedPages.delete(Number(page)));
+        this.loadPageWindow(this.currentPage);
+    }
+
+    /**
+     * Draw the class heatmap segments of a page as a strip along its right edge
+     */
+    renderClassHeatmap(pageNumber, pageDiv) {
+        const segments = this.config.classHeatmap[String(pageNumber)];
+        if (!pageDiv || !segments) return;
+
+        let strip = pageDiv.querySelector('.pdfx-class-heatmap');
+        if (!strip) {
+            strip = document.createElement('div');
+            strip.className = 'pdfx-class-heatmap';
+            strip.title = 'Class highlights';
+            pageDiv.appendChild(strip);
+        }
+        strip.replaceChildren();
+
+        // Segments are [start, end, count] in steps of the page height (HEATMAP_RESOLUTION)
+        const resolution = this.config.heatmapResolution;
+        const maxCount = Math.max(...segments.map(segment => segment[2]));
+        segments.forEach(([start, end, count]) => {
+            const band = document.createElement('div');
+            band.className = 'pdfx-class-heatmap-band';
+            band.style.top = `${(start / resolution) * 100}%`;
+            band.style.height = `${((end - start) / resolution) * 100}%`;
+            band.style.opacity = (0.2 + 0.8 * count / maxCount).toFixed(2);
+            band.title = `${count} highlight${count === 1 ? '' : 's'}`;
+            strip.appendChild(band);
+        });
+    }
+
+    _loadedPageRanges() {
+        return this._toPageRanges([...this.loadedPages].sort((a, b) => a - b));
+    }
+
+    _toPageRanges(sortedPages) {
+        const ranges = [];
+        sortedPages.forEach(page => {
+            const last = ranges[ranges.length - 1];
+            if (last && page === last[1] + 1) {
+                last[1] = page;
+            } else {
+                ranges.push([page, page]);
+            }
+        });
+        return ranges;
+    }
+
     renderLoadedAnnotations(loadedData) {
         console.log(`[PdfxViewer] Rendering loaded annotations:`, Object.keys(loadedData));
 
@@ -2827,6 +3360,10 @@ window.PdfxXBlockInit = function(runtime, element) {
     console.log('[PdfxXBlockInit] Raw allowAnnotation value:', pdfxElement.dataset.allowAnnotation);
     console.log('[PdfxXBlockInit] Raw allowDownload value:', pdfxElement.dataset.allowDownload);
 
+    // Saved annotations and document info arrive as one JSON script block
+    const stateElement = document.getElementById(`pdfx-state-${blockId}`);
+    const initialState = safeJsonParse(stateElement ? stateElement.textContent : null, {}) || {};
+
     const config = {
         blockId: blockId,
         pdfUrl: pdfxElement.dataset.pdfUrl || '',
@@ -2834,14 +3371,20 @@ window.PdfxXBlockInit = function(runtime, element) {
         // TEMPORARY FIX: Force annotations to be enabled for frontend testing
         allowAnnotation: true, // pdfxElement.dataset.allowAnnotation === 'true',
         currentPage: parseInt(pdfxElement.dataset.currentPage) || 1,
+        preloadPages: parseInt(pdfxElement.dataset.preloadPages) || 0,
+        loadedPages: (pdfxElement.dataset.loadedPages || '').split('-').map(Number).filter(Boolean),
         userId: pdfxElement.dataset.userId || 'anonymous',
         courseId: pdfxElement.dataset.courseId || '',
         handlerUrl: pdfxElement.dataset.handlerUrl || '',
-        drawingStrokes: safeJsonParse(pdfxElement.dataset.drawingStrokes, {}),
-        highlights: safeJsonParse(pdfxElement.dataset.highlights, {}),
-        markerStrokes: safeJsonParse(pdfxElement.dataset.markerStrokes, {}),
-        textAnnotations: safeJsonParse(pdfxElement.dataset.textAnnotations, {}),
-        shapeAnnotations: safeJsonParse(pdfxElement.dataset.shapeAnnotations, {})
+        textLayerUrl: pdfxElement.dataset.textLayerUrl || '',
+        drawingStrokes: initialState.drawingStrokes || {},
+        highlights: initialState.highlights || {},
+        markerStrokes: initialState.markerStrokes || {},
+        textAnnotations: initialState.textAnnotations || {},
+        shapeAnnotations: initialState.shapeAnnotations || {},
+        classHeatmap: initialState.classHeatmap || {},
+        heatmapResolution: initialState.heatmapResolution || 1000,
+        debug: initialState.debugMode === true
     };
 
     console.log(`[PdfxXBlockInit] Configuration:`, config);
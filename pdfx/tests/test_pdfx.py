@@ -5,18 +5,82 @@ This module contains unit tests for the PDF XBlock functionality.
 """
 
 import unittest
+import base64
+import hashlib
+import io
 import json
+import os
+import re
+import shutil
+import tempfile
+import zlib
+from collections import namedtuple
+from datetime import datetime
 import mock
-from webob import Response
+from webob import Request, Response
 from xblock.field_data import DictFieldData
+from xblock.fields import ScopeIds
 from xblock.test.tools import TestRuntime
 
 from pdfx.pdfx import PdfxXBlock
 from pdfx.models import (
     Annotation, DrawingAnnotation, TextAnnotation,
-    HighlightAnnotation, ShapeAnnotation
+    HighlightAnnotation, ShapeAnnotation, AnnotationIndex, AnnotationUsage, CompressedDict, HighlightHeatmap,
+    StrokeCodec
 )
-from pdfx.services import PdfService, AnnotationService, ThumbnailService
+from pdfx import assets, export, migrate, services
+from pdfx.config import DEFAULT_SETTINGS, STUDENT_VIEW_CSS, STUDENT_VIEW_JS
+from pdfx.instrumentation import DebugEvents, Metrics
+from pdfx.services import (
+    PdfService, AnnotationService, ThumbnailService, StrokeSimplifier, IdempotencyStore,
+    AnnotationExporter, AssetStream, DerivedAsset, FieldAnnotationBackend, PdfAnalyzer, PdfTextIndex, PdfTextLayer,
+    PdfUpload, PdfUploadError, SqliteAnnotationBackend, TemplateCache
+)
+
+
+CSRF_TOKEN = 'x' * 32
+
+
+def make_annotation_block(field_data=None):
+    """Create a block wired to a test runtime, usable by the annotation handlers."""
+    runtime = TestRuntime(services={'user': None})
+    block = PdfxXBlock(
+        runtime,
+        DictFieldData(field_data or {}),
+        ScopeIds('student1', 'pdfx', 'def-1', 'usage-1')
+    )
+    block.location = mock.Mock()
+    return block
+
+
+def make_json_request(data, method='POST'):
+    """Create a mock handler request carrying a JSON body and a valid CSRF token."""
+    request = mock.Mock()
+    request.method = method
+    request.body = json.dumps(data).encode()
+    request.headers = {'X-CSRFToken': CSRF_TOKEN}
+    request.cookies = {'csrftoken': CSRF_TOKEN}
+    return request
+
+
+def make_text_pdf(page_texts):
+    """Write a Letter-size PDF with one line of Helvetica text per page (needs pypdf)."""
+    from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+    writer = services.pypdf.PdfWriter()
+    font = DictionaryObject({
+        NameObject('/Type'): NameObject('/Font'),
+        NameObject('/Subtype'): NameObject('/Type1'),
+        NameObject('/BaseFont'): NameObject('/Helvetica'),
+    })
+    for text in page_texts:
+        page = writer.add_blank_page(612, 792)
+        page[NameObject('/Resources')] = DictionaryObject({NameObject('/Font'): DictionaryObject({NameObject('/F1'): font})})
+        contents = DecodedStreamObject()
+        contents.set_data(f'BT /F1 12 Tf 72 700 Td ({text}) Tj ET'.encode('latin-1'))
+        page.replace_contents(contents)
+    stream = io.BytesIO()
+    writer.write(stream)
+    return stream
 
 
 class PdfxXBlockTests(unittest.TestCase):
@@ -127,19 +191,13 @@ class PdfxXBlockTests(unittest.TestCase):
 
     def test_studio_submit(self):
         """Test studio_submit handler."""
-        # Test data
-        data = {
+        # The studio editor posts its fields as form data
+        request = Request.blank('/', POST={
             'display_name': 'Updated PDF',
             'pdf_url': 'https://example.com/updated.pdf',
-            'enable_annotations': False,
-            'enable_thumbnail_nav': False,
-            'show_toolbar': False,
-        }
-
-        # Mock request
-        request = mock.Mock()
-        request.method = 'POST'
-        request.body = json.dumps(data).encode()
+            'allow_download': 'false',
+            'allow_annotation': 'false',
+        })
 
         # Call the handler
         response = self.block.studio_submit(request)
@@ -147,13 +205,67 @@ class PdfxXBlockTests(unittest.TestCase):
         # Check the response
         self.assertIsInstance(response, Response)
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.body)['result'], 'success')
 
         # Check that the fields were updated
-        self.assertEqual(self.block.display_name, data['display_name'])
-        self.assertEqual(self.block.pdf_url, data['pdf_url'])
-        self.assertEqual(self.block.enable_annotations, data['enable_annotations'])
-        self.assertEqual(self.block.enable_thumbnail_nav, data['enable_thumbnail_nav'])
-        self.assertEqual(self.block.show_toolbar, data['show_toolbar'])
+        self.assertEqual(self.block.display_name, 'Updated PDF')
+        self.assertEqual(self.block.pdf_url, 'https://example.com/updated.pdf')
+        self.assertFalse(self.block.allow_download)
+        self.assertFalse(self.block.allow_annotation)
+
+
+class AnnotationOpsTests(unittest.TestCase):
+    """Test cases for the delta operation save protocol."""
+
+    def setUp(self):
+        """Set up a block with existing annotations on two pages."""
+        self.block = make_annotation_block({
+            'highlights': {
+                '1': [{'id': 'h1', 'type': 'highlight', 'data': {'text': 'old'}}],
+                '2': [{'id': 'h2', 'type': 'highlight', 'data': {}}],
+            }
+        })
+
+    def apply(self, ops):
+        response = self.block.save_annotations(make_json_request({
+            'action': 'apply_ops', 'userId': 'anonymous', 'ops': ops
+        }))
+        return response, json.loads(response.body)
+
+    def test_add_update_delete(self):
+        """Operations are applied in order and only touch their own pages."""
+        response, body = self.apply([
+            {'op': 'add', 'id': 'h3', 'type': 'highlight', 'page': 1,
+             'annotation': {'type': 'highlight', 'data': {'text': 'new'}}},
+            {'op': 'update', 'id': 'h1', 'type': 'highlight', 'page': 1,
+             'annotation': {'type': 'highlight', 'data': {'text': 'changed'}}},
+            {'op': 'delete', 'id': 'h2', 'type': 'highlight', 'page': 2},
+        ])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body['applied'], 3)
+        self.assertEqual(body['rejected'], [])
+        page_one = self.block.highlights['1']
+        self.assertEqual([ann['id'] for ann in page_one], ['h1', 'h3'])
+        self.assertEqual(page_one[0]['data'], {'text': 'changed'})
+        self.assertNotIn('2', self.block.highlights)
+
+    def test_invalid_operations_are_rejected(self):
+        """Malformed operations are reported without aborting the batch."""
+        _, body = self.apply([
+            {'op': 'rename', 'id': 'h1', 'type': 'highlight', 'page': 1},
+            {'op': 'add', 'id': 'x', 'type': 'unknown', 'page': 1, 'annotation': {}},
+            {'op': 'delete', 'id': 'h1', 'type': 'highlight', 'page': 1},
+        ])
+
+        self.assertEqual(body['applied'], 1)
+        self.assertEqual([item['index'] for item in body['rejected']], [0, 1])
+        self.assertNotIn('1', self.block.highlights)
+
+    def test_clear_page(self):
+        """A clear operation removes every annotation on the page."""
+        self.apply([{'op': 'clear', 'page': 2}])
+        self.assertEqual(list(self.block.highlights.keys()), ['1'])
 
 
 class AnnotationModelTests(unittest.TestCase):
@@ -307,6 +419,1453 @@ class AnnotationModelTests(unittest.TestCase):
         self.assertEqual(recreated.type, 'shape')
 
 
+class AnnotationIndexTests(unittest.TestCase):
+    """Test cases for the annotation id index."""
+
+    def setUp(self):
+        """Set up two fields and an index built over them."""
+        self.fields = {
+            'highlights': {'1': [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}]},
+            'marker_strokes': {'2': [{'id': 'd'}]},
+        }
+        self.index = AnnotationIndex({}, self.fields.__getitem__)
+        self.index.rebuild(self.fields.keys())
+
+    def test_rebuild_and_locate(self):
+        """Every stored annotation is located by id."""
+        self.assertEqual(self.index.locate('b'), ('highlights', '1', 1))
+        self.assertEqual(self.index.locate('d'), ('marker_strokes', '2', 0))
+        self.assertIsNone(self.index.locate('missing'))
+
+    def test_upsert_replaces_and_moves(self):
+        """Upserts replace in place, or move the annotation to its new page."""
+        self.assertTrue(self.index.upsert('highlights', '1', {'id': 'b', 'v': 2}))
+        self.assertEqual(self.fields['highlights']['1'][1], {'id': 'b', 'v': 2})
+
+        self.assertTrue(self.index.upsert('highlights', '3', {'id': 'a'}))
+        self.assertEqual(self.index.locate('a'), ('highlights', '3', 0))
+        self.assertEqual(len(self.fields['highlights']['1']), 2)
+
+        self.assertFalse(self.index.upsert('marker_strokes', '2', {'id': 'e'}))
+        self.assertEqual(self.index.locate('e'), ('marker_strokes', '2', 1))
+
+    def test_remove_keeps_slots_consistent(self):
+        """Removing keeps the page's order and moves the later annotations up."""
+        self.assertEqual(self.index.remove('a'), {'id': 'a'})
+        self.assertEqual(self.fields['highlights']['1'], [{'id': 'b'}, {'id': 'c'}])
+        self.assertEqual(self.index.locate('b'), ('highlights', '1', 0))
+        self.assertEqual(self.index.locate('c'), ('highlights', '1', 1))
+
+        self.index.remove('d')
+        self.assertNotIn('2', self.fields['marker_strokes'])
+        self.assertIsNone(self.index.remove('d'))
+
+    def test_stale_entries_are_ignored(self):
+        """Entries that no longer match the stored data are dropped."""
+        self.fields['highlights']['1'] = [{'id': 'c'}]
+        self.assertIsNone(self.index.locate('a'))
+        self.assertNotIn('a', self.index.entries)
+
+
+class StrokeCodecTests(unittest.TestCase):
+    """Test cases for the compact stroke point encoding."""
+
+    def make_stroke(self, count=200, scale=1.5):
+        """Build a drawing stroke annotation as sent by the ScribbleTool."""
+        points = [
+            {'x': 100 + i * 0.37, 'y': 250 - i * 0.81, 'color': '#ff0000', 'thickness': 2, 'opacity': 1}
+            for i in range(count)
+        ]
+        path = 'M ' + ' L '.join(f"{p['x']} {p['y']}" for p in points)
+        return {
+            'id': 'drawing_1', 'type': 'drawing_strokes',
+            'data': {'strokeData': {'id': 'stroke_1', 'points': points, 'pathData': path,
+                                    'originalScale': scale}},
+        }
+
+    def test_varint_round_trip(self):
+        """Signed integers survive packing and unpacking."""
+        values = [0, 1, -1, 63, -64, 64, 300, -300, 2 ** 40, -(2 ** 40)]
+        self.assertEqual(StrokeCodec.unpack_varints(StrokeCodec.pack_varints(values)), values)
+
+    def test_annotation_round_trip(self):
+        """Decoded points match the originals within the quantization step."""
+        stroke = self.make_stroke()
+        encoded = StrokeCodec.encode_annotation(stroke)
+        stroke_data = encoded['data']['strokeData']
+        self.assertNotIn('points', stroke_data)
+        self.assertNotIn('pathData', stroke_data)
+        self.assertIn('points', stroke['data']['strokeData'])
+
+        decoded = StrokeCodec.decode_annotation(encoded)['data']['strokeData']['points']
+        original = stroke['data']['strokeData']['points']
+        self.assertEqual(len(decoded), len(original))
+        for before, after in zip(original, decoded):
+            self.assertAlmostEqual(before['x'], after['x'], delta=1.5 / 20)
+            self.assertAlmostEqual(before['y'], after['y'], delta=1.5 / 20)
+            self.assertEqual(after['color'], '#ff0000')
+
+        self.assertLess(len(json.dumps(encoded)) * 5, len(json.dumps(stroke)))
+
+    def test_mixed_styles_are_not_encoded(self):
+        """Strokes whose points do not share one style are stored unchanged."""
+        stroke = self.make_stroke(count=3)
+        stroke['data']['strokeData']['points'][1]['color'] = '#00ff00'
+        self.assertIs(StrokeCodec.encode_annotation(stroke), stroke)
+        self.assertIs(StrokeCodec.decode_annotation(stroke), stroke)
+
+    def test_block_stores_encoded_and_loads_plain(self):
+        """Saved strokes are stored encoded and loaded with plain points."""
+        block = make_annotation_block()
+        stroke = self.make_stroke(count=10)
+        block.save_annotations(make_json_request({
+            'action': 'apply_ops', 'userId': 'anonymous',
+            'ops': [{'op': 'add', 'id': 'drawing_1', 'type': 'drawing_strokes', 'page': 1,
+                     'annotation': stroke}],
+        }))
+        self.assertIn('encodedPoints', block.drawing_strokes['1'][0]['data']['strokeData'])
+
+        response = block.save_annotations(make_json_request({'action': 'load'}))
+        loaded = json.loads(response.body)['data']['drawing_strokes']['1'][0]
+        # The stroke is a straight line, so simplification keeps its two ends
+        self.assertEqual(len(loaded['data']['strokeData']['points']), 2)
+
+
+class StrokeSimplifierTests(unittest.TestCase):
+    """Test cases for server-side stroke simplification."""
+
+    def make_points(self, count):
+        """Build a wavy freehand stroke with collinear noise between samples."""
+        return [{'x': i * 0.5, 'y': 10 * ((i // 20) % 2) + (i % 20) * 0.01, 'color': '#000'}
+                for i in range(count)]
+
+    def test_collinear_points_are_dropped(self):
+        """A straight line keeps only its end points."""
+        points = [{'x': i, 'y': 2 * i} for i in range(50)]
+        simplified = StrokeSimplifier.simplify_points(points, 0.1)
+        self.assertEqual(simplified, [points[0], points[-1]])
+
+    def test_corners_are_kept(self):
+        """Points farther than the tolerance from the simplified line are kept."""
+        points = [{'x': 0, 'y': 0}, {'x': 5, 'y': 5}, {'x': 10, 'y': 0}]
+        self.assertEqual(StrokeSimplifier.simplify_points(points, 1), points)
+        self.assertEqual(StrokeSimplifier.simplify_points(points, 10), [points[0], points[2]])
+
+    @unittest.skipIf(services.np is None, 'numpy is not installed')
+    def test_numpy_matches_python(self):
+        """The NumPy and pure-Python paths keep the same points."""
+        points = self.make_points(500)
+        xs = [p['x'] for p in points]
+        ys = [p['y'] for p in points]
+        self.assertEqual(
+            StrokeSimplifier._keep_mask_numpy(xs, ys, 0.3),
+            StrokeSimplifier._keep_mask_python(xs, ys, 0.3)
+        )
+
+    def test_tolerance_is_in_page_units(self):
+        """The tolerance is scaled by the zoom the stroke was drawn at."""
+        annotation = {'id': 'a', 'data': {'strokeData': {
+            'points': [{'x': 0, 'y': 0}, {'x': 10, 'y': 1}, {'x': 20, 'y': 0}],
+            'pathData': 'M 0 0 L 10 1 L 20 0', 'originalScale': 4}}}
+
+        same, points_in, points_out = StrokeSimplifier.simplify_annotation(annotation, 0.2)
+        self.assertIs(same, annotation)
+        self.assertEqual((points_in, points_out), (3, 3))
+
+        simplified, points_in, points_out = StrokeSimplifier.simplify_annotation(annotation, 0.5)
+        self.assertEqual((points_in, points_out), (3, 2))
+        self.assertNotIn('pathData', simplified['data']['strokeData'])
+        self.assertEqual(len(annotation['data']['strokeData']['points']), 3)
+
+    def test_save_reports_point_counts(self):
+        """The save response reports stroke points received and stored."""
+        block = make_annotation_block()
+        response = block.save_annotations(make_json_request({
+            'action': 'apply_ops', 'userId': 'anonymous',
+            'ops': [{'op': 'add', 'id': 'm1', 'type': 'scribble', 'page': 2, 'annotation': {
+                'type': 'scribble', 'data': {'strokeData': {'points': self.make_points(100)}}}}],
+        }))
+        body = json.loads(response.body)
+        self.assertEqual(body['strokePoints']['pointsIn'], 100)
+        self.assertLess(body['strokePoints']['pointsOut'], 20)
+
+
+class PageWindowTests(unittest.TestCase):
+    """Test cases for page-windowed annotation loading."""
+
+    def setUp(self):
+        """Set up a block with one text annotation on each of 40 pages."""
+        pages = {str(page): [{'id': f'note{page}', 'type': 'text', 'data': {}}] for page in range(1, 41)}
+        self.block = make_annotation_block({
+            'text_annotations': pages, 'current_page': 20,
+            'note_annotations': {'40': [{'id': 'sticky40'}]}, 'annotations': {'40': [{'id': 'legacy40'}]},
+        })
+
+    def test_student_view_embeds_page_window(self):
+        """Only the pages within preload_pages of the current page are embedded."""
+        with mock.patch.object(self.block.runtime, 'handler_url', return_value='/handler'):
+            content = self.block.student_view().content
+
+        self.assertIn('data-loaded-pages="18-22"', content)
+        for page in (18, 22):
+            self.assertIn(f'"note{page}"', content)
+        for page in (17, 23, 40):
+            self.assertNotIn(f'"note{page}"', content)
+        self.assertNotIn('sticky40', content)
+        self.assertNotIn('legacy40', content)
+
+    def test_load_pages(self):
+        """The load_pages action returns the requested page ranges."""
+        response = self.block.save_annotations(make_json_request({'action': 'load_pages', 'pages': [[3, 4], 39]}))
+        body = json.loads(response.body)
+
+        self.assertEqual(body['pages'], [[3, 4], [39, 39]])
+        self.assertEqual(sorted(body['data']['text_annotations'], key=int), ['3', '4', '39'])
+        self.assertEqual(body['data']['highlights'], {})
+
+    def test_parse_page_ranges(self):
+        """Page ranges are parsed from strings or lists and validated."""
+        self.assertEqual(PdfxXBlock._parse_page_ranges('3-7, 10'), [(3, 7), (10, 10)])
+        self.assertEqual(PdfxXBlock._parse_page_ranges([[1, 2], '5']), [(1, 2), (5, 5)])
+        for pages in (None, [], '5-2', '0', 'a-b', '1-1000'):
+            with self.assertRaises(ValueError):
+                PdfxXBlock._parse_page_ranges(pages)
+
+        response = self.block.save_annotations(make_json_request({'action': 'load_pages', 'pages': '9-1'}))
+        self.assertEqual(response.status_code, 400)
+
+
+class CompressedDictTests(unittest.TestCase):
+    """Test cases for transparently compressed annotation fields."""
+
+    def setUp(self):
+        """Set up a field and a large, repetitive value."""
+        self.field = PdfxXBlock.text_annotations
+        self.value = {str(page): [{'id': f'note{page}_{i}', 'type': 'text', 'data': {'text': 'lorem ipsum ' * 10}}
+                                  for i in range(5)]
+                      for page in range(1, 50)}
+        self.value['50'] = [{'id': 'small'}]
+
+    def test_large_values_are_compressed(self):
+        """Values above the threshold are stored as a smaller envelope of compressed pages."""
+        stored = self.field.to_json(self.value)
+        self.assertTrue(CompressedDict.is_compressed(stored))
+        self.assertLess(len(json.dumps(stored)) * 5, len(json.dumps(self.value)))
+        self.assertIsInstance(stored['pages']['1'], str)
+        self.assertEqual(stored['pages']['50'], [{'id': 'small'}])
+        self.assertEqual(self.field.from_json(stored), self.value)
+
+    def test_unchanged_pages_are_not_compressed_again(self):
+        """A save compresses the pages that changed; the others come from the cache."""
+        self.field.to_json(self.value)
+        self.value['2'].append({'id': 'new'})
+        with mock.patch('pdfx.models.zlib.compress', wraps=zlib.compress) as compress:
+            stored = self.field.to_json(self.value)
+        self.assertEqual(compress.call_count, 1)
+        self.assertEqual(self.field.from_json(stored), self.value)
+
+    def test_whole_field_envelopes_are_read(self):
+        """Fields stored by the first, whole-field format still decompress."""
+        data = base64.b64encode(zlib.compress(json.dumps(self.value).encode())).decode()
+        stored = {CompressedDict.FORMAT_KEY: CompressedDict.FIELD_FORMAT, 'data': data}
+        self.assertEqual(self.field.from_json(stored), self.value)
+
+    def test_small_and_legacy_values_stay_plain(self):
+        """Small values are stored as is, and plain stored dicts are read as is."""
+        small = {'1': [{'id': 'a'}]}
+        self.assertIs(self.field.to_json(small), small)
+        self.assertIs(self.field.from_json(self.value), self.value)
+        self.assertIsNone(self.field.from_json(None))
+
+    def test_block_round_trip(self):
+        """Blocks store compressed annotation fields and read them back decompressed."""
+        stored = {'current_page': 1}
+        block = make_annotation_block(stored)
+        block.text_annotations = self.value
+        block.save()
+
+        self.assertTrue(CompressedDict.is_compressed(stored['text_annotations']))
+        self.assertEqual(make_annotation_block(stored).text_annotations, self.value)
+
+    def test_bad_envelopes_survive_a_save(self):
+        """A corrupt or unknown envelope is kept next to annotations added after it."""
+        for envelope in ({CompressedDict.FORMAT_KEY: CompressedDict.FORMAT, 'pages': {'1': 'not zlib'}},
+                         {CompressedDict.FORMAT_KEY: 'zstd/9', 'pages': {'1': 'data'}}):
+            with self.subTest(envelope=envelope):
+                stored = {'text_annotations': envelope}
+                block = make_annotation_block(stored)
+                self.assertEqual(block.text_annotations, {})
+                block.text_annotations['2'] = [{'id': 'new'}]
+                block.save()
+
+                self.assertEqual(stored['text_annotations'][CompressedDict.PRESERVED_KEY], envelope)
+                reread = make_annotation_block(stored)
+                self.assertEqual(reread.text_annotations, {'2': [{'id': 'new'}]})
+                reread.text_annotations['3'] = [{'id': 'newer'}]
+                reread.save()
+                self.assertEqual(stored['text_annotations'][CompressedDict.PRESERVED_KEY], envelope)
+
+
+class RevisionTests(unittest.TestCase):
+    """Test cases for revision ETags and conditional loads."""
+
+    def setUp(self):
+        """Set up a block with one highlight."""
+        self.block = make_annotation_block({'highlights': {'1': [{'id': 'h1', 'type': 'highlight'}]}})
+
+    def load(self, etag=None, action='load', **params):
+        request = make_json_request(dict(params, action=action))
+        if etag:
+            request.headers['If-None-Match'] = etag
+        return self.block.save_annotations(request)
+
+    def test_load_exposes_revision_etag(self):
+        """Loads carry the revision in the body and at the start of the ETag."""
+        response = self.load()
+        self.assertTrue(response.headers['ETag'].startswith('"0-'))
+        self.assertEqual(json.loads(response.body)['revision'], 0)
+
+    def test_matching_etag_returns_304_without_building_payload(self):
+        """A load with a current If-None-Match short-circuits to 304."""
+        etag = self.load().headers['ETag']
+        with mock.patch.object(StrokeCodec, 'decode_strokes') as decode_strokes:
+            response = self.load(etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        decode_strokes.assert_not_called()
+
+    def test_load_pages_is_conditional(self):
+        """Page loads revalidate, and change with the pages asked for and the staff highlights."""
+        etag = self.load(action='load_pages', pages='1-2').headers['ETag']
+        self.assertEqual(self.load(etag, action='load_pages', pages='1-2').status_code, 304)
+        self.assertEqual(self.load(etag, action='load_pages', pages='1').status_code, 200)
+
+        with mock.patch.object(PdfxXBlock, 'is_staff_user', return_value=True):
+            staff_etag = self.load(action='load_pages', pages='1-2').headers['ETag']
+            self.block.staff_highlights = {'2': [{'id': 's1'}]}
+            response = self.load(staff_etag, action='load_pages', pages='1-2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.body)['data']['staff_highlights'], {'2': [{'id': 's1'}]})
+
+    def test_legacy_usage_is_not_measured_for_304(self):
+        """A conditional load answers 304 before usage is measured from the annotation fields."""
+        etag = self.load().headers['ETag']
+        self.block.annotation_usage = {}
+        with mock.patch.object(PdfxXBlock, '_get_annotation_usage') as get_usage:
+            self.assertEqual(self.load(etag).status_code, 304)
+        get_usage.assert_not_called()
+
+    def test_state_outside_annotations_changes_etag(self):
+        """Loads also carry the current page, which changes without a save."""
+        etag = self.load().headers['ETag']
+        self.block.current_page = 7
+        self.assertEqual(self.load(etag).status_code, 200)
+
+    def test_saves_advance_revision(self):
+        """Saves advance the revision, so older ETags load the new state."""
+        etag = self.load().headers['ETag']
+        response = self.block.save_annotations(make_json_request({
+            'action': 'apply_ops', 'userId': 'anonymous',
+            'ops': [{'op': 'delete', 'id': 'h1', 'type': 'highlight', 'page': 1}],
+        }))
+        self.assertEqual(json.loads(response.body)['revision'], 1)
+
+        # Operations that change nothing keep the revision
+        self.block.save_annotations(make_json_request({'action': 'apply_ops', 'userId': 'anonymous', 'ops': []}))
+        self.assertEqual(self.block.annotation_revision, 1)
+
+        response = self.load(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['ETag'].startswith('"1-'))
+        self.assertEqual(json.loads(response.body)['data']['highlights'], {})
+
+
+class ConcurrencyTests(unittest.TestCase):
+    """Test cases for saves based on an outdated revision."""
+
+    def setUp(self):
+        """Set up a block where another tab updated h1 after revision 0."""
+        self.block = make_annotation_block({
+            'highlights': {'1': [{'id': 'h1', 'type': 'highlight', 'data': {}}],
+                           '2': [{'id': 'h2', 'type': 'highlight', 'data': {}}]}
+        })
+        self.apply([self.update_op('h1', 1, 'first tab')])
+
+    def update_op(self, annotation_id, page, text, op='update'):
+        return {'op': op, 'id': annotation_id, 'type': 'highlight', 'page': page,
+                'annotation': {'type': 'highlight', 'data': {'text': text}}}
+
+    def apply(self, ops, base_revision=None):
+        data = {'action': 'apply_ops', 'userId': 'anonymous', 'ops': ops}
+        if base_revision is not None:
+            data['baseRevision'] = base_revision
+        response = self.block.save_annotations(make_json_request(data))
+        return response, json.loads(response.body)
+
+    def test_independent_changes_are_merged(self):
+        """Changes to annotations untouched since the base revision are merged by id."""
+        response, body = self.apply([self.update_op('h3', 1, 'second tab', op='add'),
+                                     self.update_op('h2', 2, 'second tab')], base_revision=0)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body['revision'], 2)
+        self.assertEqual(body['mergedPages'], ['1'])
+        self.assertEqual([ann['id'] for ann in self.block.highlights['1']], ['h1', 'h3'])
+        self.assertEqual(self.block.highlights['1'][0]['data'], {'text': 'first tab'})
+
+    def test_conflicting_changes_return_409(self):
+        """Overwriting an annotation saved after the base revision is refused."""
+        response, body = self.apply([self.update_op('h1', 1, 'second tab'),
+                                     self.update_op('h2', 2, 'second tab')], base_revision=0)
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(body['result'], 'conflict')
+        self.assertEqual(body['conflicts'], ['1'])
+        self.assertEqual(list(body['pages']['highlights']), ['1'])
+        self.assertEqual(body['revision'], 1)
+        self.assertEqual(self.block.highlights['1'][0]['data'], {'text': 'first tab'})
+        self.assertEqual(self.block.highlights['2'][0]['data'], {})
+
+    def test_clears_and_deleted_annotations_conflict(self):
+        """Clearing a changed page, or updating a deleted annotation, is refused."""
+        self.apply([{'op': 'delete', 'id': 'h2', 'type': 'highlight', 'page': 2}])
+
+        response, body = self.apply([{'op': 'clear', 'page': 1}], base_revision=0)
+        self.assertEqual((response.status_code, body['conflicts']), (409, ['1']))
+
+        response, body = self.apply([self.update_op('h2', 2, 'second tab')], base_revision=1)
+        self.assertEqual((response.status_code, body['conflicts']), (409, ['2']))
+
+        response, _ = self.apply([self.update_op('h2', 2, 'second tab')], base_revision=2)
+        self.assertEqual(response.status_code, 200)
+
+    def test_save_action_checks_base_revision(self):
+        """The full save action also honours baseRevision."""
+        response = self.block.save_annotations(make_json_request({
+            'action': 'save', 'userId': 'anonymous', 'baseRevision': 0,
+            'data': {'highlights': {'1': [{'id': 'h1', 'type': 'highlight', 'data': {}}]}},
+        }))
+        self.assertEqual(response.status_code, 409)
+
+        response, _ = self.apply([], base_revision='latest')
+        self.assertEqual(response.status_code, 400)
+
+
+class IdempotencyTests(unittest.TestCase):
+    """Test cases for idempotent save retries."""
+
+    def setUp(self):
+        """Set up a block and a fresh in-memory idempotency store."""
+        patcher = mock.patch.object(IdempotencyStore, '_default', IdempotencyStore())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.block = make_annotation_block()
+
+    def save(self, key, annotation_id='h1'):
+        return self.block.save_annotations(make_json_request({
+            'action': 'apply_ops', 'userId': 'anonymous', 'idempotencyKey': key,
+            'ops': [{'op': 'add', 'id': annotation_id, 'type': 'highlight', 'page': 1,
+                     'annotation': {'type': 'highlight', 'data': {}}}],
+        }))
+
+    def test_retry_replays_stored_response(self):
+        """A retry with the same key gets the first response without re-applying."""
+        first = self.save('batch-1')
+        with mock.patch.object(PdfxXBlock, '_handle_apply_ops') as handle_apply_ops:
+            retry = self.save('batch-1')
+
+        handle_apply_ops.assert_not_called()
+        self.assertEqual(json.loads(retry.body), json.loads(first.body))
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.block.annotation_revision, 1)
+
+    def test_new_key_applies_again(self):
+        """Requests with another key, or without a key, are applied."""
+        self.save('batch-1')
+        self.save('batch-2', 'h2')
+        self.assertEqual(self.block.annotation_revision, 2)
+        self.assertEqual(len(self.block.highlights['1']), 2)
+
+    def test_key_reused_for_another_request_is_refused(self):
+        """A key reused with another body or action gets 422, not the other request's response."""
+        self.save('batch-1')
+        other_body = self.save('batch-1', 'h2')
+        other_action = self.block.save_annotations(make_json_request({
+            'action': 'save', 'userId': 'anonymous', 'idempotencyKey': 'batch-1', 'currentPage': 2,
+        }))
+
+        self.assertEqual(other_body.status_code, 422)
+        self.assertEqual(other_action.status_code, 422)
+        self.assertEqual(self.block.annotation_revision, 1)
+        self.assertEqual([h['id'] for h in self.block.highlights['1']], ['h1'])
+
+    def test_memory_store_is_bounded(self):
+        """The in-memory store evicts the least recently used and expired entries."""
+        store = IdempotencyStore(max_entries=2, timeout=60)
+        store.set('a', {'status': 200})
+        store.set('b', {'status': 200})
+        store.get('a')
+        store.set('c', {'status': 200})
+        self.assertIsNone(store.get('b'))
+        self.assertEqual(store.get('a'), {'status': 200})
+
+        expired = IdempotencyStore(timeout=-1)
+        expired.set('a', {'status': 200})
+        self.assertIsNone(expired.get('a'))
+
+
+class UsageLimitTests(unittest.TestCase):
+    """Test cases for the annotation count and storage limits."""
+
+    def setUp(self):
+        """Set up a block without idempotency keys."""
+        self.block = make_annotation_block()
+
+    def apply_ops(self, ops):
+        return json.loads(self.block.save_annotations(make_json_request({
+            'action': 'apply_ops', 'userId': 'anonymous', 'ops': ops,
+        })).body)
+
+    def add(self, annotation_id, page=1, text='note'):
+        return {'op': 'add', 'id': annotation_id, 'type': 'highlight', 'page': page,
+                'annotation': {'type': 'highlight', 'data': {'text': text}}}
+
+    def test_usage_tracks_saves_and_deletes(self):
+        """Totals follow every change and match a full re-measure."""
+        self.apply_ops([self.add('h1'), self.add('h2', page=2), self.add('h1', text='longer note')])
+        self.apply_ops([{'op': 'delete', 'id': 'h2', 'type': 'highlight', 'page': 2}])
+
+        expected = AnnotationUsage({}, 0, 0)
+        expected.rebuild([self.block.highlights])
+        self.assertEqual(self.block.annotation_usage, expected.totals)
+        self.assertEqual(self.block.annotation_usage['count'], 1)
+
+        self.apply_ops([{'op': 'clear'}])
+        self.assertEqual(self.block.annotation_usage, {'count': 0, 'bytes': 0})
+
+    def test_count_limit_rejects_operation(self):
+        """Adds past the count limit are rejected with a structured error."""
+        with mock.patch('pdfx.pdfx.MAX_ANNOTATION_COUNT', 2):
+            body = self.apply_ops([self.add('h1'), self.add('h2'), self.add('h3'), self.add('h1', text='edit')])
+
+        self.assertEqual(body['applied'], 3)
+        self.assertEqual([rejected['id'] for rejected in body['rejected']], ['h3'])
+        self.assertEqual(body['limitExceeded']['code'], 'annotation_limit_exceeded')
+        self.assertEqual(body['limitExceeded']['limit'], 'count')
+        self.assertEqual(body['usage']['count'], 2)
+        self.assertEqual(len(self.block.highlights['1']), 2)
+
+    def test_byte_limit_refuses_legacy_save(self):
+        """The legacy save answers 413 and leaves the refused annotation out."""
+        with mock.patch.object(PdfxXBlock, '_get_setting', return_value=200):
+            response = self.block.save_annotations(make_json_request({
+                'userId': 'anonymous',
+                'data': {'highlights': {'1': [{'id': 'h1', 'type': 'highlight', 'data': {'text': 'x' * 500}}]}},
+            }))
+
+        body = json.loads(response.body)
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(body['error']['limit'], 'bytes')
+        self.assertEqual(body['savedIds'], [])
+        self.assertEqual(body['revision'], 0)
+        self.assertEqual(self.block.annotation_usage['count'], 0)
+        self.assertNotIn('1', self.block.highlights)
+
+    def test_legacy_save_lists_kept_annotations(self):
+        """A legacy save cut short by a limit lists the annotations it kept."""
+        with mock.patch('pdfx.pdfx.MAX_ANNOTATION_COUNT', 1):
+            response = self.block.save_annotations(make_json_request({
+                'userId': 'anonymous',
+                'data': {'highlights': {'1': [{'id': 'h1', 'type': 'highlight'}, {'id': 'h2', 'type': 'highlight'}]}},
+            }))
+
+        body = json.loads(response.body)
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(body['savedIds'], ['h1'])
+        self.assertEqual(body['revision'], 1)
+        self.assertEqual([annotation['id'] for annotation in self.block.highlights['1']], ['h1'])
+
+    def test_usage_rebuilt_for_legacy_state(self):
+        """State saved before usage tracking is measured once and reported on load."""
+        block = make_annotation_block({'highlights': {'1': [{'id': 'h1', 'type': 'highlight'}]}})
+        body = json.loads(block.save_annotations(make_json_request({'action': 'load'})).body)
+        self.assertEqual(body['usage']['count'], 1)
+        self.assertEqual(body['usage']['bytes'], AnnotationUsage.measure({'id': 'h1', 'type': 'highlight'}))
+
+
+class SqliteBackendTests(unittest.TestCase):
+    """Test cases for the row-per-annotation SQLite backend."""
+
+    def setUp(self):
+        """Point the sqlite backend setting at a fresh database."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'annotations.sqlite3')
+        patcher = mock.patch.dict(DEFAULT_SETTINGS, annotation_backend='sqlite', annotation_db_path=self.path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        SqliteAnnotationBackend.mark_migrated(self.path, '', 'usage-1')
+
+    def test_rows_are_scoped_and_paged(self):
+        """Each user sees only their rows; page loads return only the requested pages."""
+        backend = SqliteAnnotationBackend(self.path, 'course', 'block', 'alice')
+        other = SqliteAnnotationBackend(self.path, 'course', 'block', 'bob')
+        backend.upsert('highlights', '1', {'id': 'h1'})
+        backend.upsert('highlights', '5', {'id': 'h2'})
+        other.upsert('highlights', '1', {'id': 'h1', 'owner': 'bob'})
+
+        self.assertTrue(backend.upsert('text_annotations', '2', {'id': 'h1', 'moved': True}))
+        self.assertEqual(backend.get('h1'), ('text_annotations', '2', {'id': 'h1', 'moved': True}))
+        self.assertEqual(backend.load(['highlights'], [(4, 6)]), {'highlights': {'5': [{'id': 'h2'}]}})
+        self.assertEqual(backend.clear_page('5', ['highlights']), {'highlights': [{'id': 'h2'}]})
+        self.assertEqual(backend.remove('h1'), {'id': 'h1', 'moved': True})
+        self.assertEqual(backend.load(['highlights', 'text_annotations']), {'highlights': {}, 'text_annotations': {}})
+        self.assertEqual(other.load(['highlights'])['highlights']['1'][0]['owner'], 'bob')
+
+    def test_block_saves_rows_not_fields(self):
+        """Saves go to the database and loads read them back."""
+        block = make_annotation_block()
+        block.save_annotations(make_json_request({
+            'action': 'apply_ops', 'userId': 'anonymous',
+            'ops': [{'op': 'add', 'id': 'h1', 'type': 'highlight', 'page': 3,
+                     'annotation': {'type': 'highlight', 'data': {}}}],
+        }))
+
+        self.assertEqual(block.highlights, {})
+        body = json.loads(block.save_annotations(make_json_request({'action': 'load_pages', 'pages': '2-4'})).body)
+        self.assertEqual(body['data']['highlights']['3'][0]['id'], 'h1')
+        self.assertEqual(block.annotation_usage['count'], 1)
+
+    def test_unmigrated_block_keeps_fields(self):
+        """Until the block is migrated, the sqlite setting leaves every read and write on the fields."""
+        block = make_annotation_block({'highlights': {'1': [{'id': 'h1', 'type': 'highlight'}]}})
+        block.scope_ids = ScopeIds('student1', 'pdfx', 'def-1', 'usage-2')
+        body = json.loads(block.save_annotations(make_json_request({'action': 'load'})).body)
+
+        self.assertEqual(body['data']['highlights'], {'1': [{'id': 'h1', 'type': 'highlight'}]})
+        self.assertIsInstance(block._get_annotation_backend(), FieldAnnotationBackend)
+        self.assertEqual(block.highlights, {'1': [{'id': 'h1', 'type': 'highlight'}]})
+
+    def test_block_migration_moves_every_student(self):
+        """The command moves each student's fields, keeps what it cannot move and then switches the block."""
+        codec = CompressedDict()
+        UserState = namedtuple('UserState', 'username state')
+        states = {
+            'alice': {'highlights': codec.to_json({'1': [{'id': 'h1'}, {'type': 'highlight'}], 'notes': [{'id': 'h2'}]})},
+            'bob': {'text_annotations': codec.to_json({'2': [{'id': 't1', 'text': 'old'}]})},
+        }
+        client = mock.Mock()
+        client.iter_all_for_block.side_effect = lambda usage_key: [UserState(name, dict(state)) for name, state in states.items()]
+        client.set.side_effect = lambda username, usage_key, changed: states[username].update(changed)
+        usage_key = mock.MagicMock(course_key='')
+        usage_key.__str__.return_value = 'usage-2'
+        # bob already saved a newer copy to the database; the field copy must not replace it
+        SqliteAnnotationBackend(self.path, '', 'usage-2', '2').upsert('text_annotations', '2', {'id': 't1', 'text': 'new'})
+
+        self.assertFalse(SqliteAnnotationBackend.is_migrated(self.path, '', 'usage-2'))
+        self.assertEqual(migrate.migrate_block(self.path, usage_key, client, {'alice': 1, 'bob': 2}.get), (2, 2))
+
+        self.assertTrue(SqliteAnnotationBackend.is_migrated(self.path, '', 'usage-2'))
+        self.assertEqual(codec.from_json(states['alice']['highlights']), {'1': [{'type': 'highlight'}], 'notes': [{'id': 'h2'}]})
+        self.assertEqual(codec.from_json(states['bob']['text_annotations']), {})
+        self.assertEqual(SqliteAnnotationBackend(self.path, '', 'usage-2', '1').get('h1'), ('highlights', '1', {'id': 'h1'}))
+        self.assertEqual(SqliteAnnotationBackend(self.path, '', 'usage-2', '2').get('t1')[2]['text'], 'new')
+
+    def test_legacy_save_refuses_page_names(self):
+        """A legacy save to a page that is not a number is refused, not reported as saved."""
+        block = make_annotation_block()
+        response = block.save_annotations(make_json_request({
+            'userId': 'anonymous',
+            'data': {'highlights': {'1': [{'id': 'h1'}], 'intro': [{'id': 'h2'}]}},
+        }))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.body)['invalidPages'], ['highlights/intro'])
+        self.assertIsNone(SqliteAnnotationBackend(self.path, '', 'usage-1', 'student1').get('h1'))
+
+    def test_relative_path_needs_data_dir(self):
+        """A relative database path is resolved against DATA_DIR, not the working directory."""
+        block = make_annotation_block()
+        settings = mock.Mock(DATA_DIR='/edx/var/edxapp/data')
+        with mock.patch.dict(DEFAULT_SETTINGS, annotation_db_path='pdfx.sqlite3'):
+            with mock.patch.dict('sys.modules', {'django': mock.Mock(), 'django.conf': mock.Mock(settings=settings)}):
+                self.assertEqual(block._annotation_db_path(), '/edx/var/edxapp/data/pdfx.sqlite3')
+            with mock.patch.dict('sys.modules', {'django': None, 'django.conf': None}), self.assertRaises(ValueError):
+                block._annotation_db_path()
+
+    def test_rows_name_users_by_username(self):
+        """Rows of the block name users by username, like the field backend."""
+        SqliteAnnotationBackend(self.path, '', 'usage-1', '7').upsert('highlights', '1', {'id': 'h1'})
+        backend = SqliteAnnotationBackend(self.path, '', 'usage-1', '', usernames=lambda user_ids: {'7': 'alice'})
+        self.assertEqual(list(backend.iter_block(['highlights'])), [('alice', 'highlights', '1', {'id': 'h1'})])
+        self.assertEqual(backend.browse(['highlights'])[0], [('alice', 'highlights', '1', {'id': 'h1'})])
+
+
+class HighlightHeatmapTests(unittest.TestCase):
+    """Test cases for the class-wide highlight heatmap."""
+
+    def highlight(self, *rects):
+        return {'type': 'highlight', 'data': {'percentageRects': [
+            {'leftPercent': 0, 'topPercent': top, 'widthPercent': 50, 'heightPercent': height}
+            for top, height in rects
+        ]}}
+
+    def test_overlapping_highlights_stack(self):
+        """Rects of one highlight merge; highlights of different students add up."""
+        heatmap = HighlightHeatmap({})
+        heatmap.add('1', self.highlight((10, 5), (12, 5)))
+        heatmap.add('1', self.highlight((15, 10)))
+        self.assertEqual(heatmap.pages, {'1': [[100, 150, 1], [150, 170, 2], [170, 250, 1]]})
+
+        heatmap.add('1', self.highlight((10, 5), (12, 5)), -1)
+        heatmap.add('1', self.highlight((15, 10)), -1)
+        self.assertEqual(heatmap.pages, {})
+
+    def test_saves_update_heatmap(self):
+        """Adding, moving and deleting a highlight keeps the summary field current."""
+        block = make_annotation_block()
+
+        def apply_ops(ops):
+            block.save_annotations(make_json_request({'action': 'apply_ops', 'userId': 'anonymous', 'ops': ops}))
+
+        apply_ops([{'op': 'add', 'id': 'h1', 'type': 'highlight', 'page': 1, 'annotation': self.highlight((0, 10))}])
+        self.assertEqual(block.highlight_heatmap, {'1': [[0, 100, 1]]})
+
+        apply_ops([{'op': 'update', 'id': 'h1', 'type': 'highlight', 'page': 2, 'annotation': self.highlight((50, 10))}])
+        self.assertEqual(block.highlight_heatmap, {'2': [[500, 600, 1]]})
+        self.assertEqual(block.get_class_highlight_heatmap(), {'2': [[500, 600, 1]]})
+
+        apply_ops([{'op': 'clear', 'page': 2}])
+        self.assertEqual(block.highlight_heatmap, {})
+
+    def test_rebuild_counts_stored_highlights(self):
+        """Staff rebuild the heatmap from every student's highlights, replacing stale counts."""
+        block = make_annotation_block()
+        block.highlight_heatmap = {'9': [[0, 1000, 5]]}
+        rows = [
+            ('alice', 'highlights', '1', self.highlight((0, 10))),
+            ('bob', 'highlights', '1', self.highlight((5, 10))),
+        ]
+        with mock.patch.object(FieldAnnotationBackend, 'iter_block', return_value=iter(rows)) as iter_block, \
+                mock.patch.object(PdfxXBlock, 'is_staff_user', return_value=True):
+            response = block.rebuild_heatmap(make_json_request({}))
+
+        iter_block.assert_called_once_with(['highlights'])
+        self.assertEqual(json.loads(response.body)['highlights'], 2)
+        self.assertEqual(block.highlight_heatmap, {'1': [[0, 50, 1], [50, 100, 2], [100, 150, 1]]})
+
+    def test_rebuild_requires_staff(self):
+        """Students cannot rebuild the heatmap."""
+        block = make_annotation_block()
+        with mock.patch.object(PdfxXBlock, 'is_staff_user', return_value=False):
+            response = block.rebuild_heatmap(make_json_request({}))
+        self.assertEqual(response.status_code, 403)
+
+
+class ExportTests(unittest.TestCase):
+    """Test cases for the streaming annotation export."""
+
+    UserState = namedtuple('UserState', 'username state')
+
+    def setUp(self):
+        """Set up a sqlite database holding two students' annotations."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'annotations.sqlite3')
+        for user_id, timestamp in (('alice', 1704067200000), ('bob', 1717200000000)):
+            backend = SqliteAnnotationBackend(self.path, '', 'usage-1', user_id)
+            backend.upsert('highlights', '2', {'id': f'{user_id}-h', 'timestamp': timestamp, 'data': {}})
+            backend.upsert('text_annotations', '9', {'id': f'{user_id}-t', 'timestamp': timestamp, 'data': {}})
+            backend.commit()
+
+    def test_filters(self):
+        """Type, page and date filters apply to every row."""
+        exporter = AnnotationExporter.from_params({'types': 'highlight', 'pages': '1-5', 'since': '2024-03-01'})
+        rows = SqliteAnnotationBackend(self.path, '', 'usage-1', '').iter_block(exporter.field_names)
+        self.assertEqual([record['id'] for record in exporter.records(rows)], ['bob-h'])
+
+        with self.assertRaises(ValueError):
+            AnnotationExporter.from_params({'types': 'bogus'})
+
+    def test_user_states_are_decoded(self):
+        """Annotations are read from raw user states, compressed or not."""
+        compressed = CompressedDict(threshold=0).to_json({'3': [{'id': 'h1'}]})
+        states = [self.UserState('carol', {'highlights': compressed, 'current_page': 3})]
+        self.assertEqual(
+            list(FieldAnnotationBackend.iter_states(states)),
+            [('carol', 'highlights', '3', {'id': 'h1'})]
+        )
+
+    def test_csv_stream(self):
+        """CSV output has a header and one row per annotation."""
+        exporter = AnnotationExporter()
+        rows = SqliteAnnotationBackend(self.path, '', 'usage-1', '').iter_block(exporter.field_names)
+        lines = b''.join(exporter.stream(rows, 'csv')).decode().splitlines()
+        self.assertEqual(lines[0], 'user,type,page,id,timestamp,revision,data,config')
+        self.assertEqual(len(lines), 5)
+
+    def test_handler_streams_for_staff_only(self):
+        """The handler refuses students and streams NDJSON to staff."""
+        block = make_annotation_block()
+        request = mock.Mock(GET={'format': 'ndjson', 'types': 'text'})
+        self.assertEqual(block.export_annotations(request).status_code, 403)
+
+        SqliteAnnotationBackend.mark_migrated(self.path, '', 'usage-1')
+        with mock.patch.dict(DEFAULT_SETTINGS, annotation_backend='sqlite', annotation_db_path=self.path), \
+                mock.patch.object(PdfxXBlock, 'is_staff_user', return_value=True):
+            response = block.export_annotations(request)
+
+        self.assertEqual(response.content_type, 'application/x-ndjson')
+        records = [json.loads(line) for line in b''.join(response.app_iter).splitlines()]
+        self.assertEqual([(record['user'], record['id']) for record in records], [('alice', 'alice-t'), ('bob', 'bob-t')])
+
+    def test_command_line(self):
+        """The CLI writes the export of a sqlite database to a file."""
+        output = self.path + '.ndjson'
+        export.main(['usage-1', '--db', self.path, '--course', '', '--pages', '9', '-o', output])
+        with open(output, 'rb') as export_file:
+            self.assertEqual(len(export_file.read().splitlines()), 2)
+
+
+class BrowseTests(unittest.TestCase):
+    """Test cases for the cursor-paginated staff browse handler."""
+
+    def setUp(self):
+        """Set up a sqlite database with three students' annotations and a staff block."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'annotations.sqlite3')
+        for user_id in ('carol', 'alice', 'bob'):
+            backend = SqliteAnnotationBackend(path, '', 'usage-1', user_id)
+            backend.upsert('highlights', '10', {'id': 'h2'})
+            backend.upsert('highlights', '2', {'id': 'h1'})
+            backend.commit()
+
+        SqliteAnnotationBackend.mark_migrated(path, '', 'usage-1')
+        for patcher in (
+            mock.patch.dict(DEFAULT_SETTINGS, annotation_backend='sqlite', annotation_db_path=path),
+            mock.patch.object(PdfxXBlock, 'is_staff_user', return_value=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.block = make_annotation_block()
+
+    def browse(self, **params):
+        response = self.block.browse_annotations(mock.Mock(GET=params))
+        return response.status_code, json.loads(response.body)
+
+    def test_cursor_walks_every_record_once(self):
+        """Pages follow (user, page, id) order and end with a null cursor."""
+        seen = []
+        cursor = None
+        while True:
+            status, body = self.browse(limit='4', cursor=cursor)
+            self.assertEqual(status, 200)
+            self.assertLessEqual(len(body['records']), 4)
+            seen.extend((record['user'], record['page']) for record in body['records'])
+            cursor = body['nextCursor']
+            if not cursor:
+                break
+
+        self.assertEqual(seen, [(user, page) for user in ('alice', 'bob', 'carol') for page in ('2', '10')])
+
+    def test_field_backend_does_not_browse(self):
+        """Without the sqlite index, browsing is refused instead of scanning every student."""
+        with mock.patch.dict(DEFAULT_SETTINGS, annotation_backend='fields'):
+            block = make_annotation_block()
+            response = block.browse_annotations(mock.Mock(GET={}))
+        self.assertEqual(response.status_code, 501)
+        self.assertIn('sqlite', json.loads(response.body)['error'])
+
+    def test_bad_cursor(self):
+        """Malformed cursors are rejected."""
+        status, body = self.browse(cursor='not-a-cursor')
+        self.assertEqual(status, 400)
+
+
+class TemplateCacheTests(unittest.TestCase):
+    """Test cases for the compiled template cache."""
+
+    def setUp(self):
+        """Start from an empty cache."""
+        TemplateCache.clear()
+        self.addCleanup(TemplateCache.clear)
+
+    def test_template_compiled_once(self):
+        """Lookups return the template compiled on first use."""
+        template = TemplateCache.get('static/html/pdfx_edit.html')
+        self.assertIs(TemplateCache.get('static/html/pdfx_edit.html'), template)
+
+    def test_mtime_change_recompiles(self):
+        """With the mtime check, a changed file is compiled again."""
+        with mock.patch.object(TemplateCache, '_mtime', return_value=1):
+            template = TemplateCache.get('static/html/pdfx_edit.html', check_mtime=True)
+            self.assertIs(TemplateCache.get('static/html/pdfx_edit.html', check_mtime=True), template)
+        with mock.patch.object(TemplateCache, '_mtime', return_value=2):
+            self.assertIsNot(TemplateCache.get('static/html/pdfx_edit.html', check_mtime=True), template)
+
+
+class StaticAssetsTests(unittest.TestCase):
+    """Test cases for content-hashed static assets."""
+
+    def test_build_writes_hashed_files(self):
+        """Each asset is copied under a content-hashed name listed in the manifest."""
+        package_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, package_dir)
+        for path in STUDENT_VIEW_CSS + STUDENT_VIEW_JS:
+            os.makedirs(os.path.dirname(os.path.join(package_dir, path)), exist_ok=True)
+            with open(os.path.join(package_dir, path), 'w') as source:
+                source.write(f'/* {path} */')
+
+        manifest = assets.build(package_dir)
+        built_path = manifest['static/js/pdfx-init.js']
+        self.assertRegex(built_path, r'^public/build/pdfx-init\.[0-9a-f]{12}\.js$')
+        with open(os.path.join(package_dir, assets.MANIFEST_PATH)) as manifest_file:
+            self.assertEqual(json.load(manifest_file), manifest)
+        with open(os.path.join(package_dir, built_path)) as built:
+            self.assertEqual(built.read(), '/* static/js/pdfx-init.js */')
+
+    def test_fragment_uses_urls_from_manifest(self):
+        """Built assets are referenced by URL and the others are inlined."""
+        block = make_annotation_block()
+        frag = mock.Mock()
+        manifest = {'static/js/pdfx-init.js': 'public/build/pdfx-init.abc.js'}
+        with mock.patch.object(assets.StaticAssets, '_manifest', manifest), \
+                mock.patch.object(block.runtime, 'local_resource_url', return_value='/resource/pdfx-init.abc.js'), \
+                mock.patch.object(PdfxXBlock, 'resource_string', return_value='inline'):
+            assets.StaticAssets.add_to_fragment(block, frag)
+
+        frag.add_javascript_url.assert_called_once_with('/resource/pdfx-init.abc.js')
+        self.assertEqual(frag.add_javascript.call_count, len(STUDENT_VIEW_JS) - 1)
+        self.assertEqual(frag.add_css.call_count, len(STUDENT_VIEW_CSS))
+
+
+class InitialStateTests(unittest.TestCase):
+    """Test cases for the initial-state JSON payload of the student view."""
+
+    def test_script_json_escapes_markup(self):
+        """Markup in annotation text cannot close the script block."""
+        state = {'textAnnotations': {'1': [{'text': '</script><b>a & b</b>'}]}}
+        serialized = PdfxXBlock._script_json(state)
+        self.assertNotIn('<', serialized)
+        self.assertNotIn('&', serialized)
+        self.assertEqual(json.loads(serialized), state)
+
+    def test_template_embeds_state_once(self):
+        """The template embeds the payload unescaped, in one script block."""
+        template = TemplateCache.get('static/html/pdfx.html')
+        payload = PdfxXBlock._script_json({'highlights': {'1': [{'text': '"quoted"'}]}})
+        context = {name: '' for name in re.findall(r'\$\{\s*(\w+)', template.source)}
+        context.update(block_id='b1', initial_state_json=payload)
+        rendered = template.render(**context)
+        self.assertEqual(rendered.count(payload), 1)
+        self.assertIn('<script type="application/json" id="pdfx-state-b1">', rendered)
+
+
+class RequestContextTests(unittest.TestCase):
+    """Test cases for the per-request user, staff role and course context."""
+
+    def setUp(self):
+        """Create a block whose user service reports an authenticated staff user."""
+        self.block = make_annotation_block()
+        self.user_service = mock.Mock()
+        self.user_service.get_current_user.return_value = mock.Mock(opt_attrs={
+            'edx-platform.user_id': 7,
+            'edx-platform.username': 'ada',
+            'edx-platform.is_authenticated': True,
+            'edx-platform.anonymous_user_id': 'anon-7',
+            'edx-platform.user_role': 'instructor',
+        })
+        self.user_service.get_user_by_anonymous_id.return_value = mock.Mock(email='ada@example.com')
+        self.block.runtime.service = mock.Mock(side_effect=lambda block, name: self.user_service if name == 'user' else None)
+
+    def test_resolved_once_per_request(self):
+        """User, staff role and course are looked up once, however often they are read."""
+        self.block._begin_request(mock.Mock())
+        for _ in range(3):
+            self.assertEqual(self.block.get_course_info(), {'id': ''})
+            self.assertEqual(self.block._get_request_context().user_id, '7')
+            self.assertTrue(self.block.is_staff_user())
+        self.user_service.get_current_user.assert_called_once()
+
+        self.block._begin_request(mock.Mock())
+        self.block._get_request_context().user_id
+        self.assertEqual(self.user_service.get_current_user.call_count, 2)
+
+    def test_email_resolved_lazily(self):
+        """The Django user is only looked up when the email is read."""
+        context = self.block._begin_request(mock.Mock())
+        self.assertEqual(context.username, 'ada')
+        self.user_service.get_user_by_anonymous_id.assert_not_called()
+
+        self.assertEqual(self.block.get_user_info()['email'], 'ada@example.com')
+        self.assertEqual(context.email, 'ada@example.com')
+        self.user_service.get_user_by_anonymous_id.assert_called_once_with('anon-7')
+
+    def test_save_does_not_resolve_email(self):
+        """Saving annotations resolves the user once and never the email."""
+        request = make_json_request({'userId': '7', 'data': {'highlights': {}}})
+        with mock.patch.object(PdfxXBlock, '_validate_csrf_token', return_value=True):
+            response = self.block.save_annotations(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.user_service.get_current_user.call_count, 1)
+        self.user_service.get_user_by_anonymous_id.assert_not_called()
+
+
+class InstrumentationTests(unittest.TestCase):
+    """Test cases for handler timers, counters and sampled debug events."""
+
+    def setUp(self):
+        """Start from empty metrics."""
+        Metrics.reset()
+        self.addCleanup(Metrics.reset)
+
+    def test_timers_and_counters(self):
+        """Timers count calls and keep the total and longest time."""
+        Metrics.incr('save.deletions', 2)
+        for _ in range(3):
+            with Metrics.timer('save.merge'):
+                pass
+        snapshot = Metrics.snapshot()
+        self.assertEqual(snapshot['counters'], {'save.deletions': 2})
+        self.assertEqual(snapshot['timers']['save.merge']['count'], 3)
+        self.assertLessEqual(snapshot['timers']['save.merge']['maxMs'], snapshot['timers']['save.merge']['totalMs'])
+
+    def test_disabled_events_compute_nothing(self):
+        """Without debug_mode, event fields are neither computed nor logged."""
+        field = mock.Mock()
+        with self.assertNoLogs('pdfx.instrumentation', level='INFO'):
+            DebugEvents(enabled=False).emit('save.done', pages=field)
+        field.assert_not_called()
+
+    def test_sampled_events_are_logged(self):
+        """With debug_mode, sampled requests log one structured line per event."""
+        with self.assertLogs('pdfx.instrumentation', level='INFO') as logs:
+            DebugEvents(enabled=True, sample_rate=1.0).emit('save.done', pages=lambda: [1, 2])
+        self.assertEqual(logs.output, ['INFO:pdfx.instrumentation:pdfx.save.done {"pages": [1, 2]}'])
+        self.assertFalse(DebugEvents(enabled=True, sample_rate=0).sampled)
+
+    def test_save_records_phases(self):
+        """A save records its parse, validate, merge, save and serialize timers."""
+        block = make_annotation_block()
+        request = make_json_request({'userId': 'anonymous', 'data': {'highlights': {'1': [{'id': 'h1'}]}}})
+        with mock.patch.object(PdfxXBlock, '_validate_csrf_token', return_value=True):
+            block.save_annotations(request)
+        with mock.patch.object(PdfxXBlock, 'is_staff_user', return_value=True):
+            response = block.instrumentation(mock.Mock(GET={}))
+        timers = json.loads(response.body)['timers']
+        for name in ('annotations.parse', 'save.validate', 'save.merge', 'save.save', 'response.serialize'):
+            self.assertIn(name, timers)
+
+
+class ServePdfTests(unittest.TestCase):
+    """Test cases for range-capable PDF serving."""
+
+    ASSET = 'asset-v1:Org+Course+Run+type@asset+block@pdfs_abc_book.pdf'
+
+    def setUp(self):
+        """Create a block with an uploaded PDF held in memory."""
+        self.block = make_annotation_block({'pdf_file_asset_key': f'/{self.ASSET}'})
+        self.data = bytes(range(256)) * 40
+        self.content = mock.Mock(
+            spec=['location', 'data', 'length', 'content_digest', 'locked', 'last_modified_at'],
+            location=self.ASSET, data=self.data, length=len(self.data), content_digest='d1g3st',
+            locked=False, last_modified_at=datetime(2024, 1, 2, 3, 4, 5)
+        )
+        patcher = mock.patch.object(PdfxXBlock, '_find_pdf_asset', return_value=self.content)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def serve(self, suffix='pdfs_abc_book.pdf', **headers):
+        """Call serve_pdf with a real webob request."""
+        return self.block.serve_pdf(Request.blank('/', headers=headers), suffix)
+
+    def test_parse_range(self):
+        """Single ranges resolve to inclusive offsets; others serve everything or are refused."""
+        self.assertEqual(AssetStream.parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(AssetStream.parse_range('bytes=900-', 1000), (900, 999))
+        self.assertEqual(AssetStream.parse_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(AssetStream.parse_range('bytes=990-5000', 1000), (990, 999))
+        self.assertIsNone(AssetStream.parse_range(None, 1000))
+        self.assertIsNone(AssetStream.parse_range('bytes=0-1,5-9', 1000))
+        with self.assertRaises(ValueError):
+            AssetStream.parse_range('bytes=1000-', 1000)
+
+    def test_full_response(self):
+        """Without a Range header the whole PDF is streamed with cache and range headers."""
+        response = self.serve()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.body, self.data)
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(response.headers['ETag'], '"d1g3st"')
+        self.assertEqual(response.headers['Last-Modified'], 'Tue, 02 Jan 2024 03:04:05 GMT')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertEqual(self.serve(suffix='old.pdf').headers['Cache-Control'], 'private, no-cache')
+
+    def test_range_response(self):
+        """A byte range gets 206 with only the requested bytes, read in chunks."""
+        response = self.serve(Range='bytes=100-299')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers['Content-Range'], f'bytes 100-299/{len(self.data)}')
+        self.assertEqual(response.content_length, 200)
+        self.assertEqual(b''.join(AssetStream.iter_range(self.content, 100, 299, chunk_size=64)), self.data[100:300])
+        self.assertEqual(response.body, self.data[100:300])
+
+    def test_unsatisfiable_range(self):
+        """A range past the end gets 416 with the asset length."""
+        response = self.serve(Range=f'bytes={len(self.data)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.headers['Content-Range'], f'bytes */{len(self.data)}')
+
+    def test_conditional_requests(self):
+        """If-None-Match revalidates; a stale If-Range serves the whole new PDF."""
+        self.assertEqual(self.serve(**{'If-None-Match': '"d1g3st"'}).status_code, 304)
+        self.assertEqual(self.serve(Range='bytes=0-9', **{'If-Range': '"d1g3st"'}).status_code, 206)
+        stale = self.serve(Range='bytes=0-9', **{'If-Range': '"older"'})
+        self.assertEqual(stale.status_code, 200)
+        self.assertEqual(stale.content_length, len(self.data))
+
+    def test_pdf_url_points_at_handler(self):
+        """Uploaded PDFs are served by the handler, named after the asset."""
+        with mock.patch.object(self.block.runtime, 'handler_url', return_value='/handler/serve_pdf/x') as handler_url:
+            self.assertEqual(self.block.get_pdf_url(), '/handler/serve_pdf/x')
+        handler_url.assert_called_once_with(self.block, 'serve_pdf', 'pdfs_abc_book.pdf')
+
+
+class PdfUploadTests(unittest.TestCase):
+    """Test cases for the chunked PDF upload reader."""
+
+    PDF = b'%PDF-1.7\n' + bytes(range(256)) * 20
+
+    def test_reads_once_with_digest_and_size(self):
+        """The upload is hashed and measured as it is read, in chunks."""
+        stream = io.BytesIO(self.PDF)
+        with mock.patch.object(stream, 'read', wraps=stream.read) as read:
+            with PdfUpload.read(stream, chunk_size=1000) as upload:
+                self.assertEqual(upload.size, len(self.PDF))
+                self.assertEqual(upload.sha256, hashlib.sha256(self.PDF).hexdigest())
+                self.assertEqual(upload.data.read(), self.PDF)
+        self.assertTrue(all(call.args == (1000,) for call in read.call_args_list))
+
+    def test_header_split_across_chunks(self):
+        """The %PDF header is found even when the first chunk is shorter."""
+        with PdfUpload.read(io.BytesIO(self.PDF), chunk_size=2) as upload:
+            self.assertEqual(upload.size, len(self.PDF))
+
+    def test_not_a_pdf_stops_at_first_chunk(self):
+        """A file without the header is refused without reading the rest."""
+        stream = io.BytesIO(b'<html>' + self.PDF)
+        with self.assertRaises(PdfUploadError) as context:
+            PdfUpload.read(stream, chunk_size=100)
+        self.assertEqual(context.exception.code, 'not_a_pdf')
+        self.assertEqual(stream.tell(), 100)
+        with self.assertRaises(PdfUploadError):
+            PdfUpload.read(io.BytesIO(b'%P'))
+
+    def test_too_large_stops_at_limit(self):
+        """Reading stops at the first chunk past the size limit."""
+        stream = io.BytesIO(self.PDF)
+        with self.assertRaises(PdfUploadError) as context:
+            PdfUpload.read(stream, max_size=1000, chunk_size=600)
+        self.assertEqual(context.exception.code, 'file_too_large')
+        self.assertEqual(stream.tell(), 1200)
+        self.assertEqual(context.exception.to_dict()['result'], 'error')
+
+    def test_upload_is_not_copied(self):
+        """In memory or spooled to disk, the contentstore gets the rewound spool, not a copy."""
+        for spool_size in (1024, len(self.PDF) * 2):
+            with PdfUpload.read(io.BytesIO(self.PDF), chunk_size=1000, spool_size=spool_size) as upload:
+                upload.spool.read()
+                data = upload.data
+                self.assertIs(data, upload.spool)
+                self.assertEqual(data.read(), self.PDF)
+
+    def test_identical_upload_reuses_asset(self):
+        """Uploads are named by content hash and an existing copy is not written again."""
+        store = mock.Mock()
+        store.find.return_value = None
+        static_content = mock.Mock()
+        static_content.compute_location.side_effect = lambda course_key, path: f'{course_key}/{path}'
+        static_content.serialize_asset_key_with_slash.side_effect = lambda key: f'/{key}'
+        modules = {
+            'xmodule': mock.Mock(), 'xmodule.contentstore': mock.Mock(),
+            'xmodule.contentstore.django': mock.Mock(contentstore=lambda: store),
+            'xmodule.contentstore.content': mock.Mock(StaticContent=static_content),
+        }
+        block = make_annotation_block()
+        block.location.course_key = 'course-v1:Org+Course+Run'
+        digest = hashlib.sha256(self.PDF).hexdigest()
+
+        with mock.patch.dict('sys.modules', modules):
+            with PdfUpload.read(io.BytesIO(self.PDF)) as upload:
+                first = block._store_pdf_upload(upload, 'syllabus.pdf', 'test.store')
+            stored = mock.Mock(length=len(self.PDF), content_digest=hashlib.md5(self.PDF).hexdigest())
+            store.find.return_value = stored
+            with PdfUpload.read(io.BytesIO(self.PDF)) as upload:
+                second = block._store_pdf_upload(upload, 'copy of syllabus.pdf', 'test.store')
+
+        asset_url = f'/course-v1:Org+Course+Run/pdfs_{digest[:32]}.pdf'
+        self.assertEqual(first, (asset_url, False))
+        self.assertEqual(second, (asset_url, True))
+        store.save.assert_called_once()
+        stored.close.assert_called_once()
+
+    def test_damaged_asset_is_written_again(self):
+        """A stored copy of the right length but other content is not reused."""
+        with PdfUpload.read(io.BytesIO(self.PDF)) as upload:
+            damaged = self.PDF[:-10] + bytes(10)
+            self.assertFalse(upload.matches(mock.Mock(length=len(self.PDF), content_digest=hashlib.md5(damaged).hexdigest())))
+            # Stores without a digest are compared by reading the stored bytes
+            stream = mock.Mock(length=len(self.PDF), content_digest=None)
+            stream.stream_data.return_value = iter([damaged])
+            self.assertFalse(upload.matches(stream))
+            stream.stream_data.return_value = iter([self.PDF[:100], self.PDF[100:]])
+            self.assertTrue(upload.matches(stream))
+
+    def test_upload_pdf_refuses_non_pdf(self):
+        """The upload handler answers a refused file with its error code."""
+        block = make_annotation_block()
+        upload = mock.Mock(filename='notes.pdf', file=io.BytesIO(b'not a pdf'))
+        response = block.upload_pdf(mock.Mock(params={'file': upload}))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.body)['code'], 'not_a_pdf')
+
+
+class PdfAnalysisTests(unittest.TestCase):
+    """Test cases for the upload-time PDF analysis."""
+
+    ANALYSIS = {
+        'numPages': 3, 'pageSizes': [[612.0, 792.0, 2], [842.0, 595.0, 1]], 'title': 'Book', 'author': 'Ada',
+        'outline': [{'title': 'Intro <1>', 'page': 1, 'items': [{'title': 'Part', 'page': 3, 'items': []}]}],
+    }
+
+    @unittest.skipIf(services.pypdf is None, "pypdf is not installed")
+    def test_analyze(self):
+        """Page count, sizes, metadata and the nested outline are read from the PDF."""
+        writer = services.pypdf.PdfWriter()
+        writer.add_blank_page(612, 792)
+        writer.add_blank_page(612, 792)
+        writer.add_blank_page(842, 595)
+        intro = writer.add_outline_item('Intro <1>', 0)
+        writer.add_outline_item('Part', 2, parent=intro)
+        writer.add_metadata({'/Title': 'Book', '/Author': 'Ada'})
+        stream = io.BytesIO()
+        writer.write(stream)
+
+        self.assertEqual(PdfAnalyzer.analyze(stream), self.ANALYSIS)
+        self.assertEqual(stream.tell(), 0)
+
+    @unittest.skipIf(services.pypdf is None, "pypdf is not installed")
+    def test_unreadable_pdf(self):
+        """A PDF the parser cannot read gets an empty analysis."""
+        self.assertEqual(PdfAnalyzer.analyze(io.BytesIO(b'%PDF-1.4 truncated')), {})
+
+    def test_without_pypdf(self):
+        """Without the parser the analysis is empty and the viewer relies on pdf.js."""
+        with mock.patch.object(services, 'pypdf', None):
+            self.assertEqual(PdfAnalyzer.analyze(io.BytesIO(b'%PDF-1.4')), {})
+
+    def test_analysis_stored_once(self):
+        """The analysis is stored by content hash and reused for an upload already in the course."""
+        DerivedAsset.clear()
+        self.addCleanup(DerivedAsset.clear)
+        store = mock.Mock()
+        store.find.return_value = None
+        static_content = mock.Mock()
+        static_content.compute_location.side_effect = lambda course_key, path: f'{course_key}/{path}'
+        modules = {
+            'xmodule': mock.Mock(), 'xmodule.contentstore': mock.Mock(),
+            'xmodule.contentstore.django': mock.Mock(contentstore=lambda: store),
+            'xmodule.contentstore.content': mock.Mock(StaticContent=static_content),
+        }
+        block = make_annotation_block()
+        block.location.course_key = 'course'
+
+        with mock.patch.dict('sys.modules', modules), PdfUpload.read(io.BytesIO(b'%PDF-1.4')) as upload, \
+                mock.patch.object(PdfAnalyzer, 'analyze', return_value=self.ANALYSIS) as analyze:
+            self.assertEqual(block._analyze_pdf_upload(upload, reuse=False), self.ANALYSIS)
+            stored = static_content.call_args.args
+            self.assertTrue(stored[1].endswith('.analysis.json.gz'))
+
+            store.find.return_value = mock.Mock(length=len(stored[3]), data=stored[3])
+            self.assertEqual(block._analyze_pdf_upload(upload), self.ANALYSIS)
+        analyze.assert_called_once()
+        store.save.assert_called_once()
+
+    def test_template_placeholders_and_outline(self):
+        """The student view shows the page count, sized placeholders and an escaped outline."""
+        template = TemplateCache.get('static/html/pdfx.html')
+        context = {name: '' for name in re.findall(r'\$\{\s*(\w+)', template.source)}
+        context.update(
+            block_id='b1', num_pages=3, outline=self.ANALYSIS['outline'],
+            page_placeholders=PdfAnalyzer.expand_page_sizes(self.ANALYSIS)
+        )
+        rendered = template.render(**context)
+        self.assertIn('> of 3</span>', rendered)
+        self.assertEqual(rendered.count('pdfx-page-placeholder'), 3)
+        self.assertIn('data-page-number="3" style="aspect-ratio: 842.0 / 595.0;"', rendered)
+        self.assertIn('<a href="#page=1" data-page="1">Intro &lt;1&gt;</a>', rendered)
+        self.assertIn('data-page="3">Part</a>', rendered)
+
+
+class PdfTextIndexTests(unittest.TestCase):
+    """Test cases for the upload-time text index and the search handler."""
+
+    PAGES = ['Chapter one: cells and energy.', '', 'Energy flows   through\ncells of the body.', 'Appendix']
+
+    def setUp(self):
+        """Start with an empty index cache."""
+        PdfTextIndex.clear()
+        self.addCleanup(PdfTextIndex.clear)
+
+    def test_build_and_search(self):
+        """Pages holding every query word are found in order, with a snippet."""
+        index = PdfTextIndex.build(self.PAGES)
+        self.assertEqual(index['terms']['cells'], [1, 3])
+        self.assertEqual(index['pages'][2], 'Energy flows through cells of the body.')
+
+        matches, total = PdfTextIndex.search(index, 'Energy CELLS', limit=10)
+        self.assertEqual(total, 2)
+        self.assertEqual([match['page'] for match in matches], [1, 3])
+        self.assertEqual(matches[1]['snippet'], 'Energy flows through cells of the body.')
+        self.assertEqual(PdfTextIndex.search(index, 'energy appendix', limit=10), ([], 0))
+        self.assertEqual(PdfTextIndex.search(index, 'cells', limit=1)[1], 2)
+
+    def test_snippet_is_cut_around_match(self):
+        """Long pages are cut around the first whole-word match."""
+        text = 'x' * 200 + ' target ' + 'y' * 200
+        snippet = PdfTextIndex.snippet(text, ['target'])
+        self.assertTrue(snippet.startswith('…') and snippet.endswith('…'))
+        self.assertIn(' target ', snippet)
+        self.assertLess(len(snippet), len(text))
+
+    def test_no_text_no_index(self):
+        """A PDF without text, e.g. a scan, gets no index."""
+        self.assertIsNone(PdfTextIndex.build(['', '  ']))
+
+    def test_load_reads_once(self):
+        """An index is read from the contentstore once per process."""
+        data = PdfTextIndex.dumps(PdfTextIndex.build(self.PAGES))
+        read = mock.Mock(return_value=data)
+        first = PdfTextIndex.load('index-key', read)
+        self.assertIs(PdfTextIndex.load('index-key', read), first)
+        read.assert_called_once_with()
+
+    @unittest.skipIf(services.pypdf is None, "pypdf is not installed")
+    def test_extract_pages(self):
+        """The text of each page is extracted with pypdf."""
+        self.assertEqual(PdfTextIndex.extract_pages(make_text_pdf(['Hello world', 'Page two'])), ['Hello world', 'Page two'])
+
+    def test_search_handler(self):
+        """search_pdf returns matching pages and snippets from the stored index."""
+        block = make_annotation_block({'pdf_search_index': 'asset-v1:O+C+R+type@asset+block@pdfs_abc.index.json.gz'})
+        data = PdfTextIndex.dumps(PdfTextIndex.build(self.PAGES))
+        with mock.patch.object(PdfxXBlock, '_read_asset', return_value=data):
+            response = block.search_pdf(mock.Mock(GET={'q': 'energy', 'limit': '1'}))
+            self.assertEqual(response.status_code, 200)
+            body = json.loads(response.body)
+            self.assertEqual(body['total'], 2)
+            self.assertEqual(body['matches'], [{'page': 1, 'snippet': 'Chapter one: cells and energy.'}])
+            self.assertEqual(block.search_pdf(mock.Mock(GET={'q': ' '})).status_code, 400)
+
+        block.pdf_search_index = ''
+        self.assertEqual(block.search_pdf(mock.Mock(GET={'q': 'energy'})).status_code, 404)
+
+    def test_search_handler_begins_request(self):
+        """Like the other handlers, search_pdf starts its own request context."""
+        block = make_annotation_block()
+        stale = block._begin_request()
+        block.search_pdf(mock.Mock(GET={'q': 'energy'}))
+        self.assertIsNot(block._get_request_context(), stale)
+
+
+class PdfTextLayerTests(unittest.TestCase):
+    """Test cases for the precomputed text layer and its handler."""
+
+    LAYER_KEY = 'asset-v1:O+C+R+type@asset+block@pdfs_abc.text.json.gz'
+
+    def setUp(self):
+        """Start with an empty derived asset cache."""
+        DerivedAsset.clear()
+        self.addCleanup(DerivedAsset.clear)
+
+    def test_run_transform_and_width(self):
+        """Runs carry the pdf.js transform and a width clipped at the next run."""
+        runs = []
+        cm = [2, 0, 0, 2, 10, 20]
+        PdfTextLayer.add_run(runs, 'Hello ', cm, [1, 0, 0, 1, 5, 300], None, 10, {})
+        PdfTextLayer.add_run(runs, '\n', cm, [1, 0, 0, 1, 0, 0], None, 10, {})
+        PdfTextLayer.add_run(runs, 'world', cm, [1, 0, 0, 1, 30, 300], {'/Widths': [0, 400, 600]}, 10, {})
+        self.assertEqual(runs, [
+            ['Hello ', 20.0, 0.0, 0.0, 20.0, 20.0, 620.0, 60.0],
+            ['world', 20.0, 0.0, 0.0, 20.0, 70.0, 620.0, 50.0],
+        ])
+        PdfTextLayer.clip_widths(runs)
+        self.assertEqual(runs[0][7], 50.0)
+        self.assertIsNone(PdfTextLayer.build([[], []]))
+
+    def test_warns_once_without_pypdf(self):
+        """Without pypdf, extraction is empty and says so once per process."""
+        with mock.patch.object(services, 'pypdf', None), \
+                mock.patch.object(PdfTextLayer, '_warned_without_pypdf', False), \
+                self.assertLogs(services.logger, 'WARNING') as logs:
+            self.assertEqual(PdfTextLayer.extract(io.BytesIO(b'%PDF-1.4')), [])
+            self.assertEqual(PdfTextIndex.extract_pages(io.BytesIO(b'%PDF-1.4')), [])
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn('index_pdf_text', logs.output[0])
+
+    @unittest.skipIf(services.pypdf is None, "pypdf is not installed")
+    def test_extract(self):
+        """Text and runs of every page come from one pypdf pass."""
+        pages = PdfTextLayer.extract(make_text_pdf(['Hello world', 'Two']))
+        self.assertEqual([text for text, _ in pages], ['Hello world', 'Two'])
+        self.assertEqual(pages[0][1][0][:7], ['Hello world', 12.0, 0.0, 0.0, 12.0, 72.0, 700.0])
+
+    @unittest.skipIf(services.pypdf is None, "pypdf is not installed")
+    def test_text_assets_stored_once(self):
+        """Index and layer are stored at the first upload and reused afterwards."""
+        store = mock.Mock()
+        store.find.return_value = None
+        static_content = mock.Mock()
+        static_content.compute_location.side_effect = lambda course_key, path: f'{course_key}/{path}'
+        modules = {
+            'xmodule': mock.Mock(), 'xmodule.contentstore': mock.Mock(),
+            'xmodule.contentstore.django': mock.Mock(contentstore=lambda: store),
+            'xmodule.contentstore.content': mock.Mock(StaticContent=static_content),
+        }
+        block = make_annotation_block()
+        block.location.course_key = 'course'
+        pdf = make_text_pdf(['Cells and energy']).getvalue()
+
+        with mock.patch.dict('sys.modules', modules), PdfUpload.read(io.BytesIO(pdf)) as upload:
+            index_key, layer_key = block._store_text_assets(upload)
+            self.assertTrue(index_key.endswith('.index.json.gz') and layer_key.endswith('.text.json.gz'))
+            self.assertEqual(store.save.call_count, 2)
+
+            store.find.return_value = mock.Mock(length=100)
+            with mock.patch.object(PdfTextLayer, 'extract') as extract:
+                self.assertEqual(block._store_text_assets(upload), (index_key, layer_key))
+            extract.assert_not_called()
+            self.assertEqual(block._store_text_assets(upload, layer=False), (index_key, ''))
+            self.assertEqual(store.find.return_value.close.call_count, 3)
+
+    def test_handler(self):
+        """text_layer serves one page of runs, cached for good under the layer's name."""
+        layer = PdfTextLayer.build([[['Hello', 12, 0, 0, 12, 72, 700, 30]], []])
+        block = make_annotation_block({'pdf_text_layer': self.LAYER_KEY})
+        with mock.patch.object(PdfxXBlock, '_read_asset', return_value=DerivedAsset.dumps(layer)) as read_asset:
+            response = block.text_layer(Request.blank('/?page=1'), 'pdfs_abc.text.json.gz')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.body), {'page': 1, 'runs': [['Hello', 12, 0, 0, 12, 72, 700, 30]]})
+            self.assertEqual(response.headers['Cache-Control'], f'private, max-age={365 * 24 * 60 * 60}, immutable')
+
+            etag = response.headers['ETag']
+            self.assertEqual(block.text_layer(Request.blank('/?page=1', headers={'If-None-Match': etag}), '').status_code, 304)
+            self.assertEqual(block.text_layer(Request.blank('/?page=2'), '').headers['Cache-Control'], 'private, no-cache')
+            self.assertEqual(block.text_layer(Request.blank('/?page=3'), '').status_code, 404)
+            self.assertEqual(block.text_layer(Request.blank('/?page=x'), '').status_code, 400)
+        read_asset.assert_called_once_with(self.LAYER_KEY)
+
+
 class ServiceTests(unittest.TestCase):
     """Test cases for the service classes."""
 
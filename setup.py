@@ -2,8 +2,13 @@
 Setup file for the PDF XBlock.
 """
 
+import importlib.util
 import os
+import sys
+from distutils import log
 from setuptools import setup
+from setuptools.command.build_py import build_py
+
 
 def package_data(pkg, roots):
     """Generic function to find package_data.
@@ -19,6 +24,29 @@ def package_data(pkg, roots):
 
     return {pkg: data}
 
+
+def load_module(name, path):
+    """Load one module of the package by path, without importing the package (and XBlock)."""
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class BuildPyWithAssets(build_py):
+    """Build the content-hashed student view assets (pdfx/assets.py) into the package."""
+
+    def run(self):
+        super().run()
+        load_module('pdfx.config', os.path.join('pdfx', 'config.py'))
+        assets = load_module('pdfx.assets', os.path.join('pdfx', 'assets.py'))
+        # Editable installs run from the source tree, so build there
+        target = 'pdfx' if getattr(self, 'editable_mode', False) else os.path.join(self.build_lib, 'pdfx')
+        for path, built_path in assets.build(target).items():
+            self.announce(f"pdfx asset: {path} -> {built_path}", level=log.INFO)
+
+
 setup(
     name='pdfx-xblock',
     version='0.2.0',
@@ -31,13 +59,26 @@ setup(
         'XBlock',
         'xblock-utils',
         'pymongo>=3.12.0',
+        # Upload-time PDF analysis, search index and text layer
+        'pypdf',
     ],
+    extras_require={
+        # Vectorized stroke simplification
+        'numpy': ['numpy'],
+    },
     entry_points={
         'xblock.v1': [
             'pdfx = pdfx:PdfxXBlock',
-        ]
+        ],
+        'console_scripts': [
+            'pdfx-export-annotations = pdfx.export:main',
+            'pdfx-migrate-annotations = pdfx.migrate:main',
+        ],
     },
     package_data=package_data("pdfx", ["static", "public", "translations"]),
+    cmdclass={
+        'build_py': BuildPyWithAssets,
+    },
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Environment :: Web Environment',